@@ -0,0 +1,39 @@
+from types import MappingProxyType
+
+_EMPTY = MappingProxyType({})
+
+
+# Предвычисленный индекс прав доступа
+class AccessIndex:
+    """Неизменяемый снимок конфигурации: белый список в виде множества и готовые
+    (только для чтения) списки серверов для каждого пользователя"""
+    
+    def __init__(self, servers, allowed_user_ids, user_access):
+        self.servers = MappingProxyType(dict(servers))
+        self.allowed_user_ids = frozenset(allowed_user_ids)
+        self.user_access = MappingProxyType({user_id: tuple(user_servers) for user_id, user_servers in user_access.items()})
+        
+        # Если права доступа не настроены - всем доступны все серверы,
+        # иначе пользователям вне списка прав не доступно ничего
+        self._default_view = self.servers if not user_access else _EMPTY
+        self._views = {}
+        for user_id, user_servers in user_access.items():
+            # Пустой список или '*' - доступ ко всем серверам
+            if not user_servers or '*' in user_servers:
+                self._views[user_id] = self.servers
+            else:
+                allowed = set(user_servers)
+                self._views[user_id] = MappingProxyType(
+                    {server_id: config for server_id, config in self.servers.items() if server_id in allowed})
+    
+    def check_access(self, user_id):
+        """Есть ли пользователь в белом списке (пустой список - доступ для всех)"""
+        return not self.allowed_user_ids or user_id in self.allowed_user_ids
+    
+    def check_server_access(self, user_id, server_id):
+        """Есть ли у пользователя доступ к конкретному серверу"""
+        return server_id in self._views.get(user_id, self._default_view)
+    
+    def available_servers(self, user_id):
+        """Готовый список серверов пользователя (только для чтения)"""
+        return self._views.get(user_id, self._default_view)
@@ -0,0 +1,1047 @@
+"""Асинхронная среда выполнения бота (BOT_RUNTIME=async).
+
+AsyncTeleBot и asyncssh работают в одном цикле событий: ожидающая SSH сессия не занимает
+поток ОС. Меню, тексты, callback_data, права доступа и кэш статусов общие с bot.py.
+"""
+import asyncio
+import itertools
+import logging
+import time
+
+import asyncssh
+from concurrent.futures import Future
+
+from telebot import types
+from telebot.async_telebot import AsyncTeleBot
+
+import bot as core
+from callbacks import action_fields
+from capture import CommandResult
+from jobs import Job
+from sshkeys import KeyCache, KnownHosts
+
+logger = logging.getLogger(__name__)
+
+
+class _AsyncPoolEntry:
+    """Состояние одного сервера в асинхронном пуле"""
+    
+    def __init__(self, max_channels):
+        self.lock = asyncio.Lock()
+        self.channels = asyncio.Semaphore(max_channels)
+        self.conn = None
+        self.fingerprint = None
+        self.connected_at = None
+        self.connect_time = None
+
+
+# Асинхронный пул SSH соединений (по одному соединению на сервер)
+class AsyncSSHPool:
+    """Аналог SSHConnectionPool для asyncssh: одно соединение на сервер, процесс на каждую команду"""
+    
+    def __init__(self, keepalive=30, max_channels=4, connect_timeout=30, known_hosts=None):
+        self.keepalive = keepalive
+        self.max_channels = max_channels
+        self.connect_timeout = connect_timeout
+        self.known_hosts = known_hosts if known_hosts is not None else KnownHosts()
+        self.keys = KeyCache(asyncssh.read_private_key)
+        self._entries = {}
+    
+    def _entry(self, server_id):
+        entry = self._entries.get(server_id)
+        if entry is None:
+            entry = _AsyncPoolEntry(self.max_channels)
+            self._entries[server_id] = entry
+        return entry
+    
+    async def _connect(self, server_config, timeout):
+        logger.info(f"Подключение к {server_config['name']} (asyncssh)")
+        known_hosts = await self._trusted_host_keys(server_config, timeout)
+        password = server_config.get('password')
+        key = None
+        if server_config.get('key_path'):
+            try:
+                key = self.keys.get(server_config['key_path'], server_config.get('key_passphrase'))
+            except (OSError, ValueError) as e:
+                if not password:
+                    raise
+                logger.warning(f"Не удалось загрузить ключ для {server_config['name']} ({e}), используется пароль")
+        # asyncssh не разделяет TCP соединение и авторизацию - замеряются вместе (login_key, login_password)
+        if key is not None:
+            try:
+                with core.ssh_seconds.time(server=server_config['id'], operation='login_key'):
+                    return await self._open(server_config, timeout, known_hosts, client_keys=[key])
+            except asyncssh.PermissionDenied as e:
+                if not password:
+                    raise
+                logger.warning(f"Авторизация по ключу на {server_config['name']} не удалась ({e}), используется пароль")
+        with core.ssh_seconds.time(server=server_config['id'], operation='login_password'):
+            return await self._open(server_config, timeout, known_hosts, password=password)
+    
+    async def _trusted_host_keys(self, server_config, timeout):
+        """Сохраненные ключи хоста для asyncssh. Ключ неизвестного хоста запрашивается отдельно
+        и проходит проверку KnownHosts (при политике tofu запоминается)"""
+        hostname = server_config['hostname']
+        port = server_config.get('port', 22)
+        known = self.known_hosts.lookup(hostname, port)
+        if not known:
+            host_key = await asyncio.wait_for(asyncssh.get_server_host_key(hostname, port), timeout)
+            key_type, key = host_key.export_public_key('openssh').decode().split()[:2]
+            self.known_hosts.check(hostname, port, key_type, key)
+            known = {key_type: key}
+        return [asyncssh.import_public_key(f"{key_type} {key}") for key_type, key in known.items()], [], []
+    
+    async def _open(self, server_config, timeout, known_hosts, client_keys=None, password=None):
+        # client_keys=None и agent_path=None: не перебираем ключи из ~/.ssh и агента
+        return await asyncssh.connect(
+            server_config['hostname'],
+            port=server_config.get('port', 22),
+            username=server_config['username'],
+            password=password,
+            client_keys=client_keys,
+            agent_path=None,
+            known_hosts=known_hosts,
+            keepalive_interval=self.keepalive,
+            connect_timeout=timeout,
+            login_timeout=timeout,
+        )
+    
+    def _drop(self, entry):
+        if entry.conn is not None:
+            entry.conn.close()
+        entry.conn = None
+        entry.fingerprint = None
+        entry.connected_at = None
+        entry.connect_time = None
+    
+    async def get_connection(self, server_id, server_config, timeout=None):
+        """Возвращает живое соединение, при необходимости переподключаясь"""
+        entry = self._entry(server_id)
+        fingerprint = core.SSHConnectionPool._fingerprint(server_config)
+        async with entry.lock:
+            if entry.conn is not None and (entry.fingerprint != fingerprint or entry.conn.is_closed()):
+                logger.warning(f"Соединение с {server_config['name']} потеряно, переподключение")
+                self._drop(entry)
+            if entry.conn is None:
+                started = time.monotonic()
+                entry.conn = await self._connect(server_config, timeout or self.connect_timeout)
+                entry.fingerprint = fingerprint
+                entry.connected_at = time.monotonic()
+                entry.connect_time = entry.connected_at - started
+            return entry.conn
+    
+    async def run(self, server_id, server_config, command, result, on_output=None, cancel=None, timeout=None):
+        """Выполняет команду с учетом лимита каналов, одновременно вычитывая stdout и stderr
+        в буферы result (CommandResult) и записывая в него код возврата.
+        on_output(text) вызывается для каждого фрагмента вывода по мере поступления.
+        cancel (CancelToken) и timeout останавливают команду с ее процессами (result.interrupted)"""
+        entry = self._entry(server_id)
+        cancellable = cancel is not None or bool(timeout)
+        deadline = time.monotonic() + timeout if timeout else None
+        pid = 0
+        async with entry.channels:
+            for attempt in range(2):
+                conn = await self.get_connection(server_id, server_config)
+                try:
+                    process = await conn.create_process(core.cancellable_command(command) if cancellable else command,
+                                                        encoding='utf-8', errors='replace')
+                    break
+                except (asyncssh.Error, OSError):
+                    # Соединение умерло между проверкой и открытием канала - пробуем еще раз
+                    if entry.conn is conn:
+                        self._drop(entry)
+                    if attempt:
+                        raise
+            
+            async def read(stream, capture):
+                while True:
+                    text = await stream.read(32768)
+                    if not text:
+                        return
+                    capture.feed(text)
+                    if on_output:
+                        on_output(text)
+            
+            async def read_stdout():
+                nonlocal pid
+                if cancellable:
+                    # Первая строка - PID оболочки команды
+                    line = await process.stdout.readline()
+                    pid, _ = core.split_pid_line(line.encode())
+                    if not pid and line:
+                        result.stdout.feed(line)
+                        if on_output:
+                            on_output(line)
+                await read(process.stdout, result.stdout)
+            
+            async with process:
+                started = time.perf_counter()
+                reading = asyncio.gather(read_stdout(), read(process.stderr, result.stderr))
+                reason = await self._wait_or_stop(reading, cancel, deadline) if cancellable else None
+                if reason is None:
+                    await reading
+                    completed = await process.wait()
+                    result.exit_status = completed.exit_status
+                    core.ssh_seconds.observe(time.perf_counter() - started, server=server_id, operation='command')
+                else:
+                    result.interrupted = reason
+                    logger.info(f"Команда на {server_config['name']} остановлена ({reason}): {command}")
+                    reading.cancel()
+                    # Забираем CancelledError чтения, иначе asyncio пожалуется на непрочитанное исключение
+                    await asyncio.gather(reading, return_exceptions=True)
+                    await self._stop(conn, process, pid, server_config)
+        return result
+    
+    @staticmethod
+    async def _wait_or_stop(reading, cancel, deadline):
+        """Ждет окончания вывода команды; возвращает причину остановки, если она наступила раньше"""
+        while True:
+            reason = core.stop_reason(cancel, deadline)
+            if reason:
+                return reason
+            done, _ = await asyncio.wait({reading}, timeout=0.1)
+            if done:
+                return None
+    
+    async def _stop(self, conn, process, pid, server_config):
+        """Останавливает процессы команды: SIGTERM, через UPDATE_KILL_GRACE секунд - SIGKILL.
+        Служебные команды выполняются вне лимита каналов"""
+        if not pid:
+            return
+        try:
+            await asyncio.wait_for(conn.run(core.kill_tree_command(pid), check=False), self.connect_timeout)
+            try:
+                await asyncio.wait_for(process.wait_closed(), core.UPDATE_KILL_GRACE)
+            except asyncio.TimeoutError:
+                await asyncio.wait_for(conn.run(core.kill_tree_command(pid, 'KILL'), check=False), self.connect_timeout)
+        except Exception as e:
+            logger.warning(f"Не удалось остановить процессы команды на {server_config['name']}: {e}")
+    
+    async def probe(self, server_id, server_config, timeout):
+        """Проверяет сервер командой echo, возвращает (время подключения или None, время выполнения)"""
+        entry = self._entry(server_id)
+        connected_before = entry.connected_at
+        conn = await asyncio.wait_for(self.get_connection(server_id, server_config, timeout), timeout)
+        connect_time = entry.connect_time if entry.connected_at != connected_before else None
+        started = time.monotonic()
+        async with entry.channels:
+            await asyncio.wait_for(conn.run("echo 'test'", check=False), timeout)
+        return connect_time, time.monotonic() - started
+    
+    async def execute(self, server_id, server_config, command, timeout):
+        """Выполняет короткую команду с дедлайном и возвращает ее stdout"""
+        entry = self._entry(server_id)
+        conn = await asyncio.wait_for(self.get_connection(server_id, server_config, timeout), timeout)
+        async with entry.channels:
+            completed = await asyncio.wait_for(conn.run(command, check=False), timeout)
+        return completed.stdout or ''
+    
+    async def close(self, server_id=None):
+        """Закрывает соединения одного сервера или всего пула"""
+        if server_id is None:
+            entries = list(self._entries.values())
+        else:
+            entries = [self._entries[server_id]] if server_id in self._entries else []
+        for entry in entries:
+            conn = entry.conn
+            self._drop(entry)
+            if conn is not None:
+                await conn.wait_closed()
+
+
+# Асинхронный планировщик задач
+class AsyncJobScheduler:
+    """Аналог JobScheduler на задачах asyncio: не более workers задач всего
+    и per_server_limit на сервер, задачи одного сервера - в порядке поступления"""
+    
+    def __init__(self, workers=4, per_server_limit=1, on_finish=None):
+        self.workers = workers
+        self.per_server_limit = per_server_limit
+        self.on_finish = on_finish
+        self._slots = asyncio.Semaphore(workers)
+        self._server_slots = {}
+        self._queued = {}
+        self._running = {}
+        self._ids = itertools.count(1)
+        self._tasks = set()
+    
+    def submit(self, server_id, description, func, chat_id=None, user_id=None, job_id=None):
+        """Ставит задачу в очередь сервера. Возвращает задачу и количество задач перед ней"""
+        job = Job(job_id or next(self._ids), server_id, description, func, chat_id, user_id)
+        ahead = sum(1 for queued in self._queued.values() if queued.server_id == server_id)
+        running = sum(1 for running_job in self._running.values() if running_job.server_id == server_id)
+        if running >= self.per_server_limit:
+            ahead += running
+        self._queued[job.id] = job
+        task = asyncio.create_task(self._run(job))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        logger.info(f"Задача #{job.id} ({server_id}: {description}) поставлена в очередь, перед ней {ahead}")
+        return job, ahead
+    
+    def snapshot(self):
+        """Возвращает списки выполняющихся и ожидающих задач"""
+        return (sorted(self._running.values(), key=lambda job: job.id),
+                sorted(self._queued.values(), key=lambda job: job.id))
+    
+    def find(self, job_id):
+        return self._running.get(job_id) or self._queued.get(job_id)
+    
+    def cancel(self, job_id):
+        """Отменяет задачу: ожидающая сразу убирается из очереди, у выполняющейся срабатывает
+        cancel_token. Возвращает задачу или None, если она уже завершилась"""
+        job = self._running.get(job_id)
+        if job is not None:
+            job.cancel_token.cancel()
+            logger.info(f"Задача #{job_id} отменяется")
+            return job
+        job = self._queued.pop(job_id, None)
+        if job is None:
+            return None
+        job.cancel_token.cancel()
+        job.status = 'cancelled'
+        job.finished_at = time.time()
+        logger.info(f"Задача #{job_id} отменена до запуска")
+        self._notify_finish(job)
+        return job
+    
+    def _notify_finish(self, job):
+        if self.on_finish is not None:
+            try:
+                self.on_finish(job)
+            except Exception as e:
+                logger.error(f"Ошибка обработки завершения задачи #{job.id}: {e}")
+    
+    async def _run(self, job):
+        server_slots = self._server_slots.get(job.server_id)
+        if server_slots is None:
+            server_slots = self._server_slots[job.server_id] = asyncio.Semaphore(self.per_server_limit)
+        # Семафоры asyncio выдают слоты в порядке ожидания - очередь сервера остается FIFO
+        async with server_slots, self._slots:
+            if self._queued.pop(job.id, None) is None:
+                # Задачу отменили, пока она ждала очереди
+                return
+            job.status = 'running'
+            job.started_at = time.time()
+            self._running[job.id] = job
+            try:
+                job.result = await job.func(job)
+                job.status = job.cancel_token.reason if job.cancel_token.stopped else 'done'
+            except Exception as e:
+                job.status = 'failed'
+                logger.error(f"Ошибка выполнения задачи #{job.id}: {e}")
+            finally:
+                job.finished_at = time.time()
+                self._running.pop(job.id, None)
+                self._notify_finish(job)
+
+
+# Запросы к Bot API через общую очередь
+class AsyncOutbox:
+    """Обертки над TelegramOutbox с сигнатурами AsyncTeleBot: лимиты, повтор после 429 и слияние
+    правок те же, что в синхронном режиме. Запросы выполняют потоки очереди, корутина ждет только
+    результата отправки; редактирования и ответы на callback уходят в фоне"""
+    
+    def __init__(self, outbox):
+        self.outbox = outbox
+    
+    async def send_message(self, chat_id, text, **kwargs):
+        return await asyncio.wrap_future(self.outbox.submit('send_message', chat_id, chat_id, text, **kwargs))
+    
+    async def reply_to(self, message, text, **kwargs):
+        return await asyncio.wrap_future(self.outbox.submit('reply_to', message.chat.id, message, text, **kwargs))
+    
+    async def send_document(self, chat_id, document, **kwargs):
+        return await asyncio.wrap_future(self.outbox.submit('send_document', chat_id, chat_id, document, **kwargs))
+    
+    async def edit_message_text(self, text, chat_id, message_id, **kwargs):
+        self.outbox.edit_message_text(text, chat_id, message_id, **kwargs)
+    
+    async def answer_callback_query(self, callback_query_id, text=None, show_alert=None, **kwargs):
+        self.outbox.answer_callback_query(callback_query_id, text, show_alert, **kwargs)
+
+
+# Инициализируем асинхронного бота и общие ресурсы
+# (AsyncTeleBot только получает обновления, ответы уходят через outbox)
+bot = AsyncTeleBot(core.BOT_TOKEN)
+outbox = AsyncOutbox(core.outbox)
+
+ssh_pool = AsyncSSHPool(
+    keepalive=core.SSH_KEEPALIVE,
+    max_channels=core.SSH_MAX_CHANNELS_PER_HOST,
+    connect_timeout=core.SSH_CONNECT_TIMEOUT,
+    known_hosts=core.known_hosts,
+)
+
+# Создаются в main(), когда уже запущен цикл событий
+job_scheduler = None
+
+
+# Живое сообщение о ходе выполнения
+class AsyncStreamingStatusMessage(core.StreamingStatusMessage):
+    """StreamingStatusMessage для цикла событий: отправка и правки уходят через очередь core.outbox
+    без ожидания, методы - корутины для единообразия вызовов; начать нужно с start()"""
+    
+    def _start(self):
+        pass
+    
+    async def start(self):
+        super()._start()
+        return self
+    
+    async def tick(self):
+        super().tick()
+    
+    async def finish(self, success, interrupted=None):
+        super().finish(success, interrupted)
+
+
+class StreamBridge:
+    """Передает вывод из потока ожидания исполнителя в живое сообщение цикла событий;
+    редактирует сообщение тикер run_ssh_command"""
+    
+    def __init__(self, loop, stream):
+        self.loop = loop
+        self.stream = stream
+    
+    def feed(self, text):
+        self.loop.call_soon_threadsafe(self.stream.feed, text)
+    
+    def tick(self):
+        pass
+
+
+async def ssh_probe(server_config, timeout):
+    """Подключение и отклик сервера: через исполнитель в раздельном режиме, иначе через свой пул"""
+    if core.executor_clients:
+        return await asyncio.to_thread(core.ssh_probe, server_config, timeout)
+    return await ssh_pool.probe(server_config['id'], server_config, timeout)
+
+
+async def ssh_execute(server_config, command, timeout):
+    if core.executor_clients:
+        return await asyncio.to_thread(core.ssh_execute, server_config, command, timeout)
+    return await ssh_pool.execute(server_config['id'], server_config, command, timeout)
+
+
+async def run_ssh_command(server_config, command, stream=None, cancel=None, timeout=None):
+    """Выполняет команду через асинхронный пул и возвращает CommandResult;
+    при stream вывод показывается по мере поступления, cancel и timeout останавливают команду"""
+    on_output = stream.feed if stream is not None else None
+    
+    async def tick():
+        while True:
+            await asyncio.sleep(0.5)
+            await stream.tick()
+    
+    ticker = asyncio.create_task(tick()) if stream is not None else None
+    try:
+        if core.executor_clients:
+            # Раздельный режим: ответов исполнителя ждет отдельный поток, вывод передается в цикл событий
+            bridge = StreamBridge(asyncio.get_running_loop(), stream) if stream is not None else None
+            return await asyncio.to_thread(core.run_remote_command, server_config, command, bridge, cancel, timeout)
+        result = CommandResult(**core.CAPTURE_LIMITS)
+        try:
+            await ssh_pool.run(server_config['id'], server_config, command, result, on_output, cancel, timeout)
+        except Exception as e:
+            result.error = f"SSH Connection failed to {server_config['name']}: {e}"
+            logger.error(result.error)
+    finally:
+        if ticker is not None:
+            ticker.cancel()
+    core.ssh_commands.inc(server=server_config['id'], outcome=core.command_outcome(result))
+    return result
+
+
+async def run_update(chat_id, server_id, pc_number=None, force=False, message_id=None, pc_numbers=None, job=None):
+    """Выполняет обновление компьютера, выбранных компьютеров (pc_numbers) или всего сервера
+    и отправляет результат. Возвращает код возврата (None - команда не выполнялась)"""
+    cancel = job.cancel_token if job is not None else None
+    markup = core.cancel_markup(job) if job is not None else None
+    server_config = core.SERVERS_CONFIG.get(server_id)
+    if server_config is None:
+        await notify_chats(core.result_chats(job, chat_id), "❌ **Ошибка**\nСервер удален из конфигурации")
+        return None
+    
+    if pc_numbers:
+        pc_numbers = [number for number in pc_numbers if core.number_to_ip(server_config, number)]
+        if not pc_numbers:
+            await notify_chats(core.result_chats(job, chat_id), "❌ **Ошибка**\nВыбранных компьютеров больше нет на сервере")
+            return None
+        results = await run_mass_update_parallel(chat_id, server_config, message_id, pc_numbers, force, job)
+        return core.mass_exit_status(results)
+    
+    if not pc_number and core.MASS_UPDATE_MODE == 'parallel':
+        results = await run_mass_update_parallel(chat_id, server_config, message_id, job=job)
+        return core.mass_exit_status(results)
+    
+    command = core.update_command(server_config, pc_number, force)
+    stream = None
+    if core.STREAM_OUTPUT:
+        title = core.result_title(server_config, pc_number, force)
+        stream = await AsyncStreamingStatusMessage(chat_id, title, message_id=message_id, reply_markup=markup).start()
+    result = await run_ssh_command(server_config, command, stream, cancel)
+    if stream is not None:
+        await stream.finish(result.ok, result.interrupted)
+    
+    # Результат уходит в фоне (core.send_result): задача не ждет очереди отправки. Сборка документа
+    # (gzip, буферы захвата на диске) выполняется в потоке, чтобы не останавливать цикл событий
+    return await asyncio.to_thread(core.deliver_result, core.result_chats(job, chat_id), server_config,
+                                   pc_number, result, force)
+
+
+async def run_pc_update(server_config, pc_number, force=False, cancel=None):
+    """Запускает fre.sh для одного компьютера и возвращает итог (ok / busy / failed / cancelled / timeout)"""
+    started = time.monotonic()
+    if cancel is not None and cancel.check():
+        result = CommandResult(**core.CAPTURE_LIMITS)
+        result.interrupted = cancel.reason
+    else:
+        result = await run_ssh_command(server_config, core.update_command(server_config, pc_number, force),
+                                       cancel=cancel, timeout=core.UPDATE_TIMEOUT_PC)
+    return core.pc_update_summary(server_config, pc_number, result, started)
+
+
+async def run_mass_update_parallel(chat_id, server_config, message_id=None, pc_numbers=None, force=False, job=None):
+    """Параллельное массовое обновление по отдельным ПК (не более MASS_UPDATE_CONCURRENCY одновременно),
+    сводка отправляется всем подписчикам задачи job"""
+    cancel = job.cancel_token if job is not None else None
+    reply_markup = core.cancel_markup(job) if job is not None else None
+    title = core.result_title(server_config, None, force, pc_numbers)
+    if pc_numbers is None:
+        pc_numbers = range(1, server_config['computers_count'] + 1)
+    concurrency = max(1, min(core.MASS_UPDATE_CONCURRENCY, core.SSH_MAX_CHANNELS_PER_HOST))
+    title += f"Параллельно: до {concurrency} ПК одновременно\n\n"
+    stream = (await AsyncStreamingStatusMessage(chat_id, title, message_id=message_id, reply_markup=reply_markup).start()
+              if core.STREAM_OUTPUT else None)
+    started = time.monotonic()
+    limit = asyncio.Semaphore(concurrency)
+    results = {}
+    
+    async def update_one(pc_number):
+        async with limit:
+            result = await run_pc_update(server_config, pc_number, force, cancel)
+        results[pc_number] = result
+        if stream:
+            stream.feed(core.format_mass_progress(result))
+            await stream.tick()
+    
+    await asyncio.gather(*(update_one(pc_number) for pc_number in pc_numbers))
+    
+    if stream:
+        await stream.finish(core.mass_exit_status(results) == 0, cancel.reason if cancel is not None else None)
+    elapsed = time.monotonic() - started
+    for recipient in core.result_chats(job, chat_id):
+        await asyncio.to_thread(core.send_mass_summary, recipient, server_config, results, elapsed)
+    return results
+
+
+async def notify_chats(chat_ids, text):
+    for chat_id in chat_ids:
+        await outbox.send_message(chat_id, text, parse_mode='Markdown')
+
+
+async def supersede_update(job, new_job):
+    """Отменяет обычное обновление, замененное принудительным, и сообщает об этом его подписчикам"""
+    core.update_dedup.inc(server=job.server_id, kind='superseded')
+    cancelled = job_scheduler.cancel(job.id)
+    text = core.superseded_message_text(job, new_job)
+    if cancelled is not None and cancelled.status == 'cancelled' and job.message_id:
+        await outbox.edit_message_text(text, job.chat_id, job.message_id, parse_mode='Markdown')
+    await notify_chats([chat_id for chat_id in new_job.subscribers if chat_id != new_job.chat_id], text)
+
+
+async def submit_update_job(chat_id, server_id, pc_number=None, force=False, user_id=None, job_id=None, pc_numbers=None):
+    """Ставит обновление в очередь сервера и сообщает пользователю номер задачи и позицию"""
+    if pc_numbers and len(pc_numbers) == 1:
+        pc_number, pc_numbers = pc_numbers[0], None
+    server_config = core.SERVERS_CONFIG[server_id]
+    description = core.describe_update(pc_number, force, pc_numbers)
+    ahead = 0
+    # Future отправки сообщения о задаче (см. core.post_job_message)
+    sent = Future()
+    
+    def submit():
+        nonlocal job_id, ahead
+        if job_id is None and core.job_store is not None:
+            job_id = core.job_store.add(server_id, pc_number, force, user_id, chat_id, description, pc_numbers)
+        job, ahead = job_scheduler.submit(server_id, description, job_func,
+                                          chat_id=chat_id, user_id=user_id, job_id=job_id)
+        return job
+    
+    async def job_func(job):
+        job.cancel_token.set_timeout(core.UPDATE_TIMEOUT_PC if pc_number else core.UPDATE_TIMEOUT_ALL)
+        if not core.STREAM_OUTPUT:
+            core.show_job_running(job, server_config, sent)
+        return await run_update(chat_id, server_id, pc_number, force, sent, pc_numbers, job)
+    
+    job, attached, superseded = core.claim_update(core.update_key(server_id, pc_number, force, pc_numbers), chat_id, submit)
+    if attached:
+        core.update_dedup.inc(server=server_id, kind='attached')
+        logger.info(f"Повторный запрос {server_id}: {description} присоединен к задаче #{job.id}")
+        await outbox.send_message(chat_id, core.attached_message_text(job, server_config), parse_mode='Markdown')
+        return job
+    if superseded is not None:
+        await supersede_update(superseded, job)
+    core.post_job_message(job, server_config, ahead, sent)
+    return job
+
+
+async def recover_jobs():
+    """Заново ставит в очередь задачи, прерванные перезапуском бота"""
+    for row in core.interrupted_jobs():
+        logger.info(f"Задача #{row['id']} прервана перезапуском, повторная постановка в очередь")
+        try:
+            await outbox.send_message(row['chat_id'], f"♻️ **Задача #{row['id']}** была прервана перезапуском бота "
+                                                      f"и поставлена в очередь заново", parse_mode='Markdown')
+        except Exception as e:
+            logger.error(f"Не удалось сообщить о перезапуске задачи #{row['id']}: {e}")
+        await submit_update_job(row['chat_id'], row['server_id'], row['pc_number'], bool(row['force']),
+                                row['user_id'], job_id=row['id'], pc_numbers=core.stored_pc_numbers(row))
+
+
+# Проверка доступности серверов
+async def probe_server(server_config):
+    """Проверяет сервер с коротким дедлайном и возвращает время подключения и отклика"""
+    try:
+        connect_time, rtt = await ssh_probe(server_config, core.STATUS_PROBE_TIMEOUT)
+        return {'online': True, 'connect_time': connect_time, 'rtt': rtt}
+    except Exception as e:
+        logger.warning(f"Сервер {server_config['name']} недоступен: {e}")
+        return {'online': False, 'error': 'таймаут' if isinstance(e, asyncio.TimeoutError) else 'нет соединения'}
+
+
+async def poll_health():
+    """Фоновая проверка серверов; результаты попадают в общий кэш core.health_poller"""
+    while True:
+        started = time.monotonic()
+        servers = dict(core.SERVERS_CONFIG)
+        results = await asyncio.gather(*(probe_server(config) for config in servers.values()))
+        for server_id, result in zip(servers, results):
+            core.health_poller.record(server_id, result)
+        await asyncio.sleep(max(0, core.HEALTH_POLL_INTERVAL - (time.monotonic() - started)))
+
+
+async def warm_up_server(server_config):
+    try:
+        connect_time, rtt = await ssh_probe(server_config, core.SSH_CONNECT_TIMEOUT)
+    except Exception as e:
+        return core.warmup_result(server_config, None, None, e)
+    return core.warmup_result(server_config, connect_time, rtt)
+
+
+async def background_checks():
+    """Прогрев соединений со всеми серверами при запуске, затем периодическая проверка"""
+    if core.SSH_WARMUP:
+        started = time.monotonic()
+        servers = dict(core.SERVERS_CONFIG)
+        results = await asyncio.gather(*(warm_up_server(config) for config in servers.values()))
+        statuses = [core.health_poller.record(server_id, result) for server_id, result in zip(servers, results)]
+        core.warmup_finished(statuses, time.monotonic() - started)
+    if core.HEALTH_POLL_INTERVAL > 0:
+        await poll_health()
+
+
+# Проверка доступа
+def access_check_message(func):
+    async def wrapper(message):
+        if not core.check_access(message.from_user.id):
+            await outbox.reply_to(message, core.ACCESS_DENIED_TEXT.format(user_id=message.from_user.id))
+            return
+        try:
+            return await func(message)
+        finally:
+            core.mark_first_response()
+    return wrapper
+
+
+def access_check_callback(func):
+    async def wrapper(call):
+        if not core.check_access(call.from_user.id):
+            await outbox.answer_callback_query(call.id, "❌ Доступ запрещен", show_alert=True)
+            return
+        try:
+            return await func(call)
+        finally:
+            core.mark_first_response()
+    return wrapper
+
+
+# Меню
+async def send_or_edit(chat_id, text, markup=None, edit_message_id=None):
+    """Отправляет или редактирует сообщение, возвращает его message_id"""
+    if edit_message_id:
+        await outbox.edit_message_text(text, chat_id, edit_message_id, reply_markup=markup, parse_mode='Markdown')
+        return edit_message_id
+    return (await outbox.send_message(chat_id, text, reply_markup=markup, parse_mode='Markdown')).message_id
+
+
+async def send_servers_menu(chat_id, page=0, edit_message_id=None):
+    available_servers = core.get_available_servers(chat_id)
+    if not available_servers:
+        await send_or_edit(chat_id, core.NO_SERVERS_TEXT, edit_message_id=edit_message_id)
+        return
+    text, markup = core.get_servers_menu(available_servers, page)
+    await send_or_edit(chat_id, text, markup, edit_message_id)
+
+
+async def send_computers_menu(chat_id, server_id, page=0, edit_message_id=None):
+    if not core.check_server_access(chat_id, server_id):
+        await send_or_edit(chat_id, core.SERVER_ACCESS_DENIED_TEXT, edit_message_id=edit_message_id)
+        return
+    states = core.pc_probe.get(server_id, page) if core.pc_probe.enabled else None
+    checking = core.pc_probe.enabled and states is None
+    text, markup = core.get_computers_menu(server_id, page, states, checking, core.get_selection(chat_id, server_id))
+    message_id = await send_or_edit(chat_id, text, markup, edit_message_id)
+    
+    if checking:
+        view = pending_probe_views[(chat_id, message_id)] = object()
+        asyncio.create_task(show_pc_states(chat_id, message_id, view, server_id, page))
+
+
+# Проверки состояния ПК по страницам (server_id, page) и сообщения, ожидающие их результата
+pc_probe_tasks = {}
+pending_probe_views = {}
+
+
+async def probe_pc_states(server_id, page):
+    """Одна проверка страницы за раз: одновременные запросы ждут общую задачу"""
+    server_config = core.SERVERS_CONFIG[server_id]
+    pcs = core.page_computers(server_config, page)
+    try:
+        with core.ssh_seconds.time(server=server_id, operation='pc_probe'):
+            output = await ssh_execute(server_config, core.pc_probe.command(pcs), core.PC_PROBE_TIMEOUT)
+        states = core.pc_probe.parse(output, pcs)
+        core.pc_probe.store(server_id, page, states)
+        return states
+    except Exception as e:
+        logger.warning(f"Не удалось проверить состояние ПК на {server_config['name']}: {e}")
+        return None
+    finally:
+        pc_probe_tasks.pop((server_id, page), None)
+
+
+async def show_pc_states(chat_id, message_id, view, server_id, page):
+    task = pc_probe_tasks.get((server_id, page))
+    if task is None:
+        task = pc_probe_tasks[(server_id, page)] = asyncio.create_task(probe_pc_states(server_id, page))
+    states = await asyncio.shield(task)
+    if pending_probe_views.get((chat_id, message_id)) is not view:
+        return
+    del pending_probe_views[(chat_id, message_id)]
+    text, markup = core.get_computers_menu(server_id, page, states, selected=core.get_selection(chat_id, server_id))
+    try:
+        await outbox.edit_message_text(text, chat_id, message_id, reply_markup=markup, parse_mode='Markdown')
+    except Exception as e:
+        logger.error(f"Ошибка обновления меню после проверки ПК: {e}")
+
+
+# Обработчики сообщений
+@bot.message_handler(commands=['start', 'help'])
+@access_check_message
+async def send_welcome(message):
+    print(f"👤 Пользователь {message.from_user.id} ({message.from_user.first_name}) запустил бота")
+    text, markup = core.build_welcome(message.from_user.id)
+    await outbox.send_message(message.chat.id, text, reply_markup=markup, parse_mode='Markdown')
+
+
+@bot.message_handler(commands=['myid'])
+async def show_my_id(message):
+    await outbox.reply_to(message, core.build_my_id(message.from_user.id), parse_mode='Markdown')
+
+
+@bot.message_handler(commands=['jobs'])
+@access_check_message
+async def show_jobs(message):
+    running, queued = job_scheduler.snapshot()
+    await outbox.send_message(message.chat.id, core.build_jobs_text(message.from_user.id, running, queued), parse_mode='Markdown')
+
+
+@bot.message_handler(commands=['stats'])
+@access_check_message
+async def show_stats(message):
+    if not core.is_admin(message.from_user.id):
+        await outbox.reply_to(message, "❌ Команда доступна только администраторам")
+        return
+    for part in core.split_output(core.build_stats_text(), core.RESULT_MESSAGE_LIMIT):
+        await outbox.send_message(message.chat.id, part, parse_mode='Markdown')
+
+
+@bot.message_handler(commands=['history'])
+@access_check_message
+async def show_history(message):
+    await outbox.send_message(message.chat.id, core.build_history_text(message.from_user.id, message.text), parse_mode='Markdown')
+
+
+@bot.message_handler(commands=['update'])
+@access_check_message
+async def update_from_command(message):
+    try:
+        server_id, pc_numbers, force = core.parse_update_args(message.from_user.id, message.text)
+    except ValueError as e:
+        await outbox.send_message(message.chat.id, str(e), parse_mode='Markdown')
+        return
+    await submit_update_job(message.chat.id, server_id, force=force, user_id=message.from_user.id, pc_numbers=pc_numbers)
+
+
+@bot.message_handler(func=lambda message: message.text == '🔄 Обновить датасеты')
+@access_check_message
+async def show_servers_menu(message):
+    server_id, page = core.last_menu(message.chat.id)
+    if server_id is not None:
+        await send_computers_menu(message.chat.id, server_id, page)
+    else:
+        await send_servers_menu(message.chat.id, page)
+
+
+@bot.message_handler(func=lambda message: message.text == '📊 Статус всех серверов')
+@access_check_message
+async def show_global_status(message):
+    available_servers = core.get_available_servers(message.from_user.id)
+    if not available_servers:
+        await outbox.send_message(message.chat.id, "📊 **Статус всех серверов**\n\n❌ Нет доступных серверов", parse_mode='Markdown')
+        return
+    
+    # Сначала берем статусы из кэша фоновой проверки
+    results = {}
+    for server_id in available_servers:
+        status = core.health_poller.get(server_id)
+        if status is not None:
+            results[server_id] = status
+    
+    status_message = await outbox.send_message(
+        message.chat.id, core.render_global_status(available_servers, results), parse_mode='Markdown')
+    missing = {server_id: config for server_id, config in available_servers.items() if server_id not in results}
+    if not missing:
+        return
+    
+    # Серверы без свежего статуса проверяем одновременно и показываем результаты по мере поступления
+    async def probe(server_id, config):
+        return server_id, await probe_server(config)
+    
+    last_edit = time.monotonic()
+    for future in asyncio.as_completed([probe(server_id, config) for server_id, config in missing.items()]):
+        server_id, result = await future
+        results[server_id] = core.health_poller.record(server_id, result)
+        if len(results) < len(available_servers) and time.monotonic() - last_edit >= 1:
+            last_edit = time.monotonic()
+            await outbox.edit_message_text(core.render_global_status(available_servers, results),
+                                           message.chat.id, status_message.message_id, parse_mode='Markdown')
+    
+    await outbox.edit_message_text(core.render_global_status(available_servers, results),
+                                   message.chat.id, status_message.message_id, parse_mode='Markdown')
+
+
+@bot.message_handler(func=lambda message: message.text == '❓ Помощь')
+@access_check_message
+async def show_help(message):
+    await outbox.send_message(message.chat.id, core.build_help_text(message.from_user.id), parse_mode='Markdown')
+
+
+# Обработчики callback'ов: та же таблица действий, что и в bot.py
+callback_handlers = {}
+
+
+def callback_route(*actions):
+    """Регистрирует асинхронный обработчик для одного или нескольких действий callback"""
+    def decorator(func):
+        for action in actions:
+            callback_handlers[action] = func
+        return func
+    return decorator
+
+
+@bot.callback_query_handler(func=lambda call: True)
+@access_check_callback
+async def handle_callback(call):
+    pending_probe_views.pop((call.message.chat.id, call.message.message_id), None)
+    action = core.callback_codec.decode(call.data)
+    if action is None or action.action not in callback_handlers:
+        await outbox.answer_callback_query(call.id, "❌ Кнопка устарела")
+        return
+    
+    if 'server' in action_fields(action.action):
+        if action.server_id is None:
+            await outbox.answer_callback_query(call.id, "❌ Сервер не найден")
+            return
+        if not core.check_server_access(call.from_user.id, action.server_id):
+            await outbox.answer_callback_query(call.id, "❌ Доступ к этому серверу запрещен", show_alert=True)
+            return
+    
+    try:
+        with core.callback_seconds.time(action=action.action):
+            await callback_handlers[action.action](call, action)
+    except Exception as e:
+        logger.error(f"Ошибка обработки callback: {e}")
+        await outbox.answer_callback_query(call.id, "❌ Произошла ошибка")
+
+
+@callback_route('select_server', 'back_to_computers')
+async def on_select_server(call, action):
+    core.session_store.update(call.message.chat.id, current_server=action.server_id, computers_page=0)
+    await send_computers_menu(call.message.chat.id, action.server_id, 0, call.message.message_id)
+
+
+@callback_route('servers_page')
+async def on_servers_page(call, action):
+    core.session_store.update(call.message.chat.id, servers_page=action.page)
+    await send_servers_menu(call.message.chat.id, action.page, call.message.message_id)
+
+
+@callback_route('computers_page')
+async def on_computers_page(call, action):
+    core.session_store.update(call.message.chat.id, current_server=action.server_id, computers_page=action.page)
+    await send_computers_menu(call.message.chat.id, action.server_id, action.page, call.message.message_id)
+
+
+@callback_route('select_pc')
+async def on_select_pc(call, action):
+    await outbox.answer_callback_query(call.id, f"Выбран PC-{action.pc_number}")
+    text, markup = core.build_update_mode_menu(action.server_id, action.pc_number)
+    await send_or_edit(call.message.chat.id, text, markup, call.message.message_id)
+
+
+@callback_route('back_to_mode')
+async def on_back_to_mode(call, action):
+    text, markup = core.build_update_mode_menu(action.server_id, action.pc_number)
+    await send_or_edit(call.message.chat.id, text, markup, call.message.message_id)
+
+
+@callback_route('update_normal', 'force_update')
+async def on_update_pc(call, action):
+    force = action.action == 'force_update'
+    ip_address = core.number_to_ip(core.SERVERS_CONFIG[action.server_id], action.pc_number)
+    mode = 'принудительного' if force else 'обычного'
+    await outbox.answer_callback_query(call.id, f"Запуск {mode} обновления PC-{action.pc_number} ({ip_address})...")
+    await submit_update_job(call.message.chat.id, action.server_id, action.pc_number, force=force, user_id=call.from_user.id)
+
+
+@callback_route('update_force_confirm')
+async def on_update_force_confirm(call, action):
+    text, markup = core.build_force_confirmation(action.server_id, action.pc_number)
+    await send_or_edit(call.message.chat.id, text, markup, call.message.message_id)
+
+
+@callback_route('update_server')
+async def on_update_server(call, action):
+    server_config = core.SERVERS_CONFIG[action.server_id]
+    await outbox.answer_callback_query(call.id, f"Массовое обновление на {server_config['name']}...")
+    await submit_update_job(call.message.chat.id, action.server_id, user_id=call.from_user.id)
+
+
+@callback_route('multi_select')
+async def on_multi_select(call, action):
+    chat_id = call.message.chat.id
+    if core.get_selection(chat_id, action.server_id) is None:
+        core.session_store.update(chat_id, selection_server=action.server_id, selected_pcs=[])
+    else:
+        core.clear_selection(chat_id)
+    await send_computers_menu(chat_id, action.server_id, core.current_computers_page(chat_id, action.server_id),
+                              call.message.message_id)
+
+
+@callback_route('toggle_pc')
+async def on_toggle_pc(call, action):
+    chat_id = call.message.chat.id
+    selected = core.toggle_selection(chat_id, action.server_id, action.pc_number)
+    await outbox.answer_callback_query(call.id, f"Выбрано ПК: {len(selected)}")
+    await send_computers_menu(chat_id, action.server_id, core.current_computers_page(chat_id, action.server_id),
+                              call.message.message_id)
+
+
+@callback_route('selected_force_confirm')
+async def on_selected_force_confirm(call, action):
+    selected = core.get_selection(call.message.chat.id, action.server_id)
+    if not selected:
+        await outbox.answer_callback_query(call.id, "Не выбрано ни одного ПК")
+        return
+    text, markup = core.build_selected_force_confirmation(action.server_id, sorted(selected))
+    await send_or_edit(call.message.chat.id, text, markup, call.message.message_id)
+
+
+@callback_route('update_selected', 'force_selected')
+async def on_update_selected(call, action):
+    chat_id = call.message.chat.id
+    force = action.action == 'force_selected'
+    selected = core.get_selection(chat_id, action.server_id)
+    if not selected:
+        await outbox.answer_callback_query(call.id, "Не выбрано ни одного ПК")
+        return
+    await outbox.answer_callback_query(call.id, f"Запуск {'принудительного' if force else 'обычного'} обновления {len(selected)} ПК...")
+    core.clear_selection(chat_id)
+    await submit_update_job(chat_id, action.server_id, force=force, user_id=call.from_user.id, pc_numbers=sorted(selected))
+    await send_computers_menu(chat_id, action.server_id, core.current_computers_page(chat_id, action.server_id),
+                              call.message.message_id)
+
+
+@callback_route('cancel_job')
+async def on_cancel_job(call, action):
+    job = job_scheduler.find(action.job_id)
+    if job is None or job.server_id != action.server_id:
+        await outbox.answer_callback_query(call.id, "Задача уже завершена")
+        return
+    if job.user_id not in (None, call.from_user.id) and not core.is_admin(call.from_user.id):
+        await outbox.answer_callback_query(call.id, "❌ Отменить задачу может только ее автор или администратор", show_alert=True)
+        return
+    job = job_scheduler.cancel(job.id)
+    if job is None:
+        await outbox.answer_callback_query(call.id, "Задача уже завершена")
+    elif job.status == 'cancelled':
+        await outbox.answer_callback_query(call.id, f"Задача #{job.id} отменена")
+        text = core.job_message_text(job, core.SERVERS_CONFIG[job.server_id])
+        await outbox.edit_message_text(text, call.message.chat.id, call.message.message_id, parse_mode='Markdown')
+        await notify_chats([chat_id for chat_id in core.close_subscription(job) if chat_id != call.message.chat.id], text)
+    else:
+        await outbox.answer_callback_query(call.id, f"Останавливаем задачу #{job.id}...")
+
+
+@callback_route('back_to_servers')
+async def on_back_to_servers(call, action):
+    core.session_store.update(call.message.chat.id, current_server=None)
+    _, page = core.last_menu(call.message.chat.id)
+    await send_servers_menu(call.message.chat.id, page, call.message.message_id)
+
+
+@callback_route('current_page')
+async def on_current_page(call, action):
+    await outbox.answer_callback_query(call.id)
+
+
+async def run():
+    global job_scheduler
+    job_scheduler = AsyncJobScheduler(workers=core.JOB_WORKERS, per_server_limit=core.JOB_PER_SERVER_LIMIT,
+                                      on_finish=core.record_job_finish)
+    # Метрики и /stats читают очередь задач через core.job_scheduler
+    core.job_scheduler = job_scheduler
+    await recover_jobs()
+    health_task = asyncio.create_task(background_checks())
+    webhook_server = None
+    try:
+        if core.BOT_MODE == 'webhook':
+            loop = asyncio.get_running_loop()
+            
+            # Рабочие потоки вебхука передают обновления в цикл событий и ждут их обработки
+            def handle_update(update):
+                asyncio.run_coroutine_threadsafe(
+                    bot.process_new_updates([types.Update.de_json(update)]), loop).result()
+            
+            webhook_server = core.start_webhook(handle_update)
+            core.mark_startup('ready')
+            await asyncio.Event().wait()
+        else:
+            # Вебхук, оставшийся от запуска в режиме webhook, не дал бы получать обновления (409 Conflict)
+            await bot.remove_webhook()
+            core.mark_startup('ready')
+            await bot.infinity_polling()
+    finally:
+        if webhook_server is not None:
+            webhook_server.stop()
+        if health_task is not None:
+            health_task.cancel()
+        await ssh_pool.close()
+        await bot.close_session()
+
+
+def main():
+    """Запуск асинхронной среды (вызывается из bot.py при BOT_RUNTIME=async)"""
+    asyncio.run(run())
@@ -0,0 +1,137 @@
+"""Микробенчмарк разбора callback_data: прежняя двойная цепочка startswith/split против CallbackCodec.
+
+Запуск из корня репозитория:
+    python benchmarks/callback_bench.py
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from callbacks import CallbackCodec  # noqa: E402
+
+SERVER_IDS = [f'server_{i}' for i in range(1, 11)]
+
+
+def legacy_server_id(data):
+    """Извлечение server_id так, как это делал декоратор server_access_check_callback"""
+    server_id = None
+    if data.startswith('select_server:'):
+        server_id = data.replace('select_server:', '', 1)
+    elif data.startswith('computers_page:'):
+        parts = data.replace('computers_page:', '', 1).split(':')
+        if len(parts) == 2:
+            server_id = parts[0]
+    elif data.startswith('select_pc:'):
+        parts = data.replace('select_pc:', '', 1).split(':')
+        if len(parts) == 2:
+            server_id = parts[0]
+    elif data.startswith('update_normal:'):
+        parts = data.replace('update_normal:', '', 1).split(':')
+        if len(parts) == 2:
+            server_id = parts[0]
+    elif data.startswith('update_force_confirm:'):
+        parts = data.replace('update_force_confirm:', '', 1).split(':')
+        if len(parts) == 2:
+            server_id = parts[0]
+    elif data.startswith('force_update:'):
+        parts = data.replace('force_update:', '', 1).split(':')
+        if len(parts) == 2:
+            server_id = parts[0]
+    elif data.startswith('back_to_mode:'):
+        parts = data.replace('back_to_mode:', '', 1).split(':')
+        if len(parts) == 2:
+            server_id = parts[0]
+    elif data.startswith('back_to_computers:'):
+        server_id = data.replace('back_to_computers:', '', 1)
+    elif data.startswith('update_server:'):
+        server_id = data.replace('update_server:', '', 1)
+    return server_id
+
+
+def legacy_dispatch(data, servers):
+    """Повторный разбор в цепочке if/elif прежнего handle_callback (без побочных эффектов)"""
+    if data.startswith('select_server:'):
+        server_id = data.replace('select_server:', '', 1)
+        return ('select_server', server_id in servers and server_id)
+    elif data.startswith('servers_page:'):
+        return ('servers_page', int(data.replace('servers_page:', '', 1)))
+    elif data.startswith('computers_page:'):
+        parts = data.replace('computers_page:', '', 1).split(':')
+        if len(parts) == 2:
+            return ('computers_page', parts[0] in servers and parts[0], int(parts[1]))
+    elif data.startswith('select_pc:'):
+        parts = data.replace('select_pc:', '', 1).split(':')
+        if len(parts) == 2:
+            return ('select_pc', parts[0] in servers and parts[0], parts[1])
+    elif data.startswith('update_normal:'):
+        parts = data.replace('update_normal:', '', 1).split(':')
+        if len(parts) == 2:
+            return ('update_normal', parts[0] in servers and parts[0], parts[1])
+    elif data.startswith('update_force_confirm:'):
+        parts = data.replace('update_force_confirm:', '', 1).split(':')
+        if len(parts) == 2:
+            return ('update_force_confirm', parts[0] in servers and parts[0], parts[1])
+    elif data.startswith('force_update:'):
+        parts = data.replace('force_update:', '', 1).split(':')
+        if len(parts) == 2:
+            return ('force_update', parts[0] in servers and parts[0], parts[1])
+    elif data.startswith('back_to_mode:'):
+        parts = data.replace('back_to_mode:', '', 1).split(':')
+        if len(parts) == 2:
+            return ('back_to_mode', parts[0] in servers and parts[0], parts[1])
+    elif data.startswith('back_to_computers:'):
+        server_id = data.replace('back_to_computers:', '', 1)
+        return ('back_to_computers', server_id in servers and server_id)
+    elif data.startswith('update_server:'):
+        server_id = data.replace('update_server:', '', 1)
+        return ('update_server', server_id in servers and server_id)
+    elif data == 'back_to_servers':
+        return ('back_to_servers',)
+    elif data == 'current_page':
+        return ('current_page',)
+
+
+def legacy_callback(data, servers):
+    legacy_server_id(data)
+    return legacy_dispatch(data, servers)
+
+
+def main():
+    codec = CallbackCodec(SERVER_IDS)
+    servers = set(SERVER_IDS)
+    
+    # Смесь реальных нажатий: больше всего пагинации и выбора ПК
+    calls = [
+        ('computers_page', 'server_3', None, 2),
+        ('select_pc', 'server_3', 17, None),
+        ('update_normal', 'server_3', 17, None),
+        ('force_update', 'server_7', 4, None),
+        ('back_to_computers', 'server_7', None, None),
+        ('servers_page', None, None, 1),
+        ('current_page', None, None, None),
+        ('update_server', 'server_10', None, None),
+    ]
+    legacy_payloads = []
+    for action, server_id, pc_number, page in calls:
+        fields = [str(value) for value in (server_id, pc_number, page) if value is not None]
+        legacy_payloads.append(':'.join([action] + fields))
+    new_payloads = [codec.encode(action, server_id, pc_number, page) for action, server_id, pc_number, page in calls]
+    
+    rounds = 20000
+    legacy_time = min(timeit.repeat(lambda: [legacy_callback(data, servers) for data in legacy_payloads],
+                                    number=rounds, repeat=5))
+    new_time = min(timeit.repeat(lambda: [codec.decode(data) for data in new_payloads],
+                                 number=rounds, repeat=5))
+    
+    per_call = rounds * len(calls)
+    print(f"Прежний разбор (декоратор + if/elif): {legacy_time / per_call * 1e9:8.0f} нс/callback")
+    print(f"CallbackCodec.decode:                 {new_time / per_call * 1e9:8.0f} нс/callback")
+    print(f"Ускорение: x{legacy_time / new_time:.2f}")
+    print(f"Максимальная длина callback_data: {max(len(data.encode()) for data in new_payloads)} байт "
+          f"(прежний формат: {max(len(data.encode()) for data in legacy_payloads)} байт)")
+
+
+if __name__ == '__main__':
+    main()
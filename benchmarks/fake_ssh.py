@@ -0,0 +1,172 @@
+"""Локальный SSH сервер на paramiko, имитирующий fre.sh на TrueNAS.
+
+Принимает любой пароль, на каждую команду `sudo bash ./fre.sh [--force] <ip>` или `--all`
+выдает построчный вывод заданного объема в течение заданного времени и завершается
+с кодом 1 с вероятностью failure_rate. Команда `echo ...` (проверка статуса) отвечает сразу.
+
+Отдельный запуск:
+    python benchmarks/fake_ssh.py --port 2222 --runtime 2 --output-bytes 20000 --failure-rate 0.1
+"""
+import argparse
+import random
+import re
+import socket
+import threading
+import time
+
+import paramiko
+
+# Ключ хоста генерируется один раз на процесс
+_HOST_KEY = None
+_HOST_KEY_LOCK = threading.Lock()
+
+
+def host_key():
+    global _HOST_KEY
+    with _HOST_KEY_LOCK:
+        if _HOST_KEY is None:
+            _HOST_KEY = paramiko.RSAKey.generate(2048)
+        return _HOST_KEY
+
+
+class _Interface(paramiko.ServerInterface):
+    def __init__(self, server):
+        self.server = server
+    
+    def get_allowed_auths(self, username):
+        return 'password,publickey'
+    
+    def check_auth_password(self, username, password):
+        return paramiko.AUTH_SUCCESSFUL
+    
+    def check_auth_publickey(self, username, key):
+        return paramiko.AUTH_SUCCESSFUL
+    
+    def check_channel_request(self, kind, chanid):
+        return paramiko.OPEN_SUCCEEDED if kind == 'session' else paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+    
+    def check_channel_exec_request(self, channel, command):
+        threading.Thread(target=self.server.execute, args=(channel, command.decode('utf-8', 'replace')),
+                         daemon=True).start()
+        return True
+
+
+# Имитация сервера TrueNAS с fre.sh
+class FakeSSHServer:
+    """runtime - время выполнения fre.sh для одного ПК (секунды, ±jitter доля),
+    output_bytes - объем вывода на один ПК, failure_rate - доля запусков с кодом возврата 1,
+    computers - сколько ПК обходит `fre.sh --all`"""
+    
+    def __init__(self, host='127.0.0.1', port=0, runtime=1.0, output_bytes=4096, failure_rate=0.0,
+                 jitter=0.2, computers=10, seed=None):
+        self.host = host
+        self.port = port
+        self.runtime = runtime
+        self.output_bytes = output_bytes
+        self.failure_rate = failure_rate
+        self.jitter = jitter
+        self.computers = computers
+        self.random = random.Random(seed)
+        self.commands = 0
+        self.connections = 0
+        self._lock = threading.Lock()
+        self._socket = None
+        self._transports = []
+        self._stopped = False
+    
+    def start(self):
+        self._socket = socket.socket()
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._socket.bind((self.host, self.port))
+        self._socket.listen(128)
+        self.port = self._socket.getsockname()[1]
+        host_key()
+        threading.Thread(target=self._accept, name='fake-ssh', daemon=True).start()
+        return self
+    
+    def stop(self):
+        self._stopped = True
+        self._socket.close()
+        for transport in self._transports:
+            transport.close()
+    
+    def _accept(self):
+        while not self._stopped:
+            try:
+                client, _ = self._socket.accept()
+            except OSError:
+                return
+            transport = paramiko.Transport(client)
+            transport.add_server_key(host_key())
+            with self._lock:
+                self.connections += 1
+                self._transports.append(transport)
+            try:
+                transport.start_server(server=_Interface(self))
+            except (paramiko.SSHException, EOFError, OSError):
+                transport.close()
+    
+    def _outcome(self):
+        with self._lock:
+            self.commands += 1
+            failed = self.random.random() < self.failure_rate
+            duration = self.runtime * (1 + self.random.uniform(-self.jitter, self.jitter))
+        return failed, max(0.0, duration)
+    
+    def _emit(self, channel, ip_address, duration):
+        """Пишет около output_bytes строк вывода равномерно в течение duration секунд"""
+        line = f"rsync {ip_address}: games/dataset.bin 42% 120.00MB/s 0:00:03\n".encode()
+        lines = max(1, self.output_bytes // len(line))
+        batches = max(1, min(lines, int(duration * 10)))
+        per_batch = lines // batches
+        for batch in range(batches):
+            count = per_batch + (lines - per_batch * batches if batch == batches - 1 else 0)
+            channel.sendall(line * count)
+            time.sleep(duration / batches)
+    
+    def execute(self, channel, command):
+        try:
+            if command.startswith('echo'):
+                channel.sendall(command[5:].strip("'\"").encode() + b"\n")
+                channel.send_exit_status(0)
+                return
+            
+            targets = re.findall(r'\d+\.\d+\.\d+\.\d+', command)
+            if '--all' in command:
+                targets = [f"pc-{number}" for number in range(1, self.computers + 1)]
+            failed = False
+            for ip_address in targets or ['?']:
+                pc_failed, duration = self._outcome()
+                channel.sendall(f"Updating {ip_address} force={int('--force' in command)}\n".encode())
+                self._emit(channel, ip_address, duration)
+                if pc_failed:
+                    channel.sendall_stderr(f"rsync error on {ip_address}: connection reset\n".encode())
+                failed = failed or pc_failed
+            channel.send_exit_status(1 if failed else 0)
+        except (OSError, EOFError, paramiko.SSHException):
+            pass
+        finally:
+            channel.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Локальный SSH сервер, имитирующий fre.sh")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=2222)
+    parser.add_argument('--runtime', type=float, default=1.0, help="время обновления одного ПК, секунды")
+    parser.add_argument('--output-bytes', type=int, default=4096, help="объем вывода на один ПК")
+    parser.add_argument('--failure-rate', type=float, default=0.0, help="доля неудачных обновлений (0..1)")
+    parser.add_argument('--computers', type=int, default=10, help="сколько ПК обходит fre.sh --all")
+    args = parser.parse_args()
+    
+    server = FakeSSHServer(args.host, args.port, args.runtime, args.output_bytes, args.failure_rate,
+                           computers=args.computers).start()
+    print(f"Фейковый SSH сервер слушает {server.host}:{server.port}", flush=True)
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,142 @@
+"""Локальный HTTP сервер, отвечающий как Telegram Bot API.
+
+Понимает любые методы по пути /bot<token>/<method>: sendMessage и sendDocument возвращают
+сообщение с новым message_id, editMessageText - отредактированное сообщение, остальные - true.
+Можно добавить задержку ответа и долю ответов 429 (Too Many Requests).
+
+Подключение бота (до первого запроса):
+    telebot.apihelper.API_URL = server.api_url
+
+Отдельный запуск:
+    python benchmarks/fake_telegram.py --port 8081 --latency 0.05 --flood-rate 0.01
+"""
+import argparse
+import itertools
+import json
+import random
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+
+# Имитация Bot API
+class FakeTelegramServer:
+    """latency - задержка каждого ответа (секунды), flood_rate - доля ответов 429 с retry_after"""
+    
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, flood_rate=0.0, retry_after=1, seed=None):
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.flood_rate = flood_rate
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.calls = Counter()
+        self.flooded = 0
+        self._message_ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._httpd = None
+    
+    @property
+    def api_url(self):
+        return f"http://{self.host}:{self.port}/bot{{0}}/{{1}}"
+    
+    def _make_handler(self):
+        server = self
+        
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length', 0))
+                body = self.rfile.read(length) if length else b''
+                # telebot передает параметры в строке запроса, файлы - в multipart теле
+                url = urlsplit(self.path)
+                status, payload = server.respond(url.path.rsplit('/', 1)[-1], url.query,
+                                                 self.headers.get('Content-Type', ''), body)
+                data = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+            
+            do_GET = do_POST
+            
+            def log_message(self, format, *args):
+                pass
+        
+        return Handler
+    
+    @staticmethod
+    def _params(query, content_type, body):
+        """Параметры из строки запроса и из тела form-urlencoded или JSON (содержимое файлов не разбирается)"""
+        params = {key: values[0] for key, values in parse_qs(query).items()}
+        if content_type.startswith('application/x-www-form-urlencoded'):
+            params.update({key: values[0] for key, values in parse_qs(body.decode('utf-8', 'replace')).items()})
+        elif content_type.startswith('application/json'):
+            params.update(json.loads(body or b'{}'))
+        return params
+    
+    def respond(self, method, query, content_type, body):
+        if self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            self.calls[method] += 1
+            flooded = self.random.random() < self.flood_rate
+            if flooded:
+                self.flooded += 1
+        if flooded:
+            return 429, {'ok': False, 'error_code': 429,
+                         'description': f"Too Many Requests: retry after {self.retry_after}",
+                         'parameters': {'retry_after': self.retry_after}}
+        
+        params = self._params(query, content_type, body)
+        chat_id = int(params.get('chat_id') or 0)
+        if method in ('sendMessage', 'sendDocument'):
+            return 200, {'ok': True, 'result': self._message(next(self._message_ids), chat_id, params.get('text', ''))}
+        if method == 'editMessageText':
+            return 200, {'ok': True, 'result': self._message(int(params.get('message_id') or 0), chat_id,
+                                                             params.get('text', ''))}
+        if method == 'getMe':
+            return 200, {'ok': True, 'result': {'id': 1, 'is_bot': True, 'first_name': 'bench', 'username': 'bench_bot'}}
+        return 200, {'ok': True, 'result': True}
+    
+    @staticmethod
+    def _message(message_id, chat_id, text):
+        return {'message_id': message_id, 'date': int(time.time()), 'text': text,
+                'chat': {'id': chat_id, 'type': 'private'}}
+    
+    def start(self):
+        self._httpd = ThreadingHTTPServer((self.host, self.port), self._make_handler())
+        self._httpd.daemon_threads = True
+        self.port = self._httpd.server_port
+        threading.Thread(target=self._httpd.serve_forever, name='fake-telegram', daemon=True).start()
+        return self
+    
+    def stop(self):
+        if self._httpd is not None:
+            self._httpd.shutdown()
+            self._httpd.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Локальный сервер, отвечающий как Telegram Bot API")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--latency', type=float, default=0.0, help="задержка ответа, секунды")
+    parser.add_argument('--flood-rate', type=float, default=0.0, help="доля ответов 429 (0..1)")
+    args = parser.parse_args()
+    
+    server = FakeTelegramServer(args.host, args.port, args.latency, args.flood_rate).start()
+    print(f"Фейковый Bot API слушает {server.host}:{server.port}", flush=True)
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.stop()
+        print(f"Вызовы: {dict(server.calls)}, ответов 429: {server.flooded}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,302 @@
+"""Нагрузочный тест бота без реальных серверов TrueNAS и Telegram.
+
+Поднимает фейковый SSH сервер с fre.sh (fake_ssh.py) и фейковый Bot API (fake_telegram.py)
+в отдельных процессах, импортирует bot.py с настройками на них и запускает N администраторов,
+которые нажимают кнопки меню через handle_callback и запускают обновления: каждый ждет
+результата своего обновления и сразу начинает следующее.
+
+Выводит обновления в секунду, перцентили времени от нажатия до получения результата,
+пиковое число потоков и память, а также p50/p95/p99 из метрик бота.
+
+Запуск из корня репозитория:
+    python benchmarks/load_bench.py --admins 20 --iterations 5 --servers 4 --runtime 0.5
+    python benchmarks/load_bench.py --scenario mass --computers 20 --save baseline.json
+    python benchmarks/load_bench.py --compare baseline.json   # код 1 при регрессии
+"""
+import argparse
+import json
+import os
+import random
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест бота с фейковыми SSH и Telegram")
+    parser.add_argument('--scenario', choices=('single', 'mass', 'mixed'), default='single',
+                        help="single - обновления отдельных ПК, mass - всего сервера, mixed - вперемешку")
+    parser.add_argument('--admins', type=int, default=10, help="одновременных администраторов")
+    parser.add_argument('--iterations', type=int, default=5, help="обновлений на администратора")
+    parser.add_argument('--mass-share', type=float, default=0.2, help="доля массовых обновлений в mixed")
+    parser.add_argument('--servers', type=int, default=4)
+    parser.add_argument('--computers', type=int, default=20, help="компьютеров на сервере")
+    parser.add_argument('--runtime', type=float, default=0.5, help="время fre.sh на один ПК, секунды")
+    parser.add_argument('--output-bytes', type=int, default=8192, help="вывод fre.sh на один ПК")
+    parser.add_argument('--failure-rate', type=float, default=0.05)
+    parser.add_argument('--tg-latency', type=float, default=0.02, help="задержка ответа Bot API, секунды")
+    parser.add_argument('--tg-flood-rate', type=float, default=0.0, help="доля ответов 429")
+    parser.add_argument('--timeout', type=float, default=300, help="предельное ожидание одного обновления")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--save', help="сохранить результат в JSON")
+    parser.add_argument('--compare', help="сравнить с сохраненным результатом")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="допустимое ухудшение при сравнении (доля)")
+    return parser.parse_args()
+
+
+def start_fake(script, *args):
+    """Запускает фейковый сервер отдельным процессом и возвращает (процесс, порт)"""
+    process = subprocess.Popen([sys.executable, os.path.join(BENCH_DIR, script), '--port', '0', *map(str, args)],
+                               stdout=subprocess.PIPE, text=True)
+    line = process.stdout.readline()
+    match = re.search(r':(\d+)\s*$', line)
+    if not match:
+        process.kill()
+        raise RuntimeError(f"{script} не запустился: {line!r}")
+    return process, int(match.group(1))
+
+
+def configure_env(args, ssh_port, admin_ids, work_dir):
+    """Настройки бота: все серверы указывают на фейковый SSH, лишние фоновые задачи выключены"""
+    for i in range(1, args.servers + 1):
+        os.environ.update({
+            f'SERVER_{i}_NAME': f'Bench {i}',
+            f'SERVER_{i}_HOST': '127.0.0.1',
+            f'SERVER_{i}_PORT': str(ssh_port),
+            f'SERVER_{i}_USERNAME': 'bench',
+            f'SERVER_{i}_PASSWORD': 'bench',
+            f'SERVER_{i}_COMPUTERS_COUNT': str(args.computers),
+        })
+    os.environ.update({
+        'BOT_TOKEN': '123456:bench',
+        'ALLOWED_USER_IDS': ','.join(map(str, admin_ids)),
+        'USER_ACCESS': '',
+        'HEALTH_POLL_INTERVAL': '0',
+        'CONFIG_WATCH_INTERVAL': '0',
+        'JOB_DB_PATH': os.path.join(work_dir, 'jobs.db'),
+        # Ключ фейкового сервера не должен попасть в known_hosts рабочей копии бота
+        'SSH_KNOWN_HOSTS': os.path.join(work_dir, 'known_hosts'),
+        'JOB_RECOVER': '0',
+        'SESSION_FILE': '',
+        'METRICS_PORT': '0',
+    })
+
+
+def make_call(bot_module, user_id, data):
+    """CallbackQuery в том виде, в каком его присылает Telegram"""
+    return bot_module.types.CallbackQuery.de_json({
+        'id': str(random.getrandbits(32)),
+        'from': {'id': user_id, 'is_bot': False, 'first_name': f'admin{user_id}'},
+        'chat_instance': str(user_id),
+        'message': {'message_id': 1, 'date': int(time.time()), 'text': '',
+                    'chat': {'id': user_id, 'type': 'private'}},
+        'data': data,
+    })
+
+
+class ResourceSampler:
+    """Раз в interval секунд замеряет число потоков; пиковая память - по getrusage"""
+    
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.peak_threads = threading.active_count()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='bench-sampler', daemon=True)
+    
+    def start(self):
+        self._thread.start()
+    
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+    
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.peak_threads = max(self.peak_threads, threading.active_count())
+    
+    @staticmethod
+    def peak_rss_mb():
+        if resource is None:
+            return None
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Linux - килобайты, macOS - байты
+        return peak / 1024 / (1024 if sys.platform == 'darwin' else 1)
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))] if values else 0.0
+
+
+counts_lock = threading.Lock()
+
+
+def wait_delivered(outbox, chat_id, deadline):
+    """Результат уходит в фоне, после завершения задачи: ждет, пока очередь отправки чата опустеет"""
+    while outbox.pending(chat_id):
+        if time.perf_counter() >= deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+def run_admin(bot_module, args, admin_id, server_id, finished, latencies, counts, rng):
+    """Один администратор: меню -> выбор ПК или всего сервера -> ждет результат, и так iterations раз"""
+    codec = bot_module.callback_codec
+    done = finished[admin_id]
+    
+    def click(action, **fields):
+        bot_module.handle_callback(make_call(bot_module, admin_id, codec.encode(action, **fields)))
+    
+    for _ in range(args.iterations):
+        mass = args.scenario == 'mass' or (args.scenario == 'mixed' and rng.random() < args.mass_share)
+        done.clear()
+        started = time.perf_counter()
+        click('select_server', server_id=server_id)
+        if mass:
+            click('update_server', server_id=server_id)
+        else:
+            pc_number = rng.randint(1, args.computers)
+            click('computers_page', server_id=server_id, page=(pc_number - 1) // bot_module.COMPUTERS_PER_PAGE)
+            click('select_pc', server_id=server_id, pc_number=pc_number)
+            click('update_normal', server_id=server_id, pc_number=pc_number)
+        finished_in_time = (done.wait(args.timeout)
+                            and wait_delivered(bot_module.outbox, admin_id, started + args.timeout))
+        with counts_lock:
+            if not finished_in_time:
+                counts['timeouts'] += 1
+                continue
+            latencies.append(time.perf_counter() - started)
+            counts['mass' if mass else 'single'] += 1
+
+
+def compare(result, baseline, tolerance):
+    """Сравнивает с сохраненным результатом, возвращает список регрессий"""
+    regressions = []
+    if result['updates_per_second'] < baseline['updates_per_second'] * (1 - tolerance):
+        regressions.append(f"обновлений в секунду: {result['updates_per_second']:.2f} "
+                           f"(было {baseline['updates_per_second']:.2f})")
+    for key in ('p50', 'p95', 'p99'):
+        if result['latency'][key] > baseline['latency'][key] * (1 + tolerance):
+            regressions.append(f"задержка {key}: {result['latency'][key]:.2f}с (было {baseline['latency'][key]:.2f}с)")
+    if result['peak_threads'] > baseline['peak_threads'] * (1 + tolerance):
+        regressions.append(f"пик потоков: {result['peak_threads']} (было {baseline['peak_threads']})")
+    return regressions
+
+
+def main():
+    args = parse_args()
+    rng = random.Random(args.seed)
+    admin_ids = [100000 + i for i in range(args.admins)]
+    ssh_process, ssh_port = start_fake('fake_ssh.py', '--runtime', args.runtime, '--output-bytes', args.output_bytes,
+                                       '--failure-rate', args.failure_rate, '--computers', args.computers)
+    tg_process, tg_port = start_fake('fake_telegram.py', '--latency', args.tg_latency,
+                                     '--flood-rate', args.tg_flood_rate)
+    work_dir = tempfile.mkdtemp(prefix='bot-bench-')
+    try:
+        configure_env(args, ssh_port, admin_ids, work_dir)
+        import logging
+        import telebot
+        telebot.apihelper.API_URL = f"http://127.0.0.1:{tg_port}/bot{{0}}/{{1}}"
+        import bot as bot_module
+        bot_module.start_services()
+        logging.getLogger().setLevel(logging.WARNING)
+        
+        # Обновление считается завершенным, когда задача закончилась и ее результат отправлен
+        finished = {admin_id: threading.Event() for admin_id in admin_ids}
+        record_job_finish = bot_module.record_job_finish
+        
+        def on_job_finish(job):
+            record_job_finish(job)
+            # Одинаковые обновления выполняются одной задачей - результат получают все подписчики
+            for chat_id in job.subscribers:
+                if chat_id in finished:
+                    finished[chat_id].set()
+        
+        bot_module.record_job_finish = on_job_finish
+        
+        latencies = []
+        counts = {'single': 0, 'mass': 0, 'timeouts': 0}
+        sampler = ResourceSampler()
+        sampler.start()
+        started = time.perf_counter()
+        admins = []
+        for i, admin_id in enumerate(admin_ids):
+            server_id = f'server_{i % args.servers + 1}'
+            thread = threading.Thread(target=run_admin, name=f'bench-admin-{i + 1}',
+                                      args=(bot_module, args, admin_id, server_id, finished, latencies, counts,
+                                            random.Random(rng.random())))
+            thread.start()
+            admins.append(thread)
+        for thread in admins:
+            thread.join()
+        elapsed = time.perf_counter() - started
+        sampler.stop()
+        
+        completed = counts['single'] + counts['mass']
+        result = {
+            'scenario': args.scenario,
+            'admins': args.admins,
+            'updates': completed,
+            'single': counts['single'],
+            'mass': counts['mass'],
+            'timeouts': counts['timeouts'],
+            'elapsed': elapsed,
+            'updates_per_second': completed / elapsed if elapsed else 0.0,
+            'pc_updates_per_second': (counts['single'] + counts['mass'] * args.computers) / elapsed if elapsed else 0.0,
+            'latency': {key: percentile(latencies, q) for key, q in (('p50', 0.5), ('p95', 0.95), ('p99', 0.99))},
+            # Потоки администраторов и сэмплера бенчмарка в пик не входят
+            'peak_threads': sampler.peak_threads - len(admins) - 1,
+            'peak_rss_mb': sampler.peak_rss_mb(),
+        }
+        
+        print()
+        print(f"Сценарий {args.scenario}: {args.admins} админов x {args.iterations}, серверов {args.servers}, "
+              f"fre.sh {args.runtime}с на ПК, вывод {args.output_bytes} байт, ошибок {args.failure_rate:.0%}")
+        print(f"Обновлений: {completed} (ПК: {counts['single']}, серверов: {counts['mass']}), "
+              f"таймаутов: {counts['timeouts']}, за {elapsed:.1f}с")
+        print(f"Обновлений в секунду: {result['updates_per_second']:.2f} "
+              f"(ПК в секунду: {result['pc_updates_per_second']:.2f})")
+        print("От нажатия до результата: " + ", ".join(f"{key} {value:.2f}с" for key, value in result['latency'].items()))
+        print(f"Пик потоков бота: {result['peak_threads']}, пик памяти процесса: "
+              + (f"{result['peak_rss_mb']:.0f} МБ" if result['peak_rss_mb'] is not None else "н/д"))
+        print()
+        print(bot_module.build_stats_text().replace('**', '').replace('*', '').replace('`', ''))
+        
+        exit_code = 0
+        if args.compare:
+            with open(args.compare, encoding='utf-8') as f:
+                regressions = compare(result, json.load(f), args.tolerance)
+            print()
+            if regressions:
+                print("❌ Регрессии относительно " + args.compare + ":\n- " + "\n- ".join(regressions))
+                exit_code = 1
+            else:
+                print(f"✅ Без регрессий относительно {args.compare} (допуск {args.tolerance:.0%})")
+        if args.save:
+            with open(args.save, 'w', encoding='utf-8') as f:
+                json.dump(result, f, ensure_ascii=False, indent=2)
+        return exit_code
+    finally:
+        ssh_process.kill()
+        tg_process.kill()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    code = main()
+    # Потоки бота (планировщик, очередь отправки) не ждем
+    sys.stdout.flush()
+    os._exit(code)
@@ -1,28 +1,70 @@
+import time
+# Момент запуска процесса (до импорта остальных модулей) - от него отсчитываются этапы старта
+STARTED_AT = time.monotonic()
+
 import telebot
 from telebot import types
 import math
-import paramiko
 import os
 import logging
-from threading import Thread
-from dotenv import load_dotenv
+import threading
+from dotenv import load_dotenv, find_dotenv, dotenv_values
+import signal
+import io
+import gzip
 import tempfile
+import codecs
+import shlex
+import socket
+import hashlib
+import queue
+import re
+import sys
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED, TimeoutError as FuturesTimeoutError
+from ssh_pool import SSHConnectionPool
+from jobs import JobScheduler
+from health import HealthPoller
+from callbacks import CallbackCodec, action_fields
+from access import AccessIndex
+from webhook import WebhookServer
+from outbox import TelegramOutbox
+from capture import CommandResult
+from jobstore import JobStore
+from sessions import SessionStore
+from metrics import MetricsRegistry, MetricsServer
+from pcprobe import PCStatusProbe, PC_STATE_ICONS
+from sshkeys import KnownHosts
+from executor import ExecutorClient, ExecutorServer, ExecutorUnavailable
 
 # Загружаем переменные из .env файла
-load_dotenv()
+# Переменные окружения процесса запоминаем до загрузки .env - они имеют приоритет и при перезагрузке
+BASE_ENV = dict(os.environ)
+ENV_FILE = find_dotenv()
+load_dotenv(ENV_FILE)
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 # Загрузка списка разрешенных пользователей
-ALLOWED_USER_IDS = list(map(int, os.getenv('ALLOWED_USER_IDS', '').split(','))) if os.getenv('ALLOWED_USER_IDS') else []
+def load_allowed_user_ids(env=os.environ):
+    """Загружает белый список пользователей"""
+    return list(map(int, env.get('ALLOWED_USER_IDS', '').split(','))) if env.get('ALLOWED_USER_IDS') else []
+
+ALLOWED_USER_IDS = load_allowed_user_ids()
+
+# Загрузка списка администраторов (им доступна команда /stats)
+def load_admin_user_ids(env=os.environ):
+    """Загружает список администраторов"""
+    return list(map(int, env.get('ADMIN_USER_IDS', '').split(','))) if env.get('ADMIN_USER_IDS') else []
+
+ADMIN_USER_IDS = load_admin_user_ids()
 
 # Загрузка прав доступа пользователей к серверам
-def load_user_access():
+def load_user_access(env=os.environ):
     """Загружает права доступа пользователей к серверам"""
     user_access = {}
-    access_config = os.getenv('USER_ACCESS', '')
+    access_config = env.get('USER_ACCESS', '')
     
     if not access_config:
         return user_access
@@ -56,7 +98,7 @@ else:
     print("ℹ️  Права доступа к серверам не настроены")
 
 # Загрузка конфигурации серверов
-def load_servers_config():
+def load_servers_config(env=os.environ):
     """Загружает конфигурацию серверов из переменных окружения"""
     servers_config = {}
     i = 1
@@ -64,11 +106,11 @@ def load_servers_config():
     while True:
         # Проверяем существование сервера
         host_key = f'SERVER_{i}_HOST'
-        if not os.getenv(host_key):
+        if not env.get(host_key):
             break  # Больше серверов нет
         
         # Получаем порт, если не указан - используем 22 по умолчанию
-        port = os.getenv(f'SERVER_{i}_PORT')
+        port = env.get(f'SERVER_{i}_PORT')
         if port is not None:
             try:
                 port = int(port)
@@ -78,25 +120,30 @@ def load_servers_config():
         else:
             port = 22  # порт по умолчанию
         
-        # Получаем пароль (обязательное поле)
-        password = os.getenv(f'SERVER_{i}_PASSWORD')
-        if not password:
-            logger.error(f"Пароль не указан для сервера {i}. Сервер пропущен.")
+        # Ключ (необязательно) и пароль: нужен хотя бы один способ авторизации, пароль - запасной
+        password = env.get(f'SERVER_{i}_PASSWORD')
+        key_path = env.get(f'SERVER_{i}_KEY_PATH')
+        if not password and not key_path:
+            logger.error(f"Не указан ни пароль, ни ключ для сервера {i}. Сервер пропущен.")
             i += 1
             continue
         
         # Получаем настройки IP адресации
-        ip_base = os.getenv(f'SERVER_{i}_IP_BASE', '192.168.1.')
-        ip_start = int(os.getenv(f'SERVER_{i}_IP_START', 100))
+        ip_base = env.get(f'SERVER_{i}_IP_BASE', '192.168.1.')
+        ip_start = int(env.get(f'SERVER_{i}_IP_START', 100))
         
         server_config = {
-            'name': os.getenv(f'SERVER_{i}_NAME', f'Server {i}'),
-            'hostname': os.getenv(host_key),
+            'id': f'server_{i}',
+            'name': env.get(f'SERVER_{i}_NAME', f'Server {i}'),
+            'hostname': env.get(host_key),
             'port': port,
-            'username': os.getenv(f'SERVER_{i}_USERNAME', 'root'),
+            'username': env.get(f'SERVER_{i}_USERNAME', 'root'),
             'password': password,
-            'computers_count': int(os.getenv(f'SERVER_{i}_COMPUTERS_COUNT', 0)),
-            'location': os.getenv(f'SERVER_{i}_LOCATION', 'Unknown'),
+            'key_path': os.path.expanduser(key_path) if key_path else None,
+            'key_passphrase': env.get(f'SERVER_{i}_KEY_PASSPHRASE') or None,
+            'computers_count': int(env.get(f'SERVER_{i}_COMPUTERS_COUNT', 0)),
+            'location': env.get(f'SERVER_{i}_LOCATION', 'Unknown'),
+            'executor': env.get(f'SERVER_{i}_EXECUTOR') or None,
             'ip_base': ip_base,
             'ip_start': ip_start
         }
@@ -111,6 +158,123 @@ SERVERS_CONFIG = load_servers_config()
 BOT_TOKEN = os.getenv('BOT_TOKEN')
 COMPUTERS_PER_PAGE = int(os.getenv('COMPUTERS_PER_PAGE', 8))
 
+# Настройки пула SSH соединений
+SSH_KEEPALIVE = int(os.getenv('SSH_KEEPALIVE', 30))
+SSH_MAX_CHANNELS_PER_HOST = int(os.getenv('SSH_MAX_CHANNELS_PER_HOST', 4))
+SSH_CONNECT_TIMEOUT = int(os.getenv('SSH_CONNECT_TIMEOUT', 30))
+# Ключи хостов: проверяются по файлу known_hosts (пустой путь - только в памяти процесса).
+# tofu - новый хост запоминается при первом подключении, strict - только хосты из файла
+SSH_KNOWN_HOSTS = os.getenv('SSH_KNOWN_HOSTS', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'known_hosts'))
+SSH_HOST_KEY_POLICY = os.getenv('SSH_HOST_KEY_POLICY', 'tofu').lower()
+# Прогрев: при запуске параллельно подключаемся ко всем серверам, пока бот уже принимает обновления
+SSH_WARMUP = os.getenv('SSH_WARMUP', '1').lower() not in ('0', 'false', 'no')
+SSH_WARMUP_WORKERS = int(os.getenv('SSH_WARMUP_WORKERS', 16))
+
+# Доставка результатов: до RESULT_MESSAGE_LIMIT символов - одним сообщением,
+# до RESULT_SPLIT_MESSAGES сообщений - частями, иначе файлом (больше RESULT_GZIP_BYTES - сжатым)
+RESULT_MESSAGE_LIMIT = int(os.getenv('RESULT_MESSAGE_LIMIT', 4000))
+RESULT_SPLIT_MESSAGES = int(os.getenv('RESULT_SPLIT_MESSAGES', 3))
+RESULT_GZIP_BYTES = int(os.getenv('RESULT_GZIP_BYTES', 256 * 1024))
+
+# Захват вывода команд: в памяти начало и конец каждого потока, целиком - во временном файле
+# (до CAPTURE_SPILL_BYTES в памяти, дальше на диске, не больше CAPTURE_MAX_BYTES на поток)
+CAPTURE_LIMITS = {
+    'head_chars': int(os.getenv('CAPTURE_HEAD_CHARS', 32768)),
+    'tail_chars': int(os.getenv('CAPTURE_TAIL_CHARS', 32768)),
+    'spill_bytes': int(os.getenv('CAPTURE_SPILL_BYTES', 1024 * 1024)),
+    'max_bytes': int(os.getenv('CAPTURE_MAX_BYTES', 64 * 1024 * 1024)),
+}
+
+# Настройки потокового вывода fre.sh
+STREAM_OUTPUT = os.getenv('STREAM_OUTPUT', '1').lower() not in ('0', 'false', 'no')
+STREAM_EDIT_INTERVAL = float(os.getenv('STREAM_EDIT_INTERVAL', 3))
+STREAM_TAIL_CHARS = int(os.getenv('STREAM_TAIL_CHARS', 3000))
+
+# Настройки проверки статуса серверов
+STATUS_PROBE_WORKERS = int(os.getenv('STATUS_PROBE_WORKERS', 8))
+STATUS_PROBE_TIMEOUT = float(os.getenv('STATUS_PROBE_TIMEOUT', 5))
+
+# Интервал проверки изменения .env для перезагрузки конфигурации (0 - только по SIGHUP)
+CONFIG_WATCH_INTERVAL = float(os.getenv('CONFIG_WATCH_INTERVAL', 5))
+
+# Настройки фоновой проверки серверов (0 - отключить)
+HEALTH_POLL_INTERVAL = float(os.getenv('HEALTH_POLL_INTERVAL', 60))
+HEALTH_STATUS_TTL = float(os.getenv('HEALTH_STATUS_TTL', 180))
+
+# Состояние ПК на кнопках меню (свободен / занят / выключен): одна проверка на страницу через сервер,
+# результат хранится PC_PROBE_TTL секунд (0 - не проверять). ПК занят, если держит соединение
+# с сервером на одном из PC_BUSY_PORTS; PC_PROBE_COMMAND заменяет встроенную команду ({ips} - список IP)
+PC_PROBE_TTL = float(os.getenv('PC_PROBE_TTL', 20))
+PC_PROBE_TIMEOUT = float(os.getenv('PC_PROBE_TIMEOUT', 10))
+PC_BUSY_PORTS = [int(port) for port in os.getenv('PC_BUSY_PORTS', '3260,445').split(',') if port.strip()]
+PC_PROBE_COMMAND = os.getenv('PC_PROBE_COMMAND', '')
+
+# Настройки планировщика задач обновления
+JOB_WORKERS = int(os.getenv('JOB_WORKERS', 4))
+JOB_PER_SERVER_LIMIT = int(os.getenv('JOB_PER_SERVER_LIMIT', 1))
+
+# Журнал задач в SQLite (пустой путь - не вести) и перезапуск прерванных задач при старте
+JOB_DB_PATH = os.getenv('JOB_DB_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'jobs.db'))
+JOB_DB_FLUSH_INTERVAL = float(os.getenv('JOB_DB_FLUSH_INTERVAL', 1))
+JOB_RECOVER = os.getenv('JOB_RECOVER', '1').lower() not in ('0', 'false', 'no')
+
+# Состояния пользователей (последний сервер и страница меню): срок жизни, предел количества
+# и файл для сохранения между перезапусками (пустой путь - только в памяти)
+SESSION_TTL = int(os.getenv('SESSION_TTL', 7 * 24 * 3600))
+SESSION_MAX_ENTRIES = int(os.getenv('SESSION_MAX_ENTRIES', 10000))
+SESSION_FILE = os.getenv('SESSION_FILE', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sessions.json'))
+SESSION_SAVE_INTERVAL = float(os.getenv('SESSION_SAVE_INTERVAL', 30))
+
+# Режим массового обновления: script - один fre.sh --all, parallel - fre.sh для каждого ПК силами бота
+MASS_UPDATE_MODE = os.getenv('MASS_UPDATE_MODE', 'script').lower()
+MASS_UPDATE_CONCURRENCY = int(os.getenv('MASS_UPDATE_CONCURRENCY', 4))
+# По этому шаблону в выводе fre.sh определяется, что ПК занят и был пропущен
+MASS_UPDATE_BUSY_PATTERN = re.compile(os.getenv('MASS_UPDATE_BUSY_PATTERN', r'занят|busy|in use'), re.IGNORECASE)
+
+# Сроки выполнения обновления (секунды, 0 - без ограничения): одного ПК и всего сервера (--all,
+# выбранные ПК). После срока или кнопки отмены процессы команды на сервере получают SIGTERM,
+# а через UPDATE_KILL_GRACE секунд - SIGKILL
+UPDATE_TIMEOUT_PC = float(os.getenv('UPDATE_TIMEOUT_PC', 3600))
+UPDATE_TIMEOUT_ALL = float(os.getenv('UPDATE_TIMEOUT_ALL', 4 * 3600))
+UPDATE_KILL_GRACE = float(os.getenv('UPDATE_KILL_GRACE', 5))
+
+# Ограничения скорости отправки в Telegram (запросов в секунду) и число потоков отправки
+TG_GLOBAL_RATE = float(os.getenv('TG_GLOBAL_RATE', 25))
+TG_CHAT_RATE = float(os.getenv('TG_CHAT_RATE', 1))
+TG_CHAT_BURST = int(os.getenv('TG_CHAT_BURST', 3))
+TG_SEND_WORKERS = int(os.getenv('TG_SEND_WORKERS', 4))
+TG_SEND_RETRIES = int(os.getenv('TG_SEND_RETRIES', 5))
+
+# Среда выполнения: sync - TeleBot и paramiko в потоках, async - AsyncTeleBot и asyncssh (async_runtime.py)
+BOT_RUNTIME = os.getenv('BOT_RUNTIME', 'sync').lower()
+
+# Получение обновлений: polling - long polling, webhook - встроенный HTTP сервер
+BOT_MODE = os.getenv('BOT_MODE', 'polling').lower()
+# Публичный адрес, который регистрируется в Telegram (без него вебхук только принимает локальные POST)
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', '')
+WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', 8443))
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/webhook')
+# Секрет, который Telegram передает в заголовке каждого запроса (обязателен в режиме webhook)
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET', '')
+WEBHOOK_WORKERS = int(os.getenv('WEBHOOK_WORKERS', 4))
+WEBHOOK_QUEUE_SIZE = int(os.getenv('WEBHOOK_QUEUE_SIZE', 1000))
+
+# Раздельный запуск: front-end (Telegram, меню, очередь задач) передает SSH команды процессам-исполнителям
+# через unix-сокеты в EXECUTOR_SOCKET_DIR. EXECUTORS - имена исполнителей (пусто - все в процессе бота),
+# исполнитель запускается командой python bot.py --executor <имя>, SERVER_N_EXECUTOR - исполнитель
+# сервера (по умолчанию первый). Ключ соединения EXECUTOR_AUTHKEY по умолчанию выводится из BOT_TOKEN
+EXECUTORS = [name.strip() for name in os.getenv('EXECUTORS', '').split(',') if name.strip()]
+EXECUTOR_SOCKET_DIR = os.getenv('EXECUTOR_SOCKET_DIR', os.path.dirname(os.path.abspath(__file__)))
+EXECUTOR_AUTHKEY = (os.getenv('EXECUTOR_AUTHKEY') or hashlib.sha256(f"executor:{BOT_TOKEN}".encode()).hexdigest()).encode()
+EXECUTOR_WORKERS = int(os.getenv('EXECUTOR_WORKERS', 16))
+# Имя исполнителя, если процесс запущен с --executor (иначе None)
+EXECUTOR_ROLE = sys.argv[sys.argv.index('--executor') + 1] if '--executor' in sys.argv[1:-1] else None
+
+# Метрики в формате Prometheus на локальном порту (0 - не запускать HTTP сервер, /stats работает всегда)
+METRICS_PORT = int(os.getenv('METRICS_PORT', 0))
+METRICS_LISTEN = os.getenv('METRICS_LISTEN', '127.0.0.1')
+
 # Проверяем загрузку конфигурации
 if not BOT_TOKEN:
     raise ValueError("❌ BOT_TOKEN не найден в .env файле")
@@ -118,6 +282,14 @@ if not BOT_TOKEN:
 if not SERVERS_CONFIG:
     raise ValueError("❌ Не найдено ни одного сервера в .env файле")
 
+# Без секрета любой, кто достучится до порта, сможет прислать обновление от имени администратора
+if BOT_MODE == 'webhook' and not WEBHOOK_SECRET:
+    raise ValueError("❌ WEBHOOK_SECRET не задан: в режиме webhook он обязателен")
+
+for server_id, config in SERVERS_CONFIG.items():
+    if config['executor'] and config['executor'] not in EXECUTORS:
+        print(f"⚠️  {config['name']}: исполнитель {config['executor']} не указан в EXECUTORS")
+
 if ALLOWED_USER_IDS:
     print(f"🔐 Режим белого списка: {len(ALLOWED_USER_IDS)} пользователей")
 else:
@@ -129,114 +301,292 @@ print(f"✅ Компьютеров на странице: {COMPUTERS_PER_PAGE}")
 for server_id, config in SERVERS_CONFIG.items():
     print(f"   • {config['name']} - {config['computers_count']} компьютеров")
 
+# Метрики: длительности SSH операций, вызовов Telegram API, обработчиков и задач
+metrics = MetricsRegistry()
+ssh_seconds = metrics.histogram('bot_ssh_seconds', 'Длительность SSH операций (connect, handshake, auth_key, auth_password, channel, command)',
+                                ('server', 'operation'))
+ssh_commands = metrics.counter('bot_ssh_commands_total', 'Выполненные SSH команды по исходу (ok, failed, error, cancelled, timeout)',
+                               ('server', 'outcome'))
+telegram_seconds = metrics.histogram('bot_telegram_seconds', 'Длительность вызовов Telegram Bot API', ('method',))
+telegram_requests = metrics.counter('bot_telegram_requests_total', 'Вызовы Telegram Bot API по исходу (ok, retry, error)',
+                                    ('method', 'outcome'))
+send_result_seconds = metrics.histogram('bot_send_result_seconds', 'Отправка результата команды (message, document)',
+                                        ('server', 'kind'))
+callback_seconds = metrics.histogram('bot_callback_seconds', 'Обработка нажатий кнопок', ('action',))
+job_wait_seconds = metrics.histogram('bot_job_wait_seconds', 'Ожидание задачи в очереди', ('server',))
+job_seconds = metrics.histogram('bot_job_seconds', 'Выполнение задачи обновления', ('server',))
+jobs_finished = metrics.counter('bot_jobs_total', 'Завершенные задачи обновления по статусу', ('server', 'status'))
+update_dedup = metrics.counter('bot_update_dedup_total', 'Повторные запросы обновления: присоединены к идущей задаче '
+                               '(attached) или заменили обычную задачу принудительной (superseded)', ('server', 'kind'))
+
+def observe_telegram(method, seconds, outcome):
+    telegram_seconds.observe(seconds, method=method)
+    telegram_requests.inc(method=method, outcome=outcome)
+
 # Инициализируем бота
 bot = telebot.TeleBot(BOT_TOKEN)
 
-# Временное хранилище состояний
-user_states = {}
+# Все исходящие запросы к Telegram идут через общую очередь с ограничением скорости
+outbox = TelegramOutbox(
+    bot,
+    global_rate=TG_GLOBAL_RATE,
+    chat_rate=TG_CHAT_RATE,
+    chat_burst=TG_CHAT_BURST,
+    workers=TG_SEND_WORKERS,
+    max_retries=TG_SEND_RETRIES,
+    observe=observe_telegram,
+)
+
+# Состояния пользователей: последний выбранный сервер и страницы меню
+# Исполнитель не работает с Telegram и не должен перезаписывать файл front-end
+session_store = SessionStore(ttl=SESSION_TTL, max_entries=SESSION_MAX_ENTRIES,
+                             path=(SESSION_FILE or None) if EXECUTOR_ROLE is None else None,
+                             save_interval=SESSION_SAVE_INTERVAL)
+
+# Предвычисленный индекс доступа (заменяется целиком при перезагрузке конфигурации)
+access_index = AccessIndex(SERVERS_CONFIG, ALLOWED_USER_IDS, USER_ACCESS)
+
+# Кодирование callback_data (серверы передаются короткими токенами)
+callback_codec = CallbackCodec(SERVERS_CONFIG)
+
+# Пул постоянных SSH соединений к серверам
+# Ключи хостов общие для обеих сред выполнения
+known_hosts = KnownHosts(SSH_KNOWN_HOSTS or None, SSH_HOST_KEY_POLICY)
+known_hosts.load()
+
+ssh_pool = SSHConnectionPool(
+    keepalive=SSH_KEEPALIVE,
+    max_channels=SSH_MAX_CHANNELS_PER_HOST,
+    connect_timeout=SSH_CONNECT_TIMEOUT,
+    observe=lambda server_id, operation, seconds: ssh_seconds.observe(seconds, server=server_id, operation=operation),
+    known_hosts=known_hosts,
+)
+
+# Исполнители SSH команд в отдельных процессах (в раздельном режиме свой пул SSH не используется)
+def executor_address(name):
+    return os.path.join(EXECUTOR_SOCKET_DIR, f'executor-{name}.sock')
+
+executor_clients = ({name: ExecutorClient(name, executor_address(name), EXECUTOR_AUTHKEY) for name in EXECUTORS}
+                    if EXECUTOR_ROLE is None else {})
+
+def server_executor(server_config):
+    """Исполнитель сервера: SERVER_N_EXECUTOR или первый из EXECUTORS"""
+    return executor_clients.get(server_config.get('executor')) or executor_clients[EXECUTORS[0]]
+
+def ssh_probe(server_config, timeout):
+    """Подключается к серверу (если нужно) и измеряет отклик: (время подключения или None, отклик).
+    В раздельном режиме - силами исполнителя сервера"""
+    if executor_clients:
+        # Исполнитель сам соблюдает timeout, запас - на передачу запроса и ответа
+        return server_executor(server_config).call('probe', server_config, timeout, timeout=timeout * 2)
+    return ssh_pool.probe(server_config['id'], server_config, timeout)
+
+def ssh_execute(server_config, command, timeout):
+    """Короткая команда без потокового вывода (проверка состояния ПК), возвращает stdout"""
+    if executor_clients:
+        return server_executor(server_config).call('execute', server_config, command, timeout, timeout=timeout * 2)
+    return ssh_pool.execute(server_config['id'], server_config, command, timeout)
+
+# Ограниченный пул потоков для параллельной проверки серверов
+status_executor = ThreadPoolExecutor(max_workers=STATUS_PROBE_WORKERS, thread_name_prefix='status-probe')
+
+# Фоновая проверка доступности серверов (запускается вместе с ботом)
+health_poller = HealthPoller(
+    lambda: SERVERS_CONFIG,
+    lambda config: probe_server(config),
+    status_executor,
+    interval=HEALTH_POLL_INTERVAL,
+    ttl=HEALTH_STATUS_TTL,
+)
+
+# Проверка состояния ПК для меню компьютеров (в том же пуле потоков, что и проверка серверов)
+pc_probe = PCStatusProbe(
+    lambda server_config, command: run_probe_command(server_config, command),
+    status_executor,
+    ttl=PC_PROBE_TTL,
+    ports=PC_BUSY_PORTS,
+    template=PC_PROBE_COMMAND,
+)
+
+# Журнал задач: номера задач выдает база, итоги записываются пачками (открывается в start_services)
+job_store = None
+
+# Планировщик задач обновления: общий пул потоков и очереди по серверам
+job_scheduler = JobScheduler(workers=JOB_WORKERS, per_server_limit=JOB_PER_SERVER_LIMIT,
+                             on_finish=lambda job: record_job_finish(job))
+
+# Фоновые потоки и файлы запускаются при старте бота, а не при импорте модуля:
+# асинхронная среда использует свой планировщик, исполнителю не нужны очередь Telegram и журнал
+def start_services(runtime=BOT_RUNTIME):
+    """Запускает очередь отправки, сохранение состояний, журнал задач и (в среде потоков) планировщик"""
+    global job_store
+    outbox.start()
+    session_store.start()
+    if JOB_DB_PATH:
+        job_store = JobStore(JOB_DB_PATH, flush_interval=JOB_DB_FLUSH_INTERVAL)
+        job_store.start()
+    if runtime != 'async':
+        job_scheduler.start()
+
+# Текущее состояние: потоки, задачи, очередь отправки и состояния пользователей
+metrics.gauge('bot_threads', 'Количество потоков процесса', threading.active_count)
+metrics.gauge('bot_startup_seconds', 'Этапы запуска: секунд от старта процесса',
+              lambda: {(phase,): seconds for phase, seconds in startup_timings.items()}, labels=('phase',))
+metrics.gauge('bot_jobs', 'Задачи обновления по состоянию',
+              lambda: dict(zip([('running',), ('queued',)], map(len, job_scheduler.snapshot()))), ('state',))
+metrics.gauge('bot_executors_connected', 'Подключение front-end к исполнителям (1 - подключен)',
+              lambda: {(name,): int(client.connected) for name, client in executor_clients.items()}, ('executor',))
+metrics.gauge('bot_outbox_pending', 'Запросы к Telegram, ожидающие отправки', lambda: outbox.pending())
+metrics.gauge('bot_sessions', 'Состояния пользователей: размер и счетчики попаданий и вытеснений',
+              lambda: {(key,): value for key, value in session_store.stats().items()}, ('stat',))
 
 # Функция проверки доступа
 def check_access(user_id):
     """Проверяет, есть ли пользователь в белом списке"""
-    if not ALLOWED_USER_IDS:  # Если список пустой - доступ для всех
-        return True
-    return user_id in ALLOWED_USER_IDS
+    return access_index.check_access(user_id)
 
 # Функция проверки доступа к серверу
 def check_server_access(user_id, server_id):
     """Проверяет, есть ли у пользователя доступ к конкретному серверу"""
-    # Если права доступа не настроены - доступ ко всем серверам
-    if not USER_ACCESS:
-        return True
-    
-    # Если пользователь есть в списке прав доступа
-    if user_id in USER_ACCESS:
-        # Если список серверов пустой или содержит '*' - доступ ко всем серверам
-        user_servers = USER_ACCESS[user_id]
-        if not user_servers or '*' in user_servers:
-            return True
-        # Проверяем доступ к конкретному серверу
-        return server_id in user_servers
-    
-    # Если пользователя нет в списке прав доступа - доступ только если нет ограничений для других пользователей
-    # Это позволяет сохранить обратную совместимость
-    return len(USER_ACCESS) == 0
+    return access_index.check_server_access(user_id, server_id)
 
 # Декораторы для проверки доступа
 def access_check_message(func):
     def wrapper(message):
         if not check_access(message.from_user.id):
-            bot.reply_to(message, f"❌ Доступ запрещен. Ваш ID: {message.from_user.id}\n\nДля получения доступа предоставьте этот ID администратору.")
+            outbox.reply_to(message, ACCESS_DENIED_TEXT.format(user_id=message.from_user.id))
             return
-        return func(message)
+        try:
+            return func(message)
+        finally:
+            mark_first_response()
     return wrapper
 
 def access_check_callback(func):
     def wrapper(call):
         if not check_access(call.from_user.id):
-            bot.answer_callback_query(call.id, "❌ Доступ запрещен", show_alert=True)
+            outbox.answer_callback_query(call.id, "❌ Доступ запрещен", show_alert=True)
             return
-        return func(call)
+        try:
+            return func(call)
+        finally:
+            mark_first_response()
     return wrapper
 
-# Декоратор для проверки доступа к серверу
-def server_access_check_callback(func):
-    def wrapper(call):
-        # Извлекаем server_id из callback data
-        server_id = None
-        if call.data.startswith('select_server:'):
-            server_id = call.data.replace('select_server:', '', 1)
-        elif call.data.startswith('computers_page:'):
-            parts = call.data.replace('computers_page:', '', 1).split(':')
-            if len(parts) == 2:
-                server_id = parts[0]
-        elif call.data.startswith('select_pc:'):
-            parts = call.data.replace('select_pc:', '', 1).split(':')
-            if len(parts) == 2:
-                server_id = parts[0]
-        elif call.data.startswith('update_normal:'):
-            parts = call.data.replace('update_normal:', '', 1).split(':')
-            if len(parts) == 2:
-                server_id = parts[0]
-        elif call.data.startswith('update_force_confirm:'):
-            parts = call.data.replace('update_force_confirm:', '', 1).split(':')
-            if len(parts) == 2:
-                server_id = parts[0]
-        elif call.data.startswith('force_update:'):
-            parts = call.data.replace('force_update:', '', 1).split(':')
-            if len(parts) == 2:
-                server_id = parts[0]
-        elif call.data.startswith('back_to_mode:'):
-            parts = call.data.replace('back_to_mode:', '', 1).split(':')
-            if len(parts) == 2:
-                server_id = parts[0]
-        elif call.data.startswith('back_to_computers:'):
-            server_id = call.data.replace('back_to_computers:', '', 1)
-        elif call.data.startswith('update_server:'):
-            server_id = call.data.replace('update_server:', '', 1)
-        
-        # Если server_id найден и у пользователя нет доступа
-        if server_id and not check_server_access(call.from_user.id, server_id):
-            bot.answer_callback_query(call.id, "❌ Доступ к этому серверу запрещен", show_alert=True)
-            return
-        
-        return func(call)
-    return wrapper
+# Этапы запуска: секунды от старта процесса (для логов, /stats и метрик)
+STARTUP_PHASES = {
+    'config': 'конфигурация загружена',
+    'ready': 'прием обновлений',
+    'ssh_warmup': 'прогрев SSH завершен',
+    'first_response': 'первый ответ пользователю',
+}
+startup_timings = {}
+
+def mark_startup(phase):
+    seconds = startup_timings[phase] = time.monotonic() - STARTED_AT
+    logger.info(f"⏱️ Запуск: {STARTUP_PHASES[phase]} через {seconds:.2f} с")
+
+def mark_first_response():
+    if 'first_response' not in startup_timings:
+        mark_startup('first_response')
+
+# Проверка прав администратора
+def is_admin(user_id):
+    """Администраторы из ADMIN_USER_IDS, а если список не задан - пользователи с доступом ко всем серверам"""
+    if ADMIN_USER_IDS:
+        return user_id in ADMIN_USER_IDS
+    return check_access(user_id) and len(get_available_servers(user_id)) == len(SERVERS_CONFIG)
 
 # Функция для получения списка доступных серверов для пользователя
 def get_available_servers(user_id):
-    """Возвращает список серверов, доступных пользователю"""
-    if not USER_ACCESS:
-        return SERVERS_CONFIG
-    
-    if user_id in USER_ACCESS:
-        user_servers = USER_ACCESS[user_id]
-        if not user_servers or '*' in user_servers:
-            return SERVERS_CONFIG
-        return {server_id: config for server_id, config in SERVERS_CONFIG.items() if server_id in user_servers}
+    """Возвращает список серверов, доступных пользователю (готовый, только для чтения)"""
+    return access_index.available_servers(user_id)
+
+# Перезагрузка конфигурации без перезапуска бота
+config_reload_lock = threading.Lock()
+
+def reload_config(reason):
+    """Перечитывает .env и атомарно подменяет серверы и права доступа.
+    Выполняющиеся задачи продолжают работать со своей копией настроек сервера"""
+    global SERVERS_CONFIG, USER_ACCESS, ALLOWED_USER_IDS, ADMIN_USER_IDS, access_index, callback_codec
+    
+    with config_reload_lock:
+        # Переменные процесса приоритетнее .env, как и при запуске
+        env = dict(dotenv_values(ENV_FILE)) if ENV_FILE else {}
+        env.update(BASE_ENV)
+        env = {key: value for key, value in env.items() if value is not None}
+        
+        try:
+            servers_config = load_servers_config(env)
+            user_access = load_user_access(env)
+            allowed_user_ids = load_allowed_user_ids(env)
+            admin_user_ids = load_admin_user_ids(env)
+            new_index = AccessIndex(servers_config, allowed_user_ids, user_access)
+            # Новая таблица токенов: при отказе от перезагрузки кнопки продолжают работать со старой
+            new_codec = CallbackCodec(servers_config)
+        except Exception as e:
+            logger.error(f"Ошибка перезагрузки конфигурации ({reason}), оставлена прежняя: {e}")
+            return False
+        
+        if not servers_config:
+            logger.error(f"Перезагрузка конфигурации ({reason}) отменена: не найдено ни одного сервера")
+            return False
+        
+        removed_servers = set(SERVERS_CONFIG) - set(servers_config)
+        access_index, callback_codec = new_index, new_codec
+        SERVERS_CONFIG, USER_ACCESS, ALLOWED_USER_IDS = servers_config, user_access, allowed_user_ids
+        ADMIN_USER_IDS = admin_user_ids
+        
+        for server_id in removed_servers:
+            ssh_pool.close(server_id)
+        invalidate_menu_cache()
     
-    # Если пользователя нет в списке прав доступа
-    return {}
+    logger.info(f"Конфигурация перезагружена ({reason}): серверов {len(servers_config)}, "
+                f"пользователей в белом списке {len(allowed_user_ids)}, прав доступа {len(user_access)}")
+    return True
+
+def watch_env_file():
+    """Следит за изменением .env и перезагружает конфигурацию"""
+    last_mtime = os.path.getmtime(ENV_FILE) if os.path.exists(ENV_FILE) else None
+    while True:
+        time.sleep(CONFIG_WATCH_INTERVAL)
+        try:
+            mtime = os.path.getmtime(ENV_FILE)
+        except OSError:
+            continue
+        if mtime != last_mtime:
+            last_mtime = mtime
+            reload_config(".env изменен")
+
+def start_config_reload():
+    """Включает перезагрузку конфигурации по SIGHUP и по изменению .env"""
+    if hasattr(signal, 'SIGHUP'):
+        # В обработчике сигнала только запускаем поток - перезагрузка может занять время
+        signal.signal(signal.SIGHUP, lambda signum, frame: threading.Thread(
+            target=reload_config, args=("SIGHUP",), daemon=True).start())
+    if ENV_FILE and CONFIG_WATCH_INTERVAL > 0:
+        threading.Thread(target=watch_env_file, name='env-watcher', daemon=True).start()
+
+# Запуск приема обновлений через вебхук
+def start_webhook(handle_update):
+    """Запускает встроенный HTTP сервер и, если задан WEBHOOK_URL, регистрирует вебхук в Telegram"""
+    server = WebhookServer(
+        handle_update,
+        host=WEBHOOK_LISTEN,
+        port=WEBHOOK_PORT,
+        path=WEBHOOK_PATH,
+        secret=WEBHOOK_SECRET,
+        workers=WEBHOOK_WORKERS,
+        queue_size=WEBHOOK_QUEUE_SIZE,
+    )
+    server.start()
+    if WEBHOOK_URL:
+        bot.set_webhook(url=WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH, secret_token=WEBHOOK_SECRET)
+    return server
+
+def process_webhook_update(update):
+    """Обрабатывает JSON обновления в текущем (рабочем) потоке вебхука"""
+    bot.process_new_updates([types.Update.de_json(update)])
 
 # Функция для преобразования номера компьютера в IP адрес
 def number_to_ip(server_config, pc_number):
@@ -250,142 +600,895 @@ def number_to_ip(server_config, pc_number):
         return None
 
 # Функция для выполнения SSH команд
-def run_ssh_command(server_config, command):
-    """Выполняет команду на удаленном сервере через SSH с использованием пароля"""
+def run_ssh_command(server_config, command, stream=None, cancel=None, timeout=None, result=None):
+    """Выполняет команду через постоянное SSH соединение из пула. stdout и stderr вычитываются
+    одновременно в ограниченные буферы; при stream вывод передается в него по мере поступления.
+    cancel (CancelToken задачи) и timeout (секунды) останавливают команду вместе с ее процессами
+    на сервере, причина остановки - в result.interrupted. В раздельном режиме команда выполняется
+    исполнителем сервера, result задает исполнитель (ForwardedResult пересылает вывод в front-end).
+    Возвращает CommandResult (ошибка подключения - в result.error)"""
+    if executor_clients:
+        return run_remote_command(server_config, command, stream, cancel, timeout)
+    if result is None:
+        result = CommandResult(**CAPTURE_LIMITS)
+    cancellable = cancel is not None or bool(timeout)
+    deadline = time.monotonic() + timeout if timeout else None
     try:
-        ssh_client = paramiko.SSHClient()
-        ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        
-        # Параметры подключения
-        connect_kwargs = {
-            'hostname': server_config['hostname'],
-            'username': server_config['username'],
-            'password': server_config['password'],
-            'port': server_config.get('port', 22),
-            'timeout': 30
-        }
-        
-        logger.info(f"Подключение к {server_config['name']}")
-        ssh_client.connect(**connect_kwargs)
-        
-        stdin, stdout, stderr = ssh_client.exec_command(command)
-        
-        # Объединяем stdout и stderr в один вывод
-        output = stdout.read().decode('utf-8')
-        error = stderr.read().decode('utf-8')
-        
-        ssh_client.close()
-        
-        # Возвращаем полный вывод (stdout + stderr)
-        full_output = output + ("\n" + error if error else "")
-        return True, full_output.strip()
+        with ssh_pool.channel(server_config['id'], server_config) as channel:
+            started = time.perf_counter()
+            channel.exec_command(cancellable_command(command) if cancellable else command)
+            out_decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+            err_decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+            # PID оболочки команды приходит первой строкой stdout, до него вывод копится в head
+            pid = None if cancellable else 0
+            head = b''
+            
+            while True:
+                received = False
+                if channel.recv_ready():
+                    data = channel.recv(32768)
+                    if pid is None:
+                        head += data
+                        pid, data = split_pid_line(head)
+                        if pid is None:
+                            data = b''
+                    text = out_decoder.decode(data)
+                    result.stdout.feed(text)
+                    if stream:
+                        stream.feed(text)
+                    received = True
+                if channel.recv_stderr_ready():
+                    text = err_decoder.decode(channel.recv_stderr(32768))
+                    result.stderr.feed(text)
+                    if stream:
+                        stream.feed(text)
+                    received = True
+                reason = stop_reason(cancel, deadline)
+                if reason:
+                    result.interrupted = reason
+                    logger.info(f"Команда на {server_config['name']} остановлена ({reason}): {command}")
+                    stop_remote_command(server_config, channel, pid)
+                    break
+                if not received:
+                    if channel.exit_status_ready() and not channel.recv_ready() and not channel.recv_stderr_ready():
+                        break
+                    time.sleep(0.1)
+                if stream:
+                    stream.tick()
             
+            if pid is None:
+                # Строка с PID так и не пришла целиком - это обычный вывод
+                result.stdout.feed(out_decoder.decode(head))
+            result.stdout.feed(out_decoder.decode(b'', final=True))
+            result.stderr.feed(err_decoder.decode(b'', final=True))
+            if result.interrupted is None:
+                result.exit_status = channel.recv_exit_status()
+                ssh_seconds.observe(time.perf_counter() - started, server=server_config['id'], operation='command')
+    
+    except Exception as e:
+        result.error = f"SSH Connection failed to {server_config['name']}: {e}"
+        logger.error(result.error)
+    ssh_commands.inc(server=server_config['id'], outcome=command_outcome(result))
+    return result
+
+def run_remote_command(server_config, command, stream=None, cancel=None, timeout=None):
+    """Выполняет команду в процессе-исполнителе сервера. Вывод приходит по мере выполнения
+    и захватывается здесь же, отмена и срок задачи передаются исполнителю.
+    Перезапуск исполнителя во время команды - ошибка подключения в result.error"""
+    result = CommandResult(**CAPTURE_LIMITS)
+    client = server_executor(server_config)
+    try:
+        request_id, replies = client.submit('run', server_config, command, timeout)
+    except ExecutorUnavailable as e:
+        result.error = str(e)
+        logger.error(result.error)
+        ssh_commands.inc(server=server_config['id'], outcome=command_outcome(result))
+        return result
+    
+    stop_sent = False
+    try:
+        while True:
+            if not stop_sent and cancel is not None and cancel.check():
+                stop_sent = True
+                try:
+                    client.cancel(request_id, cancel.reason)
+                except ExecutorUnavailable:
+                    pass  # Обрыв уже передан в очередь ответов
+            try:
+                reply = replies.get(timeout=0.1)
+            except queue.Empty:
+                reply = None
+            if reply is not None and reply[0] == 'output':
+                (result.stdout if reply[2] == 'stdout' else result.stderr).feed(reply[3])
+                if stream:
+                    stream.feed(reply[3])
+            elif reply is not None and reply[0] == 'done':
+                result.exit_status, result.error, result.interrupted = reply[2:]
+                break
+            elif reply is not None:
+                result.error = f"SSH Connection failed to {server_config['name']}: {reply[2]}"
+                break
+            if stream:
+                stream.tick()
+    finally:
+        client.finish(request_id)
+    if result.error is not None:
+        logger.error(result.error)
+    ssh_commands.inc(server=server_config['id'], outcome=command_outcome(result))
+    return result
+
+def command_outcome(result):
+    """Исход команды для метрик: ok, failed (ненулевой код возврата), error (ошибка подключения),
+    cancelled или timeout (команда остановлена)"""
+    if result.error is not None:
+        return 'error'
+    if result.interrupted is not None:
+        return result.interrupted
+    return 'ok' if result.exit_status == 0 else 'failed'
+
+# Остановка команды на сервере
+# Остановимая команда выполняется в оболочке, которая первой строкой выводит свой PID
+REMOTE_PID_MARKER = '__fre_bot_pid__'
+# Дерево процессов сначала замораживается сверху вниз (замороженный процесс не породит новых потомков),
+# затем все его процессы получают сигнал и SIGCONT, чтобы сигнал был доставлен
+KILL_TREE_SCRIPT = ("tree() {{ kill -STOP $1 2>/dev/null && echo $1; for child in $(pgrep -P $1); do tree $child; done; }}; "
+                    "pids=$(tree {pid}); [ -n \"$pids\" ] && kill -{signal_name} $pids 2>/dev/null; kill -CONT $pids 2>/dev/null")
+
+INTERRUPTED_TEXTS = {'cancelled': "⛔ Отменено", 'timeout': "⏱️ Превышено время выполнения"}
+
+def cancellable_command(command):
+    """Оборачивает команду в оболочку, которая сначала выводит свой PID"""
+    return f"sh -c {shlex.quote(f'echo {REMOTE_PID_MARKER}$$; {command}')}"
+
+def split_pid_line(data):
+    """Отделяет строку с PID от начала stdout. Возвращает (pid, остаток вывода) или (None, data),
+    если строка пришла не целиком; pid 0 - строки с PID нет, весь вывод обычный"""
+    line, newline, rest = data.partition(b'\n')
+    if not newline:
+        return None, data
+    marker = REMOTE_PID_MARKER.encode()
+    if line.startswith(marker) and line[len(marker):].strip().isdigit():
+        return int(line[len(marker):]), rest
+    return 0, data
+
+def kill_tree_command(pid, signal_name='TERM'):
+    """Команда остановки дерева процессов; fre.sh запускается через sudo, поэтому и останавливается через sudo"""
+    script = shlex.quote(KILL_TREE_SCRIPT.format(pid=int(pid), signal_name=signal_name))
+    return f"sudo -n sh -c {script} 2>/dev/null || sh -c {script}"
+
+def stop_reason(cancel, deadline):
+    """Причина остановки команды: отмена или срок задачи (cancel), собственный срок команды (deadline)"""
+    reason = cancel.check() if cancel is not None else None
+    if reason is None and deadline is not None and time.monotonic() >= deadline:
+        reason = 'timeout'
+    return reason
+
+def stop_remote_command(server_config, channel, pid):
+    """Останавливает процессы команды: SIGTERM, через UPDATE_KILL_GRACE секунд - SIGKILL.
+    Служебные команды идут отдельным каналом того же соединения вне лимита каналов,
+    сам канал команды закрывается вызывающим кодом и освобождает место в пуле"""
+    if not pid:
+        return
+    try:
+        ssh_pool.side_command(channel, kill_tree_command(pid), SSH_CONNECT_TIMEOUT)
+        deadline = time.monotonic() + UPDATE_KILL_GRACE
+        while not channel.exit_status_ready() and time.monotonic() < deadline:
+            time.sleep(0.1)
+        if not channel.exit_status_ready():
+            ssh_pool.side_command(channel, kill_tree_command(pid, 'KILL'), SSH_CONNECT_TIMEOUT)
     except Exception as e:
-        error_msg = f"SSH Connection failed to {server_config['name']}: {e}"
-        logger.error(error_msg)
-        return False, error_msg
+        logger.warning(f"Не удалось остановить процессы команды на {server_config['name']}: {e}")
 
-# Функция для отправки результата (текстом или файлом)
-def send_result(chat_id, server_config, pc_number, output, force=False):
-    """Отправляет результат выполнения команды, при большом выводе - файлом"""
+# Живое сообщение о ходе выполнения
+class StreamingStatusMessage:
+    """Сообщение с хвостом вывода и временем выполнения, редактируемое не чаще раза в interval секунд.
+    message_id - номер уже отправленного сообщения или Future его отправки; пока номер неизвестен,
+    последняя правка откладывается, и поток команды не ждет очереди Telegram"""
+    
+    def __init__(self, chat_id, title, interval=None, tail_chars=None, message_id=None, reply_markup=None):
+        self.chat_id = chat_id
+        self.title = title
+        self.interval = STREAM_EDIT_INTERVAL if interval is None else interval
+        self.tail_chars = STREAM_TAIL_CHARS if tail_chars is None else tail_chars
+        self.started_at = time.monotonic()
+        self.next_edit_at = self.started_at + self.interval
+        self.tail = ""
+        self.last_text = None
+        self.message_id = None if isinstance(message_id, Future) else message_id
+        self._sending = message_id if isinstance(message_id, Future) else None
+        self._deferred = None
+        self._lock = threading.Lock()
+        # Кнопки (например, отмена задачи) показываются, пока команда выполняется
+        self.reply_markup = reply_markup
+        self._start()
+    
+    def _start(self):
+        if self.message_id is None and self._sending is None:
+            self._sending = outbox.post_message(self.chat_id, self._render("⏳ Выполняется"),
+                                                reply_markup=self.reply_markup, parse_mode='Markdown')
+        else:
+            # Используем уже отправленное сообщение (например, сообщение о задаче)
+            self._edit(self._render("⏳ Выполняется"), self.reply_markup)
+        if self._sending is not None:
+            self._sending.add_done_callback(self._sent)
+    
+    def _sent(self, future):
+        """Сообщение отправлено: запоминаем номер и выполняем отложенную правку"""
+        with self._lock:
+            self._sending = None
+            deferred, self._deferred = self._deferred, None
+            if future.exception() is not None:
+                return
+            self.message_id = future.result().message_id
+        if deferred is not None:
+            self._edit(*deferred)
+    
+    def _render(self, status):
+        elapsed = int(time.monotonic() - self.started_at)
+        text = self.title + f"{status} ({elapsed // 60}:{elapsed % 60:02d})\n"
+        if self.tail:
+            # Тройные кавычки в выводе закрыли бы блок кода раньше времени
+            tail = self.tail[-self.tail_chars:].strip('\n').replace("```", "'''")
+            text += f"```\n{tail}\n```"
+        return text
+    
+    def feed(self, text):
+        """Добавляет фрагмент вывода; отправка происходит только в tick()"""
+        self.tail = (self.tail + text)[-self.tail_chars:]
+    
+    def tick(self):
+        """Отправляет накопленные изменения одним редактированием, если прошел интервал"""
+        if time.monotonic() >= self.next_edit_at:
+            self._edit(self._render("⏳ Выполняется"), self.reply_markup)
+    
+    def finish(self, success, interrupted=None):
+        """Финальное обновление сообщения после завершения команды (кнопки убираются)"""
+        self._edit(self._render(self.final_status(success, interrupted)))
+    
+    @staticmethod
+    def final_status(success, interrupted=None):
+        return INTERRUPTED_TEXTS.get(interrupted) or ("✅ Завершено" if success else "❌ Ошибка")
+    
+    def _edit(self, text, reply_markup=None):
+        self.next_edit_at = time.monotonic() + self.interval
+        with self._lock:
+            if self.message_id is None:
+                if self._sending is not None:
+                    self._deferred = (text, reply_markup)
+                return
+        if text == self.last_text:
+            return
+        # Очередь сама соблюдает лимиты и retry_after, а неотправленные правки сливает в одну
+        outbox.edit_message_text(text, self.chat_id, self.message_id, reply_markup=reply_markup, parse_mode='Markdown')
+        self.last_text = text
+
+# Заголовок сообщений о ходе и результате обновления
+def result_title(server_config, pc_number, force=False, pc_numbers=None):
+    """Формирует заголовок для сообщений о ходе и результате обновления"""
     server_name = server_config['name']
     
+    if pc_numbers:
+        return (f"🖥️ **{server_name}**\nPC {format_pc_ranges(pc_numbers)}\nКомпьютеров: {len(pc_numbers)}\n"
+                f"Режим: {'принудительный' if force else 'обычный'}\n\n")
     if pc_number:
         ip_address = number_to_ip(server_config, pc_number)
-        title = f"🖥️ **{server_name}**\nPC-{pc_number} ({ip_address})\nРежим: {'принудительный' if force else 'обычный'}\n\n"
+        return f"🖥️ **{server_name}**\nPC-{pc_number} ({ip_address})\nРежим: {'принудительный' if force else 'обычный'}\n\n"
+    return f"🖥️ **{server_name}**\nМассовое обновление\nКомпьютеров: {server_config['computers_count']}\n\n"
+
+def code_block(text):
+    """Оборачивает вывод в блок кода (тройные кавычки в выводе закрыли бы его раньше времени)"""
+    text = text.strip('\n').replace("```", "'''")
+    return f"```\n{text}\n```"
+
+# Текст сообщения с результатом
+def build_result_message(title, output, truncated=False):
+    """Формирует сообщение с выводом команды (при truncated - первые RESULT_MESSAGE_LIMIT символов)"""
+    if truncated:
+        output = output[:RESULT_MESSAGE_LIMIT] + "\n\n... [вывод обрезан, слишком длинный]"
+    if output:
+        return title + code_block(output)
+    return title + "Вывод пуст"
+
+def split_output(output, limit):
+    """Делит вывод по границам строк на части не длиннее limit символов (слишком длинные строки режутся)"""
+    parts = []
+    current = ""
+    for line in output.splitlines(keepends=True):
+        while len(line) > limit:
+            if current:
+                parts.append(current)
+                current = ""
+            parts.append(line[:limit])
+            line = line[limit:]
+        if len(current) + len(line) > limit:
+            parts.append(current)
+            current = ""
+        current += line
+    if current:
+        parts.append(current)
+    return parts
+
+def build_result_messages(title, output):
+    """Сообщения с результатом: одно, несколько частей или None, если вывод нужно отправить файлом"""
+    if len(output) <= RESULT_MESSAGE_LIMIT:
+        return [build_result_message(title, output)]
+    
+    # Место под заголовок, номер части и ограждение блока кода
+    parts = split_output(output, RESULT_MESSAGE_LIMIT - len(title) - 40)
+    if len(parts) > RESULT_SPLIT_MESSAGES:
+        return None
+    return [title + f"*Часть {number}/{len(parts)}*\n" + code_block(part)
+            for number, part in enumerate(parts, 1)]
+
+def format_size(size):
+    if size < 1024:
+        return f"{size} Б"
+    if size < 1024 * 1024:
+        return f"{size / 1024:.1f} КБ"
+    return f"{size / 1024 / 1024:.1f} МБ"
+
+def build_document(text, file_name):
+    """Готовит документ в памяти, большие тексты сжимает gzip. Возвращает документ и подпись с размерами"""
+    data = text.encode('utf-8')
+    size_note = f"Размер: {format_size(len(data))}"
+    if len(data) > RESULT_GZIP_BYTES:
+        raw_size = len(data)
+        data = gzip.compress(data, compresslevel=6)
+        file_name += '.gz'
+        size_note = f"Размер: {format_size(len(data))} gzip ({format_size(raw_size)} без сжатия)"
+    return types.InputFile(io.BytesIO(data), file_name=file_name), size_note
+
+def build_result_document(result, file_name='output.txt'):
+    """Документ с полным выводом команды из буферов захвата (большой вывод сжимается gzip)"""
+    document = tempfile.SpooledTemporaryFile(max_size=CAPTURE_LIMITS['spill_bytes'])
+    if result.raw_size > RESULT_GZIP_BYTES:
+        with gzip.GzipFile(fileobj=document, mode='wb', compresslevel=6) as compressed:
+            result.copy_to(compressed)
+        file_name += '.gz'
+        size_note = f"Размер: {format_size(document.tell())} gzip ({format_size(result.raw_size)} без сжатия)"
     else:
-        title = f"🖥️ **{server_name}**\nМассовое обновление\nКомпьютеров: {server_config['computers_count']}\n\n"
+        result.copy_to(document)
+        size_note = f"Размер: {format_size(result.raw_size)}"
+    if result.overflow:
+        size_note += f"\nСохранены первые {format_size(CAPTURE_LIMITS['max_bytes'])} вывода"
+    document.seek(0)
+    return types.InputFile(document, file_name=file_name), size_note
+
+def result_status_line(result):
+    """Строка с кодом возврата для неуспешной команды или причиной ее остановки"""
+    if result.interrupted is not None:
+        return f"{INTERRUPTED_TEXTS[result.interrupted]}\n\n"
+    if result.exit_status == 0:
+        return ""
+    return f"❌ Код возврата: {result.exit_status}\n\n"
+
+# Функция для отправки результата (текстом, частями или файлом)
+def send_result(chat_id, server_config, pc_number, result, force=False):
+    """Отправляет результат выполнения команды: сообщением, несколькими сообщениями или файлом"""
+    started = time.perf_counter()
+    title = result_title(server_config, pc_number, force) + result_status_line(result)
+    output = result.output()
+    
+    # Если середина вывода не поместилась в память, целиком он есть только в файле
+    # Сообщения уходят в фоне: задача освобождает слот сервера, не дожидаясь очереди чата
+    messages = None if result.truncated else build_result_messages(title, output)
+    if messages is not None:
+        for text in messages:
+            sent = outbox.post_message(chat_id, text, parse_mode='Markdown')
+        sent.add_done_callback(lambda future: send_result_seconds.observe(
+            time.perf_counter() - started, server=server_config['id'], kind='message'))
+        return
     
-    # Если вывод слишком длинный, отправляем файлом
-    if len(output) > 4000:
-        try:
-            # Создаем временный файл
-            with tempfile.NamedTemporaryFile(mode='w', suffix='.txt', delete=False, encoding='utf-8') as f:
-                f.write(output)
-                temp_filename = f.name
-            
-            # Отправляем файл
-            with open(temp_filename, 'rb') as file:
-                bot.send_document(
-                    chat_id,
-                    file,
-                    caption=title + "Результат в файле",
-                    parse_mode='Markdown'
-                )
-            
-            # Удаляем временный файл
-            os.unlink(temp_filename)
-            
-        except Exception as e:
-            logger.error(f"Ошибка при отправке файла: {e}")
-            # Если не удалось отправить файл, отправляем первые 4000 символов
-            truncated_output = output[:4000] + "\n\n... [вывод обрезан, слишком длинный]"
-            bot.send_message(chat_id, title + f"```\n{truncated_output}\n```", parse_mode='Markdown')
-    else:
-        # Отправляем вывод как сообщение
-        if output:
-            bot.send_message(chat_id, title + f"```\n{output}\n```", parse_mode='Markdown')
-        else:
-            bot.send_message(chat_id, title + "Вывод пуст", parse_mode='Markdown')
+    # Вывод слишком длинный даже для нескольких сообщений - отправляем файлом
+    # (документ собирается сразу: буферы захвата освобождаются до отправки)
+    fallback = build_result_message(title, output, truncated=True)
+    try:
+        document, size_note = build_result_document(result)
+    except Exception as e:
+        logger.error(f"Ошибка при подготовке файла: {e}")
+        outbox.post_message(chat_id, fallback, parse_mode='Markdown')
+        return
+    
+    def document_sent(future):
+        document.file.close()
+        if future.exception() is not None:
+            # Если не удалось отправить файл, отправляем начало вывода
+            outbox.post_message(chat_id, fallback, parse_mode='Markdown')
+        send_result_seconds.observe(time.perf_counter() - started, server=server_config['id'], kind='document')
+    
+    outbox.post_document(chat_id, document, caption=f"{title}Результат в файле\n{size_note}",
+                         parse_mode='Markdown').add_done_callback(document_sent)
 
-# Функция для запуска обновления в отдельном потоке
-def start_update_in_thread(chat_id, server_id, pc_number=None, force=False):
-    """Запускает обновление в отдельном потоке"""
-    def update_thread():
-        server_config = SERVERS_CONFIG[server_id]
+# Функция для отправки текста файлом
+def send_text_file(chat_id, text, caption, file_name='output.txt'):
+    """Отправляет текст документом, собранным в памяти, с размером в подписи"""
+    document, size_note = build_document(text, file_name)
+    return outbox.post_document(chat_id, document, caption=f"{caption}\n{size_note}", parse_mode='Markdown')
+
+# Выполнение fre.sh с живым выводом или без него
+def execute_update_command(chat_id, server_config, command, pc_number=None, force=False, message_id=None,
+                           cancel=None, reply_markup=None):
+    """Запускает команду обновления, при STREAM_OUTPUT показывая ход выполнения в чате"""
+    if not STREAM_OUTPUT:
+        return run_ssh_command(server_config, command, cancel=cancel)
+    
+    stream = StreamingStatusMessage(chat_id, result_title(server_config, pc_number, force), message_id=message_id,
+                                    reply_markup=reply_markup)
+    result = run_ssh_command(server_config, command, stream, cancel=cancel)
+    stream.finish(result.ok, result.interrupted)
+    return result
+
+# Команда fre.sh для компьютера или всего сервера
+def update_command(server_config, pc_number=None, force=False):
+    if not pc_number:
+        return "sudo bash ./fre.sh --all"
+    ip_address = number_to_ip(server_config, pc_number)
+    return f"sudo bash ./fre.sh --force {ip_address}" if force else f"sudo bash ./fre.sh {ip_address}"
+
+def connection_error_text(server_config, pc_number, error):
+    """Текст сообщения об ошибке подключения к серверу"""
+    text = f"❌ **Ошибка подключения**\nСервер: {server_config['name']}\n"
+    if pc_number:
+        text += f"PC-{pc_number} ({number_to_ip(server_config, pc_number)})\n"
+    return text + f"\nОшибка: {error}"
+
+# Функция выполнения обновления (вызывается планировщиком задач)
+def run_update(chat_id, server_id, pc_number=None, force=False, message_id=None, pc_numbers=None, job=None):
+    """Выполняет обновление компьютера, выбранных компьютеров (pc_numbers) или всего сервера
+    и отправляет результат. job - задача планировщика: ее можно отменить кнопкой в сообщении о ходе.
+    message_id - номер сообщения о задаче или Future его отправки. Возвращает код возврата (None - команда не выполнялась)"""
+    cancel = job.cancel_token if job is not None else None
+    markup = cancel_markup(job) if job is not None else None
+    server_config = SERVERS_CONFIG.get(server_id)
+    if server_config is None:
+        notify_chats(result_chats(job, chat_id), "❌ **Ошибка**\nСервер удален из конфигурации")
+        return None
+    
+    if pc_numbers:
+        # Выбранные компьютеры: каналы одного SSH соединения и общая сводка
+        pc_numbers = [pc_number for pc_number in pc_numbers if number_to_ip(server_config, pc_number)]
+        if not pc_numbers:
+            notify_chats(result_chats(job, chat_id), "❌ **Ошибка**\nВыбранных компьютеров больше нет на сервере")
+            return None
+        results = run_mass_update_parallel(chat_id, server_config, message_id, pc_numbers, force, job)
+        return mass_exit_status(results)
+    elif pc_number:
+        # Обновление конкретного компьютера
+        ip_address = number_to_ip(server_config, pc_number)
+        if not ip_address:
+            notify_chats(result_chats(job, chat_id), f"❌ **Ошибка**\nНеверный номер компьютера: {pc_number}")
+            return None
         
-        if pc_number:
-            # Обновление конкретного компьютера
-            ip_address = number_to_ip(server_config, pc_number)
-            if not ip_address:
-                bot.send_message(
-                    chat_id,
-                    f"❌ **Ошибка**\nНеверный номер компьютера: {pc_number}",
-                    parse_mode='Markdown'
-                )
-                return
-            
-            if force:
-                command = f"sudo bash ./fre.sh --force {ip_address}"
-            else:
-                command = f"sudo bash ./fre.sh {ip_address}"
-            
-            success, output = run_ssh_command(server_config, command)
-            
-            if success:
-                send_result(chat_id, server_config, pc_number, output, force)
+        command = update_command(server_config, pc_number, force)
+        result = execute_update_command(chat_id, server_config, command, pc_number, force, message_id, cancel, markup)
+        return deliver_result(result_chats(job, chat_id), server_config, pc_number, result, force)
+    elif MASS_UPDATE_MODE == 'parallel':
+        # Массовое обновление силами бота: fre.sh отдельно для каждого ПК
+        results = run_mass_update_parallel(chat_id, server_config, message_id, job=job)
+        return mass_exit_status(results)
+    else:
+        # Массовое обновление сервера
+        command = update_command(server_config)
+        result = execute_update_command(chat_id, server_config, command, message_id=message_id,
+                                        cancel=cancel, reply_markup=markup)
+        return deliver_result(result_chats(job, chat_id), server_config, None, result, False)
+
+def mass_exit_status(results):
+    """Код возврата массового обновления по ПК: 0, если все ПК обновлены или заняты"""
+    return 1 if any(result['status'] not in ('ok', 'busy') for result in results.values()) else 0
+
+def deliver_result(chat_ids, server_config, pc_number, result, force=False):
+    """Отправляет результат или ошибку подключения во все чаты chat_ids и освобождает буферы захвата.
+    Возвращает код возврата (None при ошибке подключения)"""
+    try:
+        for chat_id in chat_ids:
+            if result.error is None:
+                send_result(chat_id, server_config, pc_number, result, force)
             else:
-                bot.send_message(
-                    chat_id,
-                    f"❌ **Ошибка подключения**\n"
-                    f"Сервер: {server_config['name']}\n"
-                    f"PC-{pc_number} ({ip_address})\n\n"
-                    f"Ошибка: {output}",
-                    parse_mode='Markdown'
-                )
+                outbox.post_message(chat_id, connection_error_text(server_config, pc_number, result.error), parse_mode='Markdown')
+    finally:
+        result.close()
+    return result.exit_status if result.error is None else None
+
+# Выполнение fre.sh для одного компьютера с учетом кода возврата
+def run_pc_update(server_config, pc_number, force=False, cancel=None):
+    """Запускает fre.sh для одного компьютера в отдельном канале и возвращает итог (ok / busy / failed,
+    cancelled / timeout - если остановлена задача или обновление ПК дольше UPDATE_TIMEOUT_PC)"""
+    command = update_command(server_config, pc_number, force)
+    started = time.monotonic()
+    if cancel is not None and cancel.check():
+        # Задача остановлена раньше, чем до ПК дошла очередь
+        result = CommandResult(**CAPTURE_LIMITS)
+        result.interrupted = cancel.reason
+    else:
+        result = run_ssh_command(server_config, command, cancel=cancel, timeout=UPDATE_TIMEOUT_PC)
+    return pc_update_summary(server_config, pc_number, result, started)
+
+def pc_update_summary(server_config, pc_number, result, started):
+    """Итог обновления одного ПК для сводной таблицы (буферы захвата освобождаются)"""
+    try:
+        if result.error is None:
+            output = result.output()
+            status = result.interrupted or classify_pc_result(result.exit_status, output)
         else:
-            # Массовое обновление сервера
-            command = "sudo bash ./fre.sh --all"
-            success, output = run_ssh_command(server_config, command)
-            
-            if success:
-                send_result(chat_id, server_config, None, output, False)
-            else:
-                bot.send_message(
-                    chat_id,
-                    f"❌ **Ошибка подключения**\n"
-                    f"Сервер: {server_config['name']}\n\n"
-                    f"Ошибка: {output}",
-                    parse_mode='Markdown'
-                )
-    
-    thread = Thread(target=update_thread)
-    thread.daemon = True
-    thread.start()
+            output = result.error
+            status = 'failed'
+    finally:
+        result.close()
+    
+    return {
+        'pc_number': pc_number,
+        'ip_address': number_to_ip(server_config, pc_number),
+        'status': status,
+        'exit_status': result.exit_status,
+        'duration': time.monotonic() - started,
+        'output': output,
+    }
 
-# Функция для показа меню выбора режима обновления
-def show_update_mode_menu(chat_id, server_id, pc_number, message_id=None):
-    """Показывает меню выбора режима обновления для конкретного компьютера"""
+MASS_STATUS_ICONS = {'ok': '✅', 'busy': '🟡', 'failed': '❌', 'cancelled': '⛔', 'timeout': '⏱️'}
+
+def classify_pc_result(exit_status, output):
+    """Итог обновления одного ПК по коду возврата и выводу fre.sh"""
+    if exit_status != 0:
+        return 'failed'
+    if MASS_UPDATE_BUSY_PATTERN.search(output):
+        return 'busy'
+    return 'ok'
+
+def format_mass_progress(result):
+    """Строка хода массового обновления для одного ПК"""
+    return (f"{MASS_STATUS_ICONS[result['status']]} PC-{result['pc_number']:02d} "
+            f"{result['status']} ({format_duration(result['duration'])})\n")
+
+def format_duration(seconds):
+    seconds = int(seconds)
+    return f"{seconds // 60}:{seconds % 60:02d}"
+
+# Параллельное массовое обновление по отдельным ПК
+def run_mass_update_parallel(chat_id, server_config, message_id=None, pc_numbers=None, force=False, job=None):
+    """Запускает fre.sh для каждого ПК сервера каналами одного SSH соединения
+    (не более MASS_UPDATE_CONCURRENCY одновременно) и отправляет сводную таблицу
+    (всем подписчикам задачи job, если она задана)"""
+    cancel = job.cancel_token if job is not None else None
+    reply_markup = cancel_markup(job) if job is not None else None
+    title = result_title(server_config, None, force, pc_numbers)
+    if pc_numbers is None:
+        pc_numbers = range(1, server_config['computers_count'] + 1)
+    # Больше каналов, чем позволяет пул, все равно не откроется
+    concurrency = max(1, min(MASS_UPDATE_CONCURRENCY, SSH_MAX_CHANNELS_PER_HOST))
+    title += f"Параллельно: до {concurrency} ПК одновременно\n\n"
+    stream = StreamingStatusMessage(chat_id, title, message_id=message_id, reply_markup=reply_markup) if STREAM_OUTPUT else None
+    started = time.monotonic()
+    results = {}
+    
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix=f"mass-{server_config['id']}") as executor:
+        pending = {executor.submit(run_pc_update, server_config, pc_number, force, cancel): pc_number
+                   for pc_number in pc_numbers}
+        while pending:
+            done, _ = wait(pending, timeout=1, return_when=FIRST_COMPLETED)
+            for future in done:
+                pc_number = pending.pop(future)
+                result = future.result()
+                results[pc_number] = result
+                if stream:
+                    stream.feed(format_mass_progress(result))
+            if stream:
+                stream.tick()
+    
+    if stream:
+        stream.finish(mass_exit_status(results) == 0, cancel.reason if cancel is not None else None)
+    elapsed = time.monotonic() - started
+    for recipient in result_chats(job, chat_id):
+        send_mass_summary(recipient, server_config, results, elapsed)
+    return results
+
+def build_mass_summary(server_config, results, elapsed):
+    """Формирует сводную таблицу массового обновления, полные логи и подпись к ним"""
+    counts = {status: 0 for status in MASS_STATUS_ICONS}
+    for result in results.values():
+        counts[result['status']] += 1
+    
+    header = (f"🖥️ **{server_config['name']}**\n"
+              f"Массовое обновление ({len(results)} ПК) за {format_duration(elapsed)}\n"
+              f"✅ {counts['ok']}  🟡 занято {counts['busy']}  ❌ {counts['failed']}")
+    if counts['cancelled'] or counts['timeout']:
+        header += f"  ⛔ {counts['cancelled']}  ⏱️ {counts['timeout']}"
+    header += "\n\n"
+    
+    rows = [f"{'ПК':<5} {'IP':<15} {'Итог':<9} Время"]
+    for pc_number in sorted(results):
+        result = results[pc_number]
+        rows.append(f"PC-{pc_number:02d} {result['ip_address']:<15} {result['status']:<9} "
+                    f"{format_duration(result['duration'])}")
+    table = "\n".join(rows)
+    if len(table) > 3500:
+        # Для больших серверов в таблице оставляем только проблемные ПК
+        rows = rows[:1] + [row for row in rows[1:] if ' ok ' not in row]
+        table = "\n".join(rows) + f"\n... остальные {counts['ok']} ПК: ok"
+    
+    logs = []
+    for pc_number in sorted(results):
+        result = results[pc_number]
+        logs.append(f"===== PC-{pc_number:02d} ({result['ip_address']}) - {result['status']}, "
+                    f"код {result['exit_status']}, {format_duration(result['duration'])} =====\n"
+                    f"{result['output']}\n")
+    caption = f"🖥️ **{server_config['name']}**\nПолные логи массового обновления"
+    return header + f"```\n{table}\n```", "\n".join(logs), caption
+
+def send_mass_summary(chat_id, server_config, results, elapsed):
+    """Отправляет сводную таблицу массового обновления и полные логи файлом"""
+    summary, logs, caption = build_mass_summary(server_config, results, elapsed)
+    outbox.post_message(chat_id, summary, parse_mode='Markdown')
+    send_text_file(chat_id, logs, caption, file_name='mass_update.txt')
+
+# Описание задачи обновления для сообщений и /jobs
+def describe_update(pc_number=None, force=False, pc_numbers=None):
+    if pc_numbers:
+        return f"PC {format_pc_ranges(pc_numbers)} ({len(pc_numbers)} ПК, {'принудительное' if force else 'обычное'})"
+    if pc_number:
+        return f"PC-{pc_number} ({'принудительное' if force else 'обычное'})"
+    return "Все компьютеры"
+
+def format_pc_ranges(pc_numbers):
+    """Список ПК в виде диапазонов: [3, 4, 5, 8] -> '3-5, 8'"""
+    ranges = []
+    for pc_number in sorted(pc_numbers):
+        if ranges and pc_number == ranges[-1][1] + 1:
+            ranges[-1][1] = pc_number
+        else:
+            ranges.append([pc_number, pc_number])
+    return ', '.join(f"{start}-{end}" if end > start else str(start) for start, end in ranges)
+
+def parse_pc_selection(spec, computers_count):
+    """Разбирает выбор ПК вида '3-12,!7' (номера, диапазоны, исключения через '!').
+    Только исключения - все ПК сервера, кроме указанных. Возвращает отсортированный список
+    или бросает ValueError с описанием ошибки"""
+    include = set()
+    exclude = set()
+    for part in spec.replace(' ', '').split(','):
+        if not part:
+            continue
+        target = exclude if part.startswith('!') else include
+        bounds = part.lstrip('!').upper().replace('PC-', '')
+        first, separator, last = bounds.partition('-')
+        try:
+            start = int(first)
+            end = int(last) if separator else start
+        except ValueError:
+            raise ValueError(f"Неверный номер или диапазон ПК: `{part}`")
+        start, end = min(start, end), max(start, end)
+        if start < 1 or end > computers_count:
+            raise ValueError(f"ПК `{part}` вне диапазона 1-{computers_count}")
+        target.update(range(start, end + 1))
+    if exclude and not include:
+        include = set(range(1, computers_count + 1))
+    selected = sorted(include - exclude)
+    if not selected:
+        raise ValueError("Не выбрано ни одного ПК")
+    return selected
+
+UPDATE_USAGE = "Использование: /update <сервер> <ПК> [--force]\nПримеры: `/update 1 3-12,!7`, `/update server_2 5 --force`"
+
+def parse_update_args(user_id, text):
+    """Разбирает /update <сервер> <ПК> [--force]: возвращает (server_id, список ПК, force)
+    или бросает ValueError с текстом ответа"""
+    args = text.split()[1:]
+    force = '--force' in args
+    args = [arg for arg in args if arg != '--force']
+    if len(args) < 2:
+        raise ValueError(UPDATE_USAGE)
+    server_id = find_server(get_available_servers(user_id), args[0])
+    if server_id is None:
+        raise ValueError(f"❌ Сервер `{args[0]}` не найден\n\n{UPDATE_USAGE}")
+    try:
+        pc_numbers = parse_pc_selection(''.join(args[1:]), SERVERS_CONFIG[server_id]['computers_count'])
+    except ValueError as e:
+        raise ValueError(f"❌ {e}\n\n{UPDATE_USAGE}")
+    return server_id, pc_numbers, force
+
+def job_message_text(job, server_config, ahead=0):
+    """Текст сообщения о задаче: в очереди, запускается, выполняется или отменена"""
+    if job.status == 'cancelled':
+        return f"⛔ **Задача #{job.id}** отменена\n{server_config['name']}: {job.description}"
+    if ahead:
+        return (f"🕐 **Задача #{job.id}** поставлена в очередь\n"
+                f"{server_config['name']}: {job.description}\n"
+                f"Задач перед ней: {ahead}")
+    if job.status == 'running':
+        return f"▶️ **Задача #{job.id}** выполняется\n{server_config['name']}: {job.description}"
+    return f"▶️ **Задача #{job.id}** запускается\n{server_config['name']}: {job.description}"
+
+# Дедупликация одинаковых обновлений
+# Ожидающие и выполняющиеся обновления по ключу (сервер, ПК или выбранные ПК, режим)
+inflight_updates = {}
+inflight_lock = threading.Lock()
+
+def update_key(server_id, pc_number=None, force=False, pc_numbers=None):
+    return (server_id, tuple(pc_numbers) if pc_numbers else pc_number, 'force' if force else 'normal')
+
+def claim_update(key, chat_id, submit):
+    """Присоединяет запрос к такому же идущему обновлению (обычный запрос - и к принудительному)
+    или ставит новое: submit() вызывается под блокировкой, чтобы два одновременных запроса не запустили
+    fre.sh дважды. Принудительный запрос забирает подписчиков идущего обычного.
+    Возвращает (задача, запрос присоединен, замененная обычная задача или None)"""
+    server_id, target, mode = key
+    with inflight_lock:
+        job = inflight_updates.get((server_id, target, 'force'))
+        if job is None and mode == 'normal':
+            job = inflight_updates.get(key)
+        if job is not None:
+            if chat_id not in job.subscribers:
+                job.subscribers.append(chat_id)
+            return job, True, None
+        superseded = inflight_updates.pop((server_id, target, 'normal'), None) if mode == 'force' else None
+        job = submit()
+        if superseded is not None:
+            job.subscribers = list(dict.fromkeys(superseded.subscribers + job.subscribers))
+            superseded.subscribers = []
+        inflight_updates[key] = job
+    return job, False, superseded
+
+def close_subscription(job):
+    """Снимает задачу с учета и возвращает чаты для результата. Вызывается перед отправкой результата:
+    запрос, пришедший после этого, запустит обновление заново, а не останется без ответа"""
+    with inflight_lock:
+        for key in [key for key, claimed in inflight_updates.items() if claimed is job]:
+            del inflight_updates[key]
+        return list(job.subscribers)
+
+def result_chats(job, chat_id):
+    """Чаты, которым отправляется результат: подписчики задачи или только chat_id вне планировщика"""
+    return close_subscription(job) if job is not None else [chat_id]
+
+def notify_chats(chat_ids, text):
+    for chat_id in chat_ids:
+        outbox.post_message(chat_id, text, parse_mode='Markdown')
+
+def attached_message_text(job, server_config):
+    """Ответ на повторный запрос обновления, присоединенный к идущей задаче"""
+    state = "выполняется" if job.status == 'running' else "уже в очереди"
+    return (f"🔁 **Задача #{job.id}** с этим обновлением {state}\n"
+            f"{server_config['name']}: {job.description}\n"
+            f"Повторный запуск не нужен - результат придет и в этот чат")
+
+def superseded_message_text(job, new_job):
+    return f"⏫ **Задача #{job.id}** заменена принудительным обновлением (задача #{new_job.id})"
+
+def supersede_update(job, new_job):
+    """Отменяет обычное обновление, замененное принудительным, и сообщает об этом его подписчикам"""
+    update_dedup.inc(server=job.server_id, kind='superseded')
+    cancelled = job_scheduler.cancel(job.id)
+    text = superseded_message_text(job, new_job)
+    if cancelled is not None and cancelled.status == 'cancelled' and job.message_id:
+        # Задача не успела запуститься - сообщение о ней в очереди больше не актуально
+        outbox.edit_message_text(text, job.chat_id, job.message_id, parse_mode='Markdown')
+    notify_chats([chat_id for chat_id in new_job.subscribers if chat_id != new_job.chat_id], text)
+
+def cancel_markup(job):
+    """Кнопка отмены под сообщением о задаче"""
+    markup = types.InlineKeyboardMarkup()
+    markup.add(types.InlineKeyboardButton(
+        "⛔ Отменить", callback_data=callback_codec.encode('cancel_job', job.server_id, job_id=job.id)))
+    return markup
+
+def job_outcome(job):
+    """Итог задачи для журнала и метрик: done, failed, cancelled или timeout"""
+    if job.status in ('cancelled', 'timeout'):
+        return job.status
+    return 'done' if job.status == 'done' and job.result == 0 else 'failed'
+
+# Запись итога задачи в журнал
+def record_job_finish(job):
+    close_subscription(job)
+    # После обновления состояние ПК могло измениться
+    pc_probe.invalidate(job.server_id)
+    # Задача, отмененная в очереди, не запускалась
+    if job.started_at is not None:
+        job_wait_seconds.observe(job.started_at - job.created_at, server=job.server_id)
+        job_seconds.observe(job.finished_at - job.started_at, server=job.server_id)
+    outcome = job_outcome(job)
+    jobs_finished.inc(server=job.server_id, status=outcome)
+    if job_store is None:
+        return
+    job_store.finish(job.id, outcome, job.result, job.started_at, job.finished_at)
+
+def interrupted_jobs():
+    """Задачи из журнала, прерванные перезапуском. Задачи удаленных серверов и пользователей
+    без доступа отмечаются отмененными, остальные возвращаются для повторной постановки в очередь"""
+    if job_store is None:
+        return []
+    jobs = []
+    for row in job_store.unfinished():
+        if not JOB_RECOVER:
+            job_store.finish(row['id'], 'interrupted')
+        elif row['server_id'] not in SERVERS_CONFIG or not check_server_access(row['user_id'], row['server_id']):
+            job_store.finish(row['id'], 'cancelled')
+        else:
+            jobs.append(row)
+    return jobs
+
+def recover_jobs():
+    """Заново ставит в очередь задачи, прерванные перезапуском бота"""
+    for row in interrupted_jobs():
+        logger.info(f"Задача #{row['id']} прервана перезапуском, повторная постановка в очередь")
+        try:
+            outbox.send_message(row['chat_id'], f"♻️ **Задача #{row['id']}** была прервана перезапуском бота "
+                                                f"и поставлена в очередь заново", parse_mode='Markdown')
+        except Exception as e:
+            logger.error(f"Не удалось сообщить о перезапуске задачи #{row['id']}: {e}")
+        submit_update_job(row['chat_id'], row['server_id'], row['pc_number'], bool(row['force']),
+                          row['user_id'], job_id=row['id'], pc_numbers=stored_pc_numbers(row))
+
+def stored_pc_numbers(row):
+    """Список выбранных ПК задачи из журнала (None - один ПК или весь сервер)"""
+    return [int(number) for number in row['pc_numbers'].split(',')] if row.get('pc_numbers') else None
+
+# Функция для постановки обновления в очередь планировщика
+def submit_update_job(chat_id, server_id, pc_number=None, force=False, user_id=None, job_id=None, pc_numbers=None):
+    """Ставит обновление в очередь сервера и сообщает пользователю номер задачи и позицию.
+    pc_numbers - список ПК для обновления выбранных компьютеров одной задачей,
+    job_id - номер уже записанной в журнал задачи (при восстановлении после перезапуска)"""
+    if pc_numbers and len(pc_numbers) == 1:
+        # Один выбранный ПК - обычное обновление компьютера с полным выводом
+        pc_number, pc_numbers = pc_numbers[0], None
+    server_config = SERVERS_CONFIG[server_id]
+    description = describe_update(pc_number, force, pc_numbers)
+    ahead = 0
+    sent = Future()
+    
+    def submit():
+        nonlocal job_id, ahead
+        if job_id is None and job_store is not None:
+            job_id = job_store.add(server_id, pc_number, force, user_id, chat_id, description, pc_numbers)
+        job, ahead = job_scheduler.submit(server_id, description, job_func, chat_id=chat_id, user_id=user_id, job_id=job_id)
+        return job
+    
+    def job_func(job):
+        # Срок отсчитывается от запуска задачи, а не от постановки в очередь
+        job.cancel_token.set_timeout(UPDATE_TIMEOUT_PC if pc_number else UPDATE_TIMEOUT_ALL)
+        if not STREAM_OUTPUT:
+            show_job_running(job, server_config, sent)
+        # Ход выполнения показывается в сообщении о задаче (sent - Future его отправки)
+        return run_update(chat_id, server_id, pc_number, force, sent, pc_numbers, job)
+    
+    job, attached, superseded = claim_update(update_key(server_id, pc_number, force, pc_numbers), chat_id, submit)
+    if attached:
+        # Такое обновление уже идет - второй fre.sh не запускаем, результат придет всем подписчикам
+        update_dedup.inc(server=server_id, kind='attached')
+        logger.info(f"Повторный запрос {server_id}: {description} присоединен к задаче #{job.id}")
+        outbox.post_message(chat_id, attached_message_text(job, server_config), parse_mode='Markdown')
+        return job
+    if superseded is not None:
+        supersede_update(superseded, job)
+    post_job_message(job, server_config, ahead, sent)
+    return job
+
+def post_job_message(job, server_config, ahead, sent):
+    """Отправляет сообщение о задаче в фоне; sent (Future) получает отправленное сообщение -
+    задача может стартовать раньше, чем оно уйдет"""
+    def message_sent(future):
+        if future.exception() is not None:
+            sent.set_exception(future.exception())
+            return
+        job.message_id = future.result().message_id
+        if job.status == 'cancelled':
+            # Задачу заменили или отменили раньше, чем ушло сообщение о ней
+            outbox.edit_message_text(job_message_text(job, server_config), job.chat_id, job.message_id,
+                                     parse_mode='Markdown')
+        sent.set_result(future.result())
+    
+    outbox.post_message(job.chat_id, job_message_text(job, server_config, ahead), reply_markup=cancel_markup(job),
+                        parse_mode='Markdown').add_done_callback(message_sent)
+
+def show_job_running(job, server_config, sent):
+    """Показывает в сообщении о задаче, что она выполняется (когда сообщение уйдет)"""
+    text = job_message_text(job, server_config)
+    sent.add_done_callback(lambda future: future.exception() is None and outbox.edit_message_text(
+        text, job.chat_id, future.result().message_id, reply_markup=cancel_markup(job), parse_mode='Markdown'))
+
+# Функция для построения меню выбора режима обновления
+def build_update_mode_menu(server_id, pc_number):
+    """Строит текст и клавиатуру выбора режима обновления для конкретного компьютера"""
     server_config = SERVERS_CONFIG[server_id]
     ip_address = number_to_ip(server_config, pc_number)
     
@@ -393,9 +1496,9 @@ def show_update_mode_menu(chat_id, server_id, pc_number, message_id=None):
     
     # Кнопки выбора режима (убран "Главное меню")
     buttons = [
-        types.InlineKeyboardButton("🔄 Обычное обновление", callback_data=f"update_normal:{server_id}:{pc_number}"),
-        types.InlineKeyboardButton("⚠️ Принудительное обновление", callback_data=f"update_force_confirm:{server_id}:{pc_number}"),
-        types.InlineKeyboardButton("◀️ Назад к компьютерам", callback_data=f"back_to_computers:{server_id}"),
+        types.InlineKeyboardButton("🔄 Обычное обновление", callback_data=callback_codec.encode('update_normal', server_id, pc_number)),
+        types.InlineKeyboardButton("⚠️ Принудительное обновление", callback_data=callback_codec.encode('update_force_confirm', server_id, pc_number)),
+        types.InlineKeyboardButton("◀️ Назад к компьютерам", callback_data=callback_codec.encode('back_to_computers', server_id)),
     ]
     
     markup.add(buttons[0], buttons[1])
@@ -408,8 +1511,15 @@ def show_update_mode_menu(chat_id, server_id, pc_number, message_id=None):
             f"*Обычное обновление* - стандартный процесс обновления\n"
             f"*Принудительное обновление* - может привести к нестабильности!")
     
+    return text, markup
+
+# Функция для показа меню выбора режима обновления
+def show_update_mode_menu(chat_id, server_id, pc_number, message_id=None):
+    """Показывает меню выбора режима обновления для конкретного компьютера"""
+    text, markup = build_update_mode_menu(server_id, pc_number)
+    
     if message_id:
-        bot.edit_message_text(
+        outbox.edit_message_text(
             text,
             chat_id,
             message_id,
@@ -417,24 +1527,24 @@ def show_update_mode_menu(chat_id, server_id, pc_number, message_id=None):
             parse_mode='Markdown'
         )
     else:
-        bot.send_message(
+        outbox.send_message(
             chat_id,
             text,
             reply_markup=markup,
             parse_mode='Markdown'
         )
 
-# Функция для подтверждения принудительного обновления
-def show_force_confirmation(chat_id, server_id, pc_number, message_id):
-    """Показывает подтверждение для принудительного обновления"""
+# Функция для построения подтверждения принудительного обновления
+def build_force_confirmation(server_id, pc_number):
+    """Строит текст и клавиатуру подтверждения принудительного обновления"""
     server_config = SERVERS_CONFIG[server_id]
     ip_address = number_to_ip(server_config, pc_number)
     
     markup = types.InlineKeyboardMarkup(row_width=2)
     
     buttons = [
-        types.InlineKeyboardButton("✅ Да, запустить принудительно", callback_data=f"force_update:{server_id}:{pc_number}"),
-        types.InlineKeyboardButton("❌ Отмена", callback_data=f"back_to_mode:{server_id}:{pc_number}")
+        types.InlineKeyboardButton("✅ Да, запустить принудительно", callback_data=callback_codec.encode('force_update', server_id, pc_number)),
+        types.InlineKeyboardButton("❌ Отмена", callback_data=callback_codec.encode('back_to_mode', server_id, pc_number))
     ]
     
     markup.add(buttons[0])
@@ -452,7 +1562,14 @@ def show_force_confirmation(chat_id, server_id, pc_number, message_id):
                     f"• Непредсказуемому поведению\n\n"
                     f"Вы уверены, что хотите продолжить?")
     
-    bot.edit_message_text(
+    return warning_text, markup
+
+# Функция для подтверждения принудительного обновления
+def show_force_confirmation(chat_id, server_id, pc_number, message_id):
+    """Показывает подтверждение для принудительного обновления"""
+    warning_text, markup = build_force_confirmation(server_id, pc_number)
+    
+    outbox.edit_message_text(
         warning_text,
         chat_id,
         message_id,
@@ -460,13 +1577,36 @@ def show_force_confirmation(chat_id, server_id, pc_number, message_id):
         parse_mode='Markdown'
     )
 
-# Главное меню
-@bot.message_handler(commands=['start', 'help'])
-@access_check_message
-def send_welcome(message):
-    user_id = message.from_user.id
-    print(f"👤 Пользователь {user_id} ({message.from_user.first_name}) запустил бота")
+# Подтверждение принудительного обновления выбранных компьютеров
+def build_selected_force_confirmation(server_id, pc_numbers):
+    """Строит текст и клавиатуру подтверждения принудительного обновления выбранных ПК"""
+    server_config = SERVERS_CONFIG[server_id]
+    
+    markup = types.InlineKeyboardMarkup(row_width=1)
+    markup.add(types.InlineKeyboardButton(f"✅ Да, запустить принудительно ({len(pc_numbers)} ПК)",
+                                          callback_data=callback_codec.encode('force_selected', server_id)))
+    markup.add(types.InlineKeyboardButton("❌ Отмена", callback_data=callback_codec.encode('back_to_computers', server_id)))
+    
+    warning_text = (f"⚠️ **ВНИМАНИЕ: Принудительное обновление!**\n\n"
+                    f"Сервер: {server_config['name']}\n"
+                    f"Компьютеры: PC {format_pc_ranges(pc_numbers)} ({len(pc_numbers)} ПК)\n\n"
+                    f"Закройте на выбранных компьютерах\n"
+                    f"все открытые приложения, лаунчеры и игры!\n"
+                    f"**Иначе обновление может привести к:**\n"
+                    f"• Вылету игр\n"
+                    f"• Ошибкам диска\n"
+                    f"• Непредсказуемому поведению\n\n"
+                    f"Вы уверены, что хотите продолжить?")
     
+    return warning_text, markup
+
+# Тексты и клавиатуры, общие для синхронной и асинхронной среды выполнения
+ACCESS_DENIED_TEXT = "❌ Доступ запрещен. Ваш ID: {user_id}\n\nДля получения доступа предоставьте этот ID администратору."
+NO_SERVERS_TEXT = "❌ **Нет доступных серверов**\n\nОбратитесь к администратору для получения доступа."
+SERVER_ACCESS_DENIED_TEXT = "❌ **Доступ запрещен**\n\nУ вас нет доступа к этому серверу."
+
+def build_welcome(user_id):
+    """Строит приветствие и основную клавиатуру"""
     # Получаем доступные серверы для пользователя
     available_servers = get_available_servers(user_id)
     total_computers = sum(server['computers_count'] for server in available_servers.values())
@@ -491,44 +1631,205 @@ def send_welcome(message):
     if not available_servers:
         servers_info = "• ❌ Нет доступных серверов\n"
     
-    bot.send_message(
-        message.chat.id,
-        f"🤖 **Бот управления TrueNAS серверами**\n\n"
-        f"Серверов: {len(available_servers)}\n"
-        f"Компьютеров: {total_computers}\n\n"
-        f"{servers_info}",
-        reply_markup=markup,
-        parse_mode='Markdown'
-    )
+    text = (f"🤖 **Бот управления TrueNAS серверами**\n\n"
+            f"Серверов: {len(available_servers)}\n"
+            f"Компьютеров: {total_computers}\n\n"
+            f"{servers_info}")
+    return text, markup
+
+def build_my_id(user_id):
+    return (f"🆔 Ваш Telegram ID: `{user_id}`\n\n"
+            f"Для получения доступа к боту предоставьте этот ID администратору.")
+
+def build_jobs_text(user_id, running, queued):
+    """Строит список выполняющихся и ожидающих задач по доступным пользователю серверам"""
+    available_servers = get_available_servers(user_id)
+    running = [job for job in running if job.server_id in available_servers]
+    queued = [job for job in queued if job.server_id in available_servers]
+    
+    text = "📋 **Задачи обновления**\n\n"
+    if not running and not queued:
+        text += "Нет выполняющихся и ожидающих задач"
+    
+    if running:
+        text += "*Выполняются:*\n"
+        for job in running:
+            text += f"▶️ #{job.id} {available_servers[job.server_id]['name']}: {job.description} — {format_duration(job.elapsed())}\n"
+        text += "\n"
+    
+    if queued:
+        text += "*В очереди:*\n"
+        for job in queued:
+            text += f"🕐 #{job.id} {available_servers[job.server_id]['name']}: {job.description} — ждет {format_duration(job.elapsed())}\n"
+    
+    return text
+
+# Гистограммы, которые показывает /stats, и их заголовки
+STATS_HISTOGRAMS = (
+    (ssh_seconds, "SSH"),
+    (telegram_seconds, "Telegram API"),
+    (send_result_seconds, "Отправка результата"),
+    (callback_seconds, "Обработка кнопок"),
+    (job_wait_seconds, "Ожидание в очереди"),
+    (job_seconds, "Выполнение задач"),
+)
+
+def format_seconds(seconds):
+    return f"{seconds * 1000:.0f}мс" if seconds < 0.9995 else f"{seconds:.2f}с"
+
+def build_stats_text():
+    """Перцентили p50/p95/p99 по последним замерам каждой метрики и текущее состояние бота"""
+    running, queued = job_scheduler.snapshot()
+    sessions = session_store.stats()
+    lines = [
+        "📈 **Статистика бота**",
+        "",
+        "Запуск: " + (", ".join(f"{STARTUP_PHASES[phase]} {seconds:.2f} с" for phase, seconds in startup_timings.items()) or "нет данных"),
+        f"Потоков: {threading.active_count()}, задач: {len(running)} выполняется, {len(queued)} в очереди",
+        f"Очередь отправки в Telegram: {outbox.pending()}",
+        f"Состояния пользователей: {sessions['size']}, попаданий {sessions['hits']}, промахов {sessions['misses']}, "
+        f"вытеснено {sessions['evictions']}, устарело {sessions['expired']}",
+    ]
+    for histogram, title in STATS_HISTOGRAMS:
+        series = histogram.percentiles()
+        if not series:
+            continue
+        lines += ["", f"*{title}* (p50 / p95 / p99):"]
+        for labels, (count, values) in series.items():
+            lines.append(f"`{' '.join(labels)}` ×{count}: {' / '.join(format_seconds(value) for value in values)}")
+    return "\n".join(lines)
+
+HISTORY_STATUS_ICONS = {'done': '✅', 'failed': '❌', 'queued': '🕐', 'cancelled': '⛔', 'timeout': '⏱️',
+                        'interrupted': '⚠️'}
+
+def find_server(servers, name):
+    """Ищет сервер по id (server_1), номеру (1) или имени без учета регистра"""
+    name = name.strip().lower()
+    for server_id, config in servers.items():
+        if name in (server_id, server_id.replace('server_', ''), config['name'].lower()):
+            return server_id
+    return None
+
+def build_history_text(user_id, text):
+    """Последние задачи по доступным пользователю серверам: /history [сервер] [ПК]"""
+    if job_store is None:
+        return "📜 История задач отключена (не задан JOB_DB_PATH)"
+    
+    available_servers = get_available_servers(user_id)
+    args = text.split()[1:]
+    server_id = None
+    pc_number = None
+    if args:
+        server_id = find_server(available_servers, args[0])
+        if server_id is None:
+            return f"❌ Сервер `{args[0]}` не найден\n\nИспользование: /history [сервер] [ПК]"
+    if len(args) > 1:
+        try:
+            pc_number = int(args[1].upper().replace('PC-', ''))
+        except ValueError:
+            return f"❌ Неверный номер компьютера: `{args[1]}`\n\nИспользование: /history [сервер] [ПК]"
+    
+    if server_id is not None:
+        server_ids = [server_id]
+    elif len(available_servers) == len(SERVERS_CONFIG):
+        # Доступ ко всем серверам - фильтр не нужен, запрос идет по индексу времени
+        server_ids = None
+    else:
+        server_ids = list(available_servers)
+    rows = job_store.history(server_ids, pc_number, limit=20)
+    
+    title = "📜 **История задач**"
+    if server_id is not None:
+        title += f" — {available_servers[server_id]['name']}" + (f", PC-{pc_number}" if pc_number else "")
+    if not rows:
+        return title + "\n\nЗадач не найдено"
+    
+    lines = [title, ""]
+    for row in rows:
+        server_name = SERVERS_CONFIG[row['server_id']]['name'] if row['server_id'] in SERVERS_CONFIG else f"`{row['server_id']}`"
+        duration = ""
+        if row['started_at'] and row['finished_at']:
+            duration = f", {format_duration(row['finished_at'] - row['started_at'])}"
+        exit_status = f", код {row['exit_status']}" if row['exit_status'] not in (None, 0) else ""
+        lines.append(f"{HISTORY_STATUS_ICONS.get(row['status'], '▶️')} #{row['id']} "
+                     f"{time.strftime('%d.%m %H:%M', time.localtime(row['created_at']))} "
+                     f"{server_name}: {row['description']}{exit_status}{duration}, ID {row['user_id']}")
+    return "\n".join(lines)
+
+# Главное меню
+@bot.message_handler(commands=['start', 'help'])
+@access_check_message
+def send_welcome(message):
+    user_id = message.from_user.id
+    print(f"👤 Пользователь {user_id} ({message.from_user.first_name}) запустил бота")
+    
+    text, markup = build_welcome(user_id)
+    outbox.send_message(message.chat.id, text, reply_markup=markup, parse_mode='Markdown')
 
 # Команда для получения своего ID
 @bot.message_handler(commands=['myid'])
 def show_my_id(message):
-    user_id = message.from_user.id
-    bot.reply_to(
-        message,
-        f"🆔 Ваш Telegram ID: `{user_id}`\n\n"
-        f"Для получения доступа к боту предоставьте этот ID администратору.",
-        parse_mode='Markdown'
-    )
+    outbox.reply_to(message, build_my_id(message.from_user.id), parse_mode='Markdown')
 
-# Функции меню
-def send_servers_menu(chat_id, page=0, edit_message_id=None):
-    """Отправляет меню выбора сервера"""
-    user_id = chat_id
-    available_servers = get_available_servers(user_id)
-    
-    # Если нет доступных серверов
-    if not available_servers:
-        text = "❌ **Нет доступных серверов**\n\nОбратитесь к администратору для получения доступа."
-        if edit_message_id:
-            bot.edit_message_text(text, chat_id, edit_message_id, parse_mode='Markdown')
-        else:
-            bot.send_message(chat_id, text, parse_mode='Markdown')
+# Команда для просмотра очереди задач
+@bot.message_handler(commands=['jobs'])
+@access_check_message
+def show_jobs(message):
+    running, queued = job_scheduler.snapshot()
+    outbox.send_message(message.chat.id, build_jobs_text(message.from_user.id, running, queued), parse_mode='Markdown')
+
+# Статистика и перцентили задержек (только для администраторов)
+@bot.message_handler(commands=['stats'])
+@access_check_message
+def show_stats(message):
+    if not is_admin(message.from_user.id):
+        outbox.reply_to(message, "❌ Команда доступна только администраторам")
         return
-    
-    servers_list = list(available_servers.items())
-    servers_per_page = 6
+    for part in split_output(build_stats_text(), RESULT_MESSAGE_LIMIT):
+        outbox.send_message(message.chat.id, part, parse_mode='Markdown')
+
+# История задач из журнала
+@bot.message_handler(commands=['history'])
+@access_check_message
+def show_history(message):
+    outbox.send_message(message.chat.id, build_history_text(message.from_user.id, message.text), parse_mode='Markdown')
+
+# Обновление выбранных компьютеров командой: /update <сервер> 3-12,!7 [--force]
+@bot.message_handler(commands=['update'])
+@access_check_message
+def update_from_command(message):
+    try:
+        server_id, pc_numbers, force = parse_update_args(message.from_user.id, message.text)
+    except ValueError as e:
+        outbox.send_message(message.chat.id, str(e), parse_mode='Markdown')
+        return
+    submit_update_job(message.chat.id, server_id, force=force, user_id=message.from_user.id, pc_numbers=pc_numbers)
+
+# Функции меню
+def server_health_icon(server_id):
+    """Значок доступности сервера по данным фоновой проверки"""
+    status = health_poller.get(server_id)
+    if status is None:
+        return "⚪"
+    return "✅" if status['online'] else "❌"
+
+# Кэш готовых меню: ключ -> (подпись состояния, текст, разметка)
+# Меню компьютеров строятся заранее при загрузке конфигурации, меню серверов - при первом запросе
+menu_cache = {}
+
+def invalidate_menu_cache():
+    """Сбрасывает кэш меню и заново строит меню компьютеров (вызывается при изменении конфигурации)"""
+    menu_cache.clear()
+    for server_id, server_config in SERVERS_CONFIG.items():
+        total_pages = max(1, math.ceil(server_config['computers_count'] / COMPUTERS_PER_PAGE))
+        for page in range(total_pages):
+            get_computers_menu(server_id, page)
+
+SERVERS_PER_PAGE = 6
+
+def render_servers_menu(servers_list, page, icons):
+    """Строит текст и клавиатуру страницы меню серверов"""
+    servers_per_page = SERVERS_PER_PAGE
     total_pages = math.ceil(len(servers_list) / servers_per_page)
     
     start_idx = page * servers_per_page
@@ -538,18 +1839,18 @@ def send_servers_menu(chat_id, page=0, edit_message_id=None):
     
     # Кнопки серверов
     for server_id, server_config in servers_list[start_idx:end_idx]:
-        btn_text = f"{server_config['name']} ({server_config['computers_count']})"
-        markup.add(types.InlineKeyboardButton(btn_text, callback_data=f"select_server:{server_id}"))
+        btn_text = f"{icons[server_id]} {server_config['name']} ({server_config['computers_count']})"
+        markup.add(types.InlineKeyboardButton(btn_text, callback_data=callback_codec.encode('select_server', server_id)))
     
     # Навигация
     nav_buttons = []
     if page > 0:
-        nav_buttons.append(types.InlineKeyboardButton("◀️", callback_data=f"servers_page:{page-1}"))
+        nav_buttons.append(types.InlineKeyboardButton("◀️", callback_data=callback_codec.encode('servers_page', page=page-1)))
     
-    nav_buttons.append(types.InlineKeyboardButton(f"{page+1}/{total_pages}", callback_data="current_page"))
+    nav_buttons.append(types.InlineKeyboardButton(f"{page+1}/{total_pages}", callback_data=callback_codec.encode('current_page')))
     
     if page < total_pages - 1:
-        nav_buttons.append(types.InlineKeyboardButton("▶️", callback_data=f"servers_page:{page+1}"))
+        nav_buttons.append(types.InlineKeyboardButton("▶️", callback_data=callback_codec.encode('servers_page', page=page+1)))
     
     if nav_buttons:
         markup.add(*nav_buttons)
@@ -561,22 +1862,24 @@ def send_servers_menu(chat_id, page=0, edit_message_id=None):
     for server_id, server_config in servers_list[start_idx:end_idx]:
         text += f"• {server_config['name']} - {server_config['computers_count']} компьютеров\n"
     
-    if edit_message_id:
-        bot.edit_message_text(text, chat_id, edit_message_id, reply_markup=markup, parse_mode='Markdown')
-    else:
-        bot.send_message(chat_id, text, reply_markup=markup, parse_mode='Markdown')
+    return text, markup
 
-def send_computers_menu(chat_id, server_id, page=0, edit_message_id=None):
-    """Отправляет меню компьютеров для выбранного сервера"""
-    # Проверяем доступ к серверу
-    if not check_server_access(chat_id, server_id):
-        text = "❌ **Доступ запрещен**\n\nУ вас нет доступа к этому серверу."
-        if edit_message_id:
-            bot.edit_message_text(text, chat_id, edit_message_id, parse_mode='Markdown')
-        else:
-            bot.send_message(chat_id, text, parse_mode='Markdown')
-        return
-    
+def get_servers_menu(available_servers, page):
+    """Возвращает меню серверов из кэша; перестраивает его, только если изменились значки доступности"""
+    # Статус берется из кэша фоновой проверки, без SSH в обработчике
+    icons = {server_id: server_health_icon(server_id) for server_id in available_servers}
+    signature = tuple(icons.values())
+    key = ('servers', tuple(available_servers), page)
+    cached = menu_cache.get(key)
+    if cached is None or cached[0] != signature:
+        cached = (signature,) + render_servers_menu(list(available_servers.items()), page, icons)
+        menu_cache[key] = cached
+    return cached[1], cached[2]
+
+def render_computers_menu(server_id, page, states=None, checking=False, selected=None):
+    """Строит текст и клавиатуру страницы меню компьютеров сервера.
+    states - {номер ПК: состояние} для значков на кнопках, checking - проверка еще идет,
+    selected - отмеченные ПК в режиме выбора нескольких компьютеров (None - обычный режим)"""
     server_config = SERVERS_CONFIG[server_id]
     total_computers = server_config['computers_count']
     
@@ -590,9 +1893,14 @@ def send_computers_menu(chat_id, server_id, page=0, edit_message_id=None):
     # Кнопки компьютеров
     buttons = []
     for i in range(start_idx, end_idx + 1):
-        ip_address = number_to_ip(server_config, i)
-        button_text = f"PC-{i:02d}" if ip_address else f"PC-{i:02d}"
-        buttons.append(types.InlineKeyboardButton(button_text, callback_data=f"select_pc:{server_id}:{i}"))
+        icon = PC_STATE_ICONS.get(states.get(i), '❔') + ' ' if states is not None else ''
+        if selected is None:
+            callback_data = callback_codec.encode('select_pc', server_id, i)
+        else:
+            # В режиме выбора кнопка отмечает ПК
+            icon = ('✅ ' if i in selected else '') + icon
+            callback_data = callback_codec.encode('toggle_pc', server_id, i)
+        buttons.append(types.InlineKeyboardButton(f"{icon}PC-{i:02d}", callback_data=callback_data))
     
     for i in range(0, len(buttons), 4):
         markup.add(*buttons[i:i+4])
@@ -600,37 +1908,255 @@ def send_computers_menu(chat_id, server_id, page=0, edit_message_id=None):
     # Навигация
     nav_buttons = []
     if page > 0:
-        nav_buttons.append(types.InlineKeyboardButton("◀️", callback_data=f"computers_page:{server_id}:{page-1}"))
+        nav_buttons.append(types.InlineKeyboardButton("◀️", callback_data=callback_codec.encode('computers_page', server_id, page=page-1)))
     
-    nav_buttons.append(types.InlineKeyboardButton(f"{page+1}/{total_pages}", callback_data="current_page"))
+    nav_buttons.append(types.InlineKeyboardButton(f"{page+1}/{total_pages}", callback_data=callback_codec.encode('current_page')))
     
     if page < total_pages - 1:
-        nav_buttons.append(types.InlineKeyboardButton("▶️", callback_data=f"computers_page:{server_id}:{page+1}"))
+        nav_buttons.append(types.InlineKeyboardButton("▶️", callback_data=callback_codec.encode('computers_page', server_id, page=page+1)))
     
     markup.add(*nav_buttons)
     
     # Действия (убран "Главное меню")
-    action_buttons = [
-        types.InlineKeyboardButton("🔄 Обновить все компьютеры", callback_data=f"update_server:{server_id}"),
-        types.InlineKeyboardButton("◀️ К серверам", callback_data="back_to_servers"),
-    ]
-    markup.add(action_buttons[0])
-    markup.add(action_buttons[1])  # Только кнопка "К серверам"
+    if selected is None:
+        markup.add(types.InlineKeyboardButton("🔄 Обновить все компьютеры", callback_data=callback_codec.encode('update_server', server_id)))
+        markup.add(types.InlineKeyboardButton("☑️ Выбрать несколько", callback_data=callback_codec.encode('multi_select', server_id)))
+    else:
+        if selected:
+            markup.add(
+                types.InlineKeyboardButton(f"🔄 Обновить выбранные ({len(selected)})", callback_data=callback_codec.encode('update_selected', server_id)),
+                types.InlineKeyboardButton("⚠️ Принудительно", callback_data=callback_codec.encode('selected_force_confirm', server_id)),
+            )
+        markup.add(types.InlineKeyboardButton("✖️ Отменить выбор", callback_data=callback_codec.encode('multi_select', server_id)))
+    markup.add(types.InlineKeyboardButton("◀️ К серверам", callback_data=callback_codec.encode('back_to_servers')))
     
     text = (f"🖥️ **{server_config['name']}**\n"
             f"*Компьютеры {start_idx}-{end_idx} из {total_computers}*\n"
             f"*Расположение: {server_config['location']}*")
+    if selected is not None:
+        text += (f"\n\n☑️ Отметьте компьютеры (можно на разных страницах)\n"
+                 f"Выбрано: {f'PC {format_pc_ranges(selected)}' if selected else 'ничего'}")
+    if states is not None:
+        text += "\n\n🟢 свободен  🔴 занят  ⚫ выключен"
+    elif checking:
+        text += "\n\n⏳ Проверка состояния ПК..."
+    
+    return text, markup
+
+def get_computers_menu(server_id, page, states=None, checking=False, selected=None):
+    """Возвращает меню компьютеров из кэша; перестраивает его, только если изменились состояния ПК.
+    Меню режима выбора зависит от пользователя и не кэшируется"""
+    if selected is not None:
+        return render_computers_menu(server_id, page, states, checking, selected)
+    signature = (tuple(sorted(states.items())) if states is not None else None, checking)
+    key = ('computers', server_id, page)
+    cached = menu_cache.get(key)
+    if cached is None or cached[0] != signature:
+        cached = (signature,) + render_computers_menu(server_id, page, states, checking)
+        menu_cache[key] = cached
+    return cached[1], cached[2]
+
+def get_selection(chat_id, server_id):
+    """ПК, отмеченные пользователем на сервере, или None, если режим выбора не включен"""
+    state = session_store.get(chat_id) or {}
+    if state.get('selection_server') != server_id:
+        return None
+    return set(state.get('selected_pcs', ()))
+
+def toggle_selection(chat_id, server_id, pc_number):
+    """Отмечает ПК или снимает отметку, возвращает новое множество выбранных ПК"""
+    selected = get_selection(chat_id, server_id) or set()
+    selected ^= {pc_number}
+    session_store.update(chat_id, selection_server=server_id, selected_pcs=sorted(selected))
+    return selected
+
+def clear_selection(chat_id):
+    session_store.update(chat_id, selection_server=None, selected_pcs=None)
+
+def page_computers(server_config, page):
+    """{номер ПК: IP} для страницы меню компьютеров"""
+    start_idx = page * COMPUTERS_PER_PAGE + 1
+    end_idx = min((page + 1) * COMPUTERS_PER_PAGE, server_config['computers_count'])
+    return {pc_number: number_to_ip(server_config, pc_number) for pc_number in range(start_idx, end_idx + 1)}
+
+def run_probe_command(server_config, command):
+    """Выполняет проверку состояния ПК на сервере и возвращает вывод"""
+    with ssh_seconds.time(server=server_config['id'], operation='pc_probe'):
+        return ssh_execute(server_config, command, PC_PROBE_TIMEOUT)
+
+# Сообщения с меню компьютеров, ожидающие результата проверки ПК: (чат, сообщение) -> метка показа.
+# Нажатие любой кнопки в сообщении снимает метку, и результат проверки его уже не перезапишет
+pending_probe_views = {}
+
+def last_menu(chat_id):
+    """Меню, на котором пользователь остановился: (server_id, страница компьютеров)
+    или (None, страница серверов). Сервер без доступа или удаленный не восстанавливается"""
+    state = session_store.get(chat_id) or {}
+    server_id = state.get('current_server')
+    if server_id in SERVERS_CONFIG and check_server_access(chat_id, server_id):
+        total_pages = max(1, math.ceil(SERVERS_CONFIG[server_id]['computers_count'] / COMPUTERS_PER_PAGE))
+        return server_id, min(state.get('computers_page', 0), total_pages - 1)
+    total_pages = max(1, math.ceil(len(get_available_servers(chat_id)) / SERVERS_PER_PAGE))
+    return None, min(state.get('servers_page', 0), total_pages - 1)
+
+def current_computers_page(chat_id, server_id):
+    """Страница меню компьютеров сервера, открытая у пользователя"""
+    menu_server_id, page = last_menu(chat_id)
+    return page if menu_server_id == server_id else 0
+
+def send_last_menu(chat_id):
+    """Открывает меню, на котором пользователь остановился (в том числе до перезапуска бота)"""
+    server_id, page = last_menu(chat_id)
+    if server_id is not None:
+        send_computers_menu(chat_id, server_id, page)
+    else:
+        send_servers_menu(chat_id, page)
+
+def send_servers_menu(chat_id, page=0, edit_message_id=None):
+    """Отправляет меню выбора сервера"""
+    user_id = chat_id
+    available_servers = get_available_servers(user_id)
+    
+    # Если нет доступных серверов
+    if not available_servers:
+        text = NO_SERVERS_TEXT
+        if edit_message_id:
+            outbox.edit_message_text(text, chat_id, edit_message_id, parse_mode='Markdown')
+        else:
+            outbox.send_message(chat_id, text, parse_mode='Markdown')
+        return
+    
+    text, markup = get_servers_menu(available_servers, page)
     
     if edit_message_id:
-        bot.edit_message_text(text, chat_id, edit_message_id, reply_markup=markup, parse_mode='Markdown')
+        outbox.edit_message_text(text, chat_id, edit_message_id, reply_markup=markup, parse_mode='Markdown')
     else:
-        bot.send_message(chat_id, text, reply_markup=markup, parse_mode='Markdown')
+        outbox.send_message(chat_id, text, reply_markup=markup, parse_mode='Markdown')
+
+def send_computers_menu(chat_id, server_id, page=0, edit_message_id=None):
+    """Отправляет меню компьютеров для выбранного сервера"""
+    # Проверяем доступ к серверу
+    if not check_server_access(chat_id, server_id):
+        text = SERVER_ACCESS_DENIED_TEXT
+        if edit_message_id:
+            outbox.edit_message_text(text, chat_id, edit_message_id, parse_mode='Markdown')
+        else:
+            outbox.send_message(chat_id, text, parse_mode='Markdown')
+        return
+    
+    states = pc_probe.get(server_id, page) if pc_probe.enabled else None
+    checking = pc_probe.enabled and states is None
+    text, markup = get_computers_menu(server_id, page, states, checking, get_selection(chat_id, server_id))
+    
+    if edit_message_id:
+        outbox.edit_message_text(text, chat_id, edit_message_id, reply_markup=markup, parse_mode='Markdown')
+        message_id = edit_message_id
+    else:
+        message_id = outbox.send_message(chat_id, text, reply_markup=markup, parse_mode='Markdown').message_id
+    
+    if checking:
+        # Меню уже показано, значки состояния появятся после проверки
+        view = pending_probe_views[(chat_id, message_id)] = object()
+        
+        def on_probe_done(states):
+            if pending_probe_views.get((chat_id, message_id)) is not view:
+                return
+            del pending_probe_views[(chat_id, message_id)]
+            text, markup = get_computers_menu(server_id, page, states, selected=get_selection(chat_id, server_id))
+            outbox.edit_message_text(text, chat_id, message_id, reply_markup=markup, parse_mode='Markdown')
+        
+        pc_probe.request(server_id, page, SERVERS_CONFIG[server_id], page_computers(SERVERS_CONFIG[server_id], page), on_probe_done)
+
+# Проверка доступности сервера для статуса
+def probe_server(server_config):
+    """Проверяет сервер с коротким дедлайном и возвращает время подключения и отклика"""
+    try:
+        connect_time, rtt = ssh_probe(server_config, STATUS_PROBE_TIMEOUT)
+        return {'online': True, 'connect_time': connect_time, 'rtt': rtt}
+    except Exception as e:
+        logger.warning(f"Сервер {server_config['name']} недоступен: {e}")
+        return {'online': False, 'error': 'таймаут' if isinstance(e, socket.timeout) else 'нет соединения'}
+
+# Прогрев SSH соединений при запуске
+def warmup_result(server_config, connect_time, rtt, error=None):
+    """Пишет в лог готовность сервера после прогрева и возвращает статус для health_poller"""
+    if error is not None:
+        # Ошибку выводим полностью: неверный адрес или пароль видно сразу после запуска
+        logger.error(f"❌ {server_config['name']}: SSH недоступен при запуске: {error}")
+        return {'online': False, 'error': 'таймаут' if isinstance(error, (socket.timeout, TimeoutError)) else 'нет соединения'}
+    handshake = "соединение уже открыто" if connect_time is None else f"рукопожатие {connect_time * 1000:.0f} мс"
+    logger.info(f"✅ {server_config['name']}: SSH готов ({handshake}, отклик {rtt * 1000:.0f} мс)")
+    return {'online': True, 'connect_time': connect_time, 'rtt': rtt}
+
+def warmup_finished(statuses, elapsed):
+    online = sum(1 for status in statuses if status['online'])
+    logger.info(f"Прогрев SSH: готово {online} из {len(statuses)} серверов за {elapsed:.2f} с")
+    mark_startup('ssh_warmup')
+
+def warm_up_server(server_config):
+    try:
+        connect_time, rtt = ssh_probe(server_config, SSH_CONNECT_TIMEOUT)
+    except Exception as e:
+        return warmup_result(server_config, None, None, e)
+    return warmup_result(server_config, connect_time, rtt)
+
+def warm_up_servers():
+    """Параллельно подключается ко всем серверам, сохраняет их статус и затем запускает фоновую проверку"""
+    servers = dict(SERVERS_CONFIG)
+    started = time.monotonic()
+    statuses = []
+    if servers:
+        with ThreadPoolExecutor(max_workers=min(SSH_WARMUP_WORKERS, len(servers)), thread_name_prefix='ssh-warmup') as executor:
+            futures = {executor.submit(warm_up_server, config): server_id for server_id, config in servers.items()}
+            for future in as_completed(futures):
+                statuses.append(health_poller.record(futures[future], future.result()))
+    warmup_finished(statuses, time.monotonic() - started)
+    # Фоновая проверка начинается после прогрева, чтобы не подключаться к серверам дважды
+    health_poller.start()
+
+def format_age(timestamp):
+    """Человекочитаемое время, прошедшее с момента timestamp"""
+    age = int(time.time() - timestamp)
+    if age < 60:
+        return f"{age} с назад"
+    if age < 3600:
+        return f"{age // 60} мин назад"
+    return f"{age // 3600} ч назад"
+
+def render_global_status(servers, results):
+    """Формирует текст статуса серверов; непроверенные серверы помечаются как ожидающие"""
+    status_text = "📊 **Статус всех серверов**\n\n"
+    
+    for server_id, config in servers.items():
+        result = results.get(server_id)
+        if result is None:
+            status_icon = "⏳"
+            status_text_online = "Проверка..."
+        elif result['online']:
+            status_icon = "✅"
+            connect = "соединение открыто" if result['connect_time'] is None else f"подключение {result['connect_time'] * 1000:.0f} мс"
+            status_text_online = f"Онлайн ({connect}, отклик {result['rtt'] * 1000:.0f} мс)"
+        else:
+            status_icon = "❌"
+            status_text_online = f"Офлайн ({result['error']})"
+        
+        status_text += f"{status_icon} {config['name']}\n"
+        status_text += f"   Компьютеров: {config['computers_count']}\n"
+        status_text += f"   Статус: {status_text_online}\n"
+        if result is not None:
+            status_text += f"   Проверено: {format_age(result['checked_at'])}\n"
+            if not result['online']:
+                last_seen = format_age(result['last_seen']) if result.get('last_seen') else "не было"
+                status_text += f"   Последний отклик: {last_seen}\n"
+        status_text += f"   Расположение: {config['location']}\n\n"
+    
+    return status_text
 
 # Обработчики сообщений
 @bot.message_handler(func=lambda message: message.text == '🔄 Обновить датасеты')
 @access_check_message
 def show_servers_menu(message):
-    send_servers_menu(message.chat.id)
+    send_last_menu(message.chat.id)
 
 @bot.message_handler(func=lambda message: message.text == '📊 Статус всех серверов')
 @access_check_message
@@ -638,33 +2164,52 @@ def show_global_status(message):
     user_id = message.from_user.id
     available_servers = get_available_servers(user_id)
     
-    status_text = "📊 **Статус всех серверов**\n\n"
+    if not available_servers:
+        outbox.send_message(message.chat.id, "📊 **Статус всех серверов**\n\n❌ Нет доступных серверов", parse_mode='Markdown')
+        return
     
-    for server_id, config in available_servers.items():
-        # Упрощенная проверка доступности сервера
-        try:
-            test_command = "echo 'test'"
-            success, _ = run_ssh_command(config, test_command)
-            status_icon = "✅" if success else "❌"
-            status_text_online = "Онлайн" if success else "Офлайн"
-        except:
-            status_icon = "❌"
-            status_text_online = "Офлайн"
-        
-        status_text += f"{status_icon} {config['name']}\n"
-        status_text += f"   Компьютеров: {config['computers_count']}\n"
-        status_text += f"   Статус: {status_text_online}\n"
-        status_text += f"   Расположение: {config['location']}\n\n"
+    # Сначала берем статусы из кэша фоновой проверки
+    results = {}
+    for server_id in available_servers:
+        status = health_poller.get(server_id)
+        if status is not None:
+            results[server_id] = status
     
-    if not available_servers:
-        status_text += "❌ Нет доступных серверов"
+    status_message = outbox.send_message(
+        message.chat.id,
+        render_global_status(available_servers, results),
+        parse_mode='Markdown'
+    )
+    missing = {server_id: config for server_id, config in available_servers.items() if server_id not in results}
+    if not missing:
+        return
     
-    bot.send_message(message.chat.id, status_text, parse_mode='Markdown')
+    # Серверы без свежего статуса проверяем параллельно и показываем результаты по мере поступления
+    futures = {status_executor.submit(probe_server, config): server_id
+               for server_id, config in missing.items()}
+    last_edit = time.monotonic()
+    try:
+        for future in as_completed(futures, timeout=STATUS_PROBE_TIMEOUT * 2):
+            server_id = futures[future]
+            results[server_id] = health_poller.record(server_id, future.result())
+            if len(results) < len(available_servers) and time.monotonic() - last_edit >= 1:
+                last_edit = time.monotonic()
+                outbox.edit_message_text(render_global_status(available_servers, results),
+                                      message.chat.id, status_message.message_id, parse_mode='Markdown')
+    except FuturesTimeoutError:
+        for server_id in missing:
+            if server_id not in results:
+                results[server_id] = health_poller.record(server_id, {'online': False, 'error': 'таймаут'})
+    
+    outbox.edit_message_text(render_global_status(available_servers, results),
+                          message.chat.id, status_message.message_id, parse_mode='Markdown')
 
 @bot.message_handler(func=lambda message: message.text == '❓ Помощь')
 @access_check_message
 def show_help(message):
-    user_id = message.from_user.id
+    outbox.send_message(message.chat.id, build_help_text(message.from_user.id), parse_mode='Markdown')
+
+def build_help_text(user_id):
     available_servers = get_available_servers(user_id)
     total_computers = sum(server['computers_count'] for server in available_servers.values())
     
@@ -678,7 +2223,9 @@ def show_help(message):
         f"- Выберите сервер\n"
         f"- Выберите конкретный компьютер\n"
         f"- Выберите режим обновления (обычный/принудительный)\n"
-        f"- Или обновите все ПК сразу\n\n"
+        f"- Или обновите все ПК сразу\n"
+        f"- ☑️ Выбрать несколько - отметьте нужные ПК и обновите их одной задачей\n"
+        f"- /update <сервер> <ПК> [--force] - то же командой, например `/update 1 3-12,!7`\n\n"
         f"*Обычное обновление*\n"
         f"- Проверяет занятость ПК.\n"
         f"- Обновляет только если ПК выключен.\n\n"
@@ -690,156 +2237,324 @@ def show_help(message):
         f"*Результаты выполнения:*\n"
         f"- Результат обновления отправляется сообщением\n"
         f"- Если текста много - отправляется файлом\n\n"
+        f"*Очередь задач:*\n"
+        f"- Обновления выполняются по очереди для каждого сервера\n"
+        f"- ⛔ Отменить под сообщением о задаче - убрать ее из очереди или остановить обновление\n"
+        f"- 🔁 Повторный запрос того же обновления присоединяется к идущей задаче, принудительное заменяет обычное\n"
+        f"- /jobs - выполняющиеся и ожидающие задачи\n"
+        f"- /history [сервер] [ПК] - последние задачи\n"
+        + ("- /stats - задержки и состояние бота\n" if is_admin(user_id) else "")
+        + f"\n"
         f"*Доступные серверы:* {len(available_servers)}\n"
         f"*Доступные компьютеры:* {total_computers}\n"
     )
     
-    bot.send_message(message.chat.id, help_text, parse_mode='Markdown')
+    return help_text
 
 # Обработчики callback'ов
+# Таблица обработчиков: действие -> функция(call, action)
+callback_handlers = {}
+
+def callback_route(*actions):
+    """Регистрирует обработчик для одного или нескольких действий callback"""
+    def decorator(func):
+        for action in actions:
+            callback_handlers[action] = func
+        return func
+    return decorator
+
 @bot.callback_query_handler(func=lambda call: True)
 @access_check_callback
-@server_access_check_callback
 def handle_callback(call):
-    user_id = call.message.chat.id
-    message_id = call.message.message_id
+    pending_probe_views.pop((call.message.chat.id, call.message.message_id), None)
+    # callback_data разбирается один раз, дальше все работают с готовым действием
+    action = callback_codec.decode(call.data)
+    if action is None or action.action not in callback_handlers:
+        outbox.answer_callback_query(call.id, "❌ Кнопка устарела")
+        return
     
-    try:
-        # Выбор сервера
-        if call.data.startswith('select_server:'):
-            server_id = call.data.replace('select_server:', '', 1)
-            if server_id in SERVERS_CONFIG:
-                user_states[user_id] = {'current_server': server_id, 'computers_page': 0}
-                send_computers_menu(call.message.chat.id, server_id, 0, message_id)
-            else:
-                bot.answer_callback_query(call.id, "❌ Сервер не найден")
-        
-        # Пагинация серверов
-        elif call.data.startswith('servers_page:'):
-            page = int(call.data.replace('servers_page:', '', 1))
-            send_servers_menu(call.message.chat.id, page, message_id)
-        
-        # Пагинация компьютеров
-        elif call.data.startswith('computers_page:'):
-            parts = call.data.replace('computers_page:', '', 1).split(':')
-            if len(parts) == 2:
-                server_id = parts[0]
-                page = int(parts[1])
-                if server_id in SERVERS_CONFIG:
-                    user_states[user_id] = {'current_server': server_id, 'computers_page': page}
-                    send_computers_menu(call.message.chat.id, server_id, page, message_id)
-                else:
-                    bot.answer_callback_query(call.id, "❌ Сервер не найден")
-        
-        # Выбор компьютера - показываем меню выбора режима
-        elif call.data.startswith('select_pc:'):
-            parts = call.data.replace('select_pc:', '', 1).split(':')
-            if len(parts) == 2:
-                server_id = parts[0]
-                pc_number = parts[1]
-                if server_id in SERVERS_CONFIG:
-                    bot.answer_callback_query(call.id, f"Выбран PC-{pc_number}")
-                    show_update_mode_menu(call.message.chat.id, server_id, pc_number, message_id)
-                else:
-                    bot.answer_callback_query(call.id, "❌ Сервер не найден")
-        
-        # Обычное обновление - сразу запускаем
-        elif call.data.startswith('update_normal:'):
-            parts = call.data.replace('update_normal:', '', 1).split(':')
-            if len(parts) == 2:
-                server_id = parts[0]
-                pc_number = parts[1]
-                if server_id in SERVERS_CONFIG:
-                    ip_address = number_to_ip(SERVERS_CONFIG[server_id], pc_number)
-                    bot.answer_callback_query(call.id, f"Запуск обычного обновления PC-{pc_number} ({ip_address})...")
-                    start_update_in_thread(call.message.chat.id, server_id, pc_number, force=False)
-                else:
-                    bot.answer_callback_query(call.id, "❌ Сервер не найден")
-        
-        # Подтверждение принудительного обновления
-        elif call.data.startswith('update_force_confirm:'):
-            parts = call.data.replace('update_force_confirm:', '', 1).split(':')
-            if len(parts) == 2:
-                server_id = parts[0]
-                pc_number = parts[1]
-                if server_id in SERVERS_CONFIG:
-                    show_force_confirmation(call.message.chat.id, server_id, pc_number, message_id)
-                else:
-                    bot.answer_callback_query(call.id, "❌ Сервер не найден")
-        
-        # Запуск принудительного обновления после подтверждения
-        elif call.data.startswith('force_update:'):
-            parts = call.data.replace('force_update:', '', 1).split(':')
-            if len(parts) == 2:
-                server_id = parts[0]
-                pc_number = parts[1]
-                if server_id in SERVERS_CONFIG:
-                    ip_address = number_to_ip(SERVERS_CONFIG[server_id], pc_number)
-                    bot.answer_callback_query(call.id, f"Запуск принудительного обновления PC-{pc_number} ({ip_address})...")
-                    start_update_in_thread(call.message.chat.id, server_id, pc_number, force=True)
-                else:
-                    bot.answer_callback_query(call.id, "❌ Сервер не найден")
-        
-        # Возврат к выбору режима обновления
-        elif call.data.startswith('back_to_mode:'):
-            parts = call.data.replace('back_to_mode:', '', 1).split(':')
-            if len(parts) == 2:
-                server_id = parts[0]
-                pc_number = parts[1]
-                if server_id in SERVERS_CONFIG:
-                    show_update_mode_menu(call.message.chat.id, server_id, pc_number, message_id)
-                else:
-                    bot.answer_callback_query(call.id, "❌ Сервер не найден")
-        
-        # Возврат к списку компьютеров
-        elif call.data.startswith('back_to_computers:'):
-            server_id = call.data.replace('back_to_computers:', '', 1)
-            if server_id in SERVERS_CONFIG:
-                user_states[user_id] = {'current_server': server_id, 'computers_page': 0}
-                send_computers_menu(call.message.chat.id, server_id, 0, message_id)
-            else:
-                bot.answer_callback_query(call.id, "❌ Сервер не найден")
-        
-        # Обновление всего сервера
-        elif call.data.startswith('update_server:'):
-            server_id = call.data.replace('update_server:', '', 1)
-            if server_id in SERVERS_CONFIG:
-                server_config = SERVERS_CONFIG[server_id]
-                bot.answer_callback_query(call.id, f"Массовое обновление на {server_config['name']}...")
-                start_update_in_thread(call.message.chat.id, server_id)
-            else:
-                bot.answer_callback_query(call.id, "❌ Сервер не найден")
-        
-        # Возврат к серверам
-        elif call.data == 'back_to_servers':
-            send_servers_menu(call.message.chat.id, 0, message_id)
-        
-        # Текущая страница (ничего не делаем)
-        elif call.data == 'current_page':
-            bot.answer_callback_query(call.id)
+    if 'server' in action_fields(action.action):
+        if action.server_id is None:
+            outbox.answer_callback_query(call.id, "❌ Сервер не найден")
+            return
+        if not check_server_access(call.from_user.id, action.server_id):
+            outbox.answer_callback_query(call.id, "❌ Доступ к этому серверу запрещен", show_alert=True)
+            return
     
+    try:
+        with callback_seconds.time(action=action.action):
+            callback_handlers[action.action](call, action)
     except Exception as e:
         logger.error(f"Ошибка обработки callback: {e}")
-        bot.answer_callback_query(call.id, "❌ Произошла ошибка")
+        outbox.answer_callback_query(call.id, "❌ Произошла ошибка")
+
+# Выбор сервера и возврат к списку компьютеров
+@callback_route('select_server', 'back_to_computers')
+def on_select_server(call, action):
+    session_store.update(call.message.chat.id, current_server=action.server_id, computers_page=0)
+    send_computers_menu(call.message.chat.id, action.server_id, 0, call.message.message_id)
+
+# Пагинация серверов
+@callback_route('servers_page')
+def on_servers_page(call, action):
+    session_store.update(call.message.chat.id, servers_page=action.page)
+    send_servers_menu(call.message.chat.id, action.page, call.message.message_id)
+
+# Пагинация компьютеров
+@callback_route('computers_page')
+def on_computers_page(call, action):
+    session_store.update(call.message.chat.id, current_server=action.server_id, computers_page=action.page)
+    send_computers_menu(call.message.chat.id, action.server_id, action.page, call.message.message_id)
+
+# Выбор компьютера - показываем меню выбора режима
+@callback_route('select_pc')
+def on_select_pc(call, action):
+    outbox.answer_callback_query(call.id, f"Выбран PC-{action.pc_number}")
+    show_update_mode_menu(call.message.chat.id, action.server_id, action.pc_number, call.message.message_id)
+
+# Возврат к выбору режима обновления
+@callback_route('back_to_mode')
+def on_back_to_mode(call, action):
+    show_update_mode_menu(call.message.chat.id, action.server_id, action.pc_number, call.message.message_id)
+
+# Обычное обновление - сразу запускаем
+@callback_route('update_normal')
+def on_update_normal(call, action):
+    ip_address = number_to_ip(SERVERS_CONFIG[action.server_id], action.pc_number)
+    outbox.answer_callback_query(call.id, f"Запуск обычного обновления PC-{action.pc_number} ({ip_address})...")
+    submit_update_job(call.message.chat.id, action.server_id, action.pc_number, force=False, user_id=call.from_user.id)
+
+# Подтверждение принудительного обновления
+@callback_route('update_force_confirm')
+def on_update_force_confirm(call, action):
+    show_force_confirmation(call.message.chat.id, action.server_id, action.pc_number, call.message.message_id)
+
+# Запуск принудительного обновления после подтверждения
+@callback_route('force_update')
+def on_force_update(call, action):
+    ip_address = number_to_ip(SERVERS_CONFIG[action.server_id], action.pc_number)
+    outbox.answer_callback_query(call.id, f"Запуск принудительного обновления PC-{action.pc_number} ({ip_address})...")
+    submit_update_job(call.message.chat.id, action.server_id, action.pc_number, force=True, user_id=call.from_user.id)
+
+# Обновление всего сервера
+@callback_route('update_server')
+def on_update_server(call, action):
+    server_config = SERVERS_CONFIG[action.server_id]
+    outbox.answer_callback_query(call.id, f"Массовое обновление на {server_config['name']}...")
+    submit_update_job(call.message.chat.id, action.server_id, user_id=call.from_user.id)
+
+# Включение и выключение режима выбора нескольких компьютеров
+@callback_route('multi_select')
+def on_multi_select(call, action):
+    chat_id = call.message.chat.id
+    if get_selection(chat_id, action.server_id) is None:
+        session_store.update(chat_id, selection_server=action.server_id, selected_pcs=[])
+    else:
+        clear_selection(chat_id)
+    send_computers_menu(chat_id, action.server_id, current_computers_page(chat_id, action.server_id), call.message.message_id)
+
+# Отметка компьютера в режиме выбора
+@callback_route('toggle_pc')
+def on_toggle_pc(call, action):
+    chat_id = call.message.chat.id
+    selected = toggle_selection(chat_id, action.server_id, action.pc_number)
+    outbox.answer_callback_query(call.id, f"Выбрано ПК: {len(selected)}")
+    send_computers_menu(chat_id, action.server_id, current_computers_page(chat_id, action.server_id), call.message.message_id)
+
+# Обычное обновление выбранных компьютеров одной задачей
+@callback_route('update_selected')
+def on_update_selected(call, action):
+    start_selected_update(call, action.server_id, force=False)
+
+# Подтверждение принудительного обновления выбранных компьютеров
+@callback_route('selected_force_confirm')
+def on_selected_force_confirm(call, action):
+    selected = get_selection(call.message.chat.id, action.server_id)
+    if not selected:
+        outbox.answer_callback_query(call.id, "Не выбрано ни одного ПК")
+        return
+    text, markup = build_selected_force_confirmation(action.server_id, sorted(selected))
+    outbox.edit_message_text(text, call.message.chat.id, call.message.message_id, reply_markup=markup, parse_mode='Markdown')
+
+# Принудительное обновление выбранных компьютеров после подтверждения
+@callback_route('force_selected')
+def on_force_selected(call, action):
+    start_selected_update(call, action.server_id, force=True)
+
+def start_selected_update(call, server_id, force):
+    """Ставит в очередь обновление выбранных ПК, сбрасывает выбор и возвращает обычное меню"""
+    chat_id = call.message.chat.id
+    selected = get_selection(chat_id, server_id)
+    if not selected:
+        outbox.answer_callback_query(call.id, "Не выбрано ни одного ПК")
+        return
+    outbox.answer_callback_query(call.id, f"Запуск {'принудительного' if force else 'обычного'} обновления {len(selected)} ПК...")
+    clear_selection(chat_id)
+    submit_update_job(chat_id, server_id, force=force, user_id=call.from_user.id, pc_numbers=sorted(selected))
+    send_computers_menu(chat_id, server_id, current_computers_page(chat_id, server_id), call.message.message_id)
+
+# Отмена задачи кнопкой под сообщением о ней
+@callback_route('cancel_job')
+def on_cancel_job(call, action):
+    job = job_scheduler.find(action.job_id)
+    if job is None or job.server_id != action.server_id:
+        outbox.answer_callback_query(call.id, "Задача уже завершена")
+        return
+    if job.user_id not in (None, call.from_user.id) and not is_admin(call.from_user.id):
+        outbox.answer_callback_query(call.id, "❌ Отменить задачу может только ее автор или администратор", show_alert=True)
+        return
+    job = job_scheduler.cancel(job.id)
+    if job is None:
+        outbox.answer_callback_query(call.id, "Задача уже завершена")
+    elif job.status == 'cancelled':
+        # Задача не успела запуститься - сообщение о ней больше некому обновлять
+        outbox.answer_callback_query(call.id, f"Задача #{job.id} отменена")
+        text = job_message_text(job, SERVERS_CONFIG[job.server_id])
+        outbox.edit_message_text(text, call.message.chat.id, call.message.message_id, parse_mode='Markdown')
+        # Присоединившиеся к задаче чаты ждут результат - сообщаем им об отмене
+        notify_chats([chat_id for chat_id in close_subscription(job) if chat_id != call.message.chat.id], text)
+    else:
+        outbox.answer_callback_query(call.id, f"Останавливаем задачу #{job.id}...")
+
+# Возврат к серверам
+@callback_route('back_to_servers')
+def on_back_to_servers(call, action):
+    session_store.update(call.message.chat.id, current_server=None)
+    _, page = last_menu(call.message.chat.id)
+    send_servers_menu(call.message.chat.id, page, call.message.message_id)
+
+# Текущая страница (ничего не делаем)
+@callback_route('current_page')
+def on_current_page(call, action):
+    outbox.answer_callback_query(call.id)
+
+# Процесс-исполнитель: SSH пул и команды без Telegram
+def run_executor(name):
+    """Выполняет команды front-end в своем пуле SSH соединений (python bot.py --executor <имя>)"""
+    server = ExecutorServer(
+        executor_address(name),
+        lambda server_config, command, result, cancel, timeout: run_ssh_command(
+            server_config, command, cancel=cancel, timeout=timeout, result=result),
+        {
+            'probe': lambda server_config, timeout: ssh_pool.probe(server_config['id'], server_config, timeout),
+            'execute': lambda server_config, command, timeout: ssh_pool.execute(server_config['id'], server_config,
+                                                                                command, timeout),
+        },
+        authkey=EXECUTOR_AUTHKEY,
+        workers=EXECUTOR_WORKERS,
+    )
+    served = [config['name'] for config in SERVERS_CONFIG.values()
+              if (config['executor'] if config['executor'] in EXECUTORS else (EXECUTORS or [name])[0]) == name]
+    print(f"🛠️  Исполнитель {name}: {executor_address(name)}, до {EXECUTOR_WORKERS} запросов одновременно")
+    print(f"   Серверы: {', '.join(served) if served else 'не назначены'}")
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        ssh_pool.close()
 
 # Запуск бота
 if __name__ == "__main__":
+    if EXECUTOR_ROLE is not None:
+        run_executor(EXECUTOR_ROLE)
+        sys.exit(0)
+    
+    mark_startup('config')
     print(f"🤖 Бот запускается...")
     print(f"📊 Серверов: {len(SERVERS_CONFIG)}")
     print(f"🔧 Компьютеров на странице: {COMPUTERS_PER_PAGE}")
-    print("🔐 Используется аутентификация по паролю")
+    key_servers = sum(1 for config in SERVERS_CONFIG.values() if config['key_path'])
+    print(f"🔐 Аутентификация: по ключу {key_servers}, только по паролю {len(SERVERS_CONFIG) - key_servers} серверов")
+    print(f"🔑 Ключи хостов: {SSH_HOST_KEY_POLICY}, " + (SSH_KNOWN_HOSTS if SSH_KNOWN_HOSTS else "только в памяти"))
+    print(f"🔌 Пул SSH: keepalive {SSH_KEEPALIVE}с, до {SSH_MAX_CHANNELS_PER_HOST} каналов на сервер")
+    if SSH_WARMUP:
+        print("🔥 Прогрев SSH: подключение ко всем серверам в фоне при запуске")
     print("🔄 Скрипт обновления: sudo bash ./fre.sh")
+    if MASS_UPDATE_MODE == 'parallel':
+        print(f"⚡ Массовое обновление: по ПК, до {MASS_UPDATE_CONCURRENCY} одновременно")
     print("📄 Большие выводы отправляются как .txt файлы")
     print("👤 Система белого списка активна")
+    print("♻️  Перезагрузка конфигурации: SIGHUP" + (f", изменение .env (каждые {CONFIG_WATCH_INTERVAL:g}с)" if ENV_FILE and CONFIG_WATCH_INTERVAL > 0 else ""))
     
     if USER_ACCESS:
         print(f"🔒 Контроль доступа к серверам: настроен для {len(USER_ACCESS)} пользователей")
     else:
         print("🔓 Контроль доступа к серверам: не настроен")
     
+    if BOT_MODE == 'webhook':
+        print(f"🌐 Вебхук: {WEBHOOK_LISTEN}:{WEBHOOK_PORT}{WEBHOOK_PATH}, обработчиков {WEBHOOK_WORKERS}"
+              + ("" if WEBHOOK_URL else " (WEBHOOK_URL не задан - в Telegram не регистрируется)"))
+    if EXECUTORS:
+        print(f"🛠️  SSH команды выполняют исполнители: {', '.join(EXECUTORS)} (сокеты в {EXECUTOR_SOCKET_DIR})")
+    print(f"⚙️  Среда выполнения: {'asyncio (AsyncTeleBot + asyncssh)' if BOT_RUNTIME == 'async' else 'потоки (TeleBot + paramiko)'}")
     print("Для остановки нажмите Ctrl+C")
     
+    start_services()
+    invalidate_menu_cache()
+    start_config_reload()
+    # SIGTERM (systemctl stop, docker stop) завершает бота через finally: накопленные итоги задач
+    # и состояния пользователей записываются перед выходом
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    metrics_server = None
+    if METRICS_PORT:
+        metrics_server = MetricsServer(metrics, METRICS_LISTEN, METRICS_PORT)
+        metrics_server.start()
+    if job_store:
+        print(f"📜 Журнал задач: {JOB_DB_PATH}")
+    if METRICS_PORT:
+        print(f"📈 Метрики Prometheus: http://{METRICS_LISTEN}:{METRICS_PORT}/metrics")
+    print(f"💾 Состояния пользователей: до {SESSION_MAX_ENTRIES}, срок {SESSION_TTL // 3600} ч"
+          + (f", сохраняются в {SESSION_FILE}" if SESSION_FILE else ""))
+    
+    if BOT_RUNTIME == 'async':
+        # async_runtime импортирует этот модуль как bot - подставляем уже загруженный,
+        # чтобы конфигурация и кэши не создавались второй раз
+        sys.modules.setdefault('bot', sys.modules[__name__])
+        import async_runtime
+        try:
+            async_runtime.main()
+        except Exception as e:
+            print(f"Ошибка: {e}")
+        finally:
+            if job_store:
+                job_store.close()
+            session_store.stop()
+            outbox.stop()
+        sys.exit(0)
+    
+    if SSH_WARMUP:
+        threading.Thread(target=warm_up_servers, name='ssh-warmup', daemon=True).start()
+    else:
+        health_poller.start()
+    recover_jobs()
+    
     try:
-        bot.infinity_polling()
+        if BOT_MODE == 'webhook':
+            # Обработчики выполняются прямо в рабочих потоках вебхука, без пула потоков telebot
+            bot.threaded = False
+            webhook_server = start_webhook(process_webhook_update)
+            mark_startup('ready')
+            try:
+                threading.Event().wait()
+            finally:
+                webhook_server.stop()
+        else:
+            # Вебхук, оставшийся от запуска в режиме webhook, не дал бы получать обновления (409 Conflict)
+            bot.remove_webhook()
+            mark_startup('ready')
+            bot.infinity_polling()
     except Exception as e:
-        print(f"Ошибка: {e}")
\ No newline at end of file
+        print(f"Ошибка: {e}")
+    finally:
+        job_scheduler.shutdown()
+        health_poller.stop()
+        if metrics_server:
+            metrics_server.stop()
+        if job_store:
+            job_store.close()
+        session_store.stop()
+        logger.info(f"Состояния пользователей: {session_store.stats()}")
+        outbox.stop()
+        ssh_pool.close()
\ No newline at end of file
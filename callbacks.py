@@ -0,0 +1,145 @@
+import hashlib
+from collections import namedtuple
+
+# Версия формата callback_data; меняется при несовместимом изменении кодирования
+CALLBACK_VERSION = '1'
+
+# Ограничение Telegram на длину callback_data в байтах
+MAX_CALLBACK_DATA = 64
+
+# Действия: имя -> (короткий код, поля в порядке кодирования)
+ACTIONS = {
+    'select_server': ('s', ('server',)),
+    'servers_page': ('p', ('page',)),
+    'computers_page': ('c', ('server', 'page')),
+    'select_pc': ('m', ('server', 'pc')),
+    'update_normal': ('u', ('server', 'pc')),
+    'update_force_confirm': ('f', ('server', 'pc')),
+    'force_update': ('F', ('server', 'pc')),
+    'back_to_mode': ('b', ('server', 'pc')),
+    'back_to_computers': ('B', ('server',)),
+    'update_server': ('a', ('server',)),
+    'multi_select': ('t', ('server',)),
+    'toggle_pc': ('T', ('server', 'pc')),
+    'update_selected': ('U', ('server',)),
+    'selected_force_confirm': ('g', ('server',)),
+    'force_selected': ('G', ('server',)),
+    'cancel_job': ('x', ('server', 'job')),
+    'back_to_servers': ('S', ()),
+    'current_page': ('n', ()),
+}
+
+# Для разбора: версия+код -> (имя, число частей, индексы полей server/pc/page/job или 0)
+_DECODE_TABLE = {
+    CALLBACK_VERSION + code: (
+        name,
+        len(fields) + 1,
+        fields.index('server') + 1 if 'server' in fields else 0,
+        fields.index('pc') + 1 if 'pc' in fields else 0,
+        fields.index('page') + 1 if 'page' in fields else 0,
+        fields.index('job') + 1 if 'job' in fields else 0,
+    )
+    for name, (code, fields) in ACTIONS.items()
+}
+
+# Разобранный callback: server_id равен None, если сервер не найден
+CallbackAction = namedtuple('CallbackAction', ['action', 'server_id', 'pc_number', 'page', 'job_id'], defaults=(None,))
+
+
+def action_fields(action):
+    """Поля, которые несет действие ('server', 'pc', 'page', 'job')"""
+    return ACTIONS[action][1]
+
+
+def server_token(server_id):
+    """Короткий стабильный идентификатор сервера фиксированной длины (8 символов)"""
+    return hashlib.blake2b(server_id.encode('utf-8'), digest_size=5).hexdigest()[:8]
+
+
+# Кодирование и разбор callback_data
+class CallbackCodec:
+    """Компактное версионированное кодирование callback_data.
+    Формат: <версия><код действия>[:<поле>...], сервер передается коротким токеном"""
+    
+    def __init__(self, server_ids=()):
+        self._servers = {}
+        self._tokens = {}
+        self.register_servers(server_ids)
+    
+    def register_servers(self, server_ids):
+        """Перестраивает таблицу токенов серверов (вызывается при загрузке конфигурации)"""
+        servers = {}
+        tokens = {}
+        for server_id in server_ids:
+            token = server_token(server_id)
+            if token in servers and servers[token] != server_id:
+                raise ValueError(f"Коллизия токенов серверов {servers[token]} и {server_id}")
+            servers[token] = server_id
+            tokens[server_id] = token
+        self._servers, self._tokens = servers, tokens
+    
+    def encode(self, action, server_id=None, pc_number=None, page=None, job_id=None):
+        code, fields = ACTIONS[action]
+        parts = [CALLBACK_VERSION + code]
+        for field in fields:
+            if field == 'server':
+                parts.append(self._tokens.get(server_id) or server_token(server_id))
+            elif field == 'pc':
+                parts.append(str(int(pc_number)))
+            elif field == 'page':
+                parts.append(str(int(page)))
+            else:
+                parts.append(str(int(job_id)))
+        data = ':'.join(parts)
+        if len(data.encode('utf-8')) > MAX_CALLBACK_DATA:
+            raise ValueError(f"callback_data длиннее {MAX_CALLBACK_DATA} байт: {data}")
+        return data
+    
+    def decode(self, data):
+        """Разбирает callback_data за один проход. Возвращает CallbackAction или None для неизвестных данных"""
+        if not data:
+            return None
+        parts = data.split(':')
+        spec = _DECODE_TABLE.get(parts[0])
+        if spec is None:
+            return self.decode_legacy(data) if data[0] != CALLBACK_VERSION else None
+        
+        name, count, server_index, pc_index, page_index, job_index = spec
+        if len(parts) != count:
+            return None
+        try:
+            return CallbackAction(
+                name,
+                self._servers.get(parts[server_index]) if server_index else None,
+                int(parts[pc_index]) if pc_index else None,
+                int(parts[page_index]) if page_index else None,
+                int(parts[job_index]) if job_index else None,
+            )
+        except ValueError:
+            return None
+    
+    def decode_legacy(self, data):
+        """Разбирает прежний формат 'действие:server_id[:число]', чтобы кнопки в старых сообщениях продолжали работать"""
+        name, _, rest = data.partition(':')
+        if name not in ACTIONS or (rest and name in ('back_to_servers', 'current_page')):
+            return None
+        fields = action_fields(name)
+        # server_id может содержать ':' только теоретически - числовое поле всегда последнее
+        if len(fields) == 2:
+            server_id, _, number = rest.rpartition(':')
+            values = {'server': server_id, fields[1]: number}
+        elif fields:
+            values = {fields[0]: rest}
+        else:
+            values = {}
+        try:
+            server_id = values.get('server')
+            return CallbackAction(
+                name,
+                server_id if server_id in self._tokens else None,
+                int(values['pc']) if 'pc' in values else None,
+                int(values['page']) if 'page' in values else None,
+                int(values['job']) if 'job' in values else None,
+            )
+        except ValueError:
+            return None
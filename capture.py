@@ -0,0 +1,117 @@
+import shutil
+import tempfile
+from collections import deque
+
+
+# Ограниченный захват одного потока вывода
+class OutputCapture:
+    """Держит в памяти только начало и конец вывода. Весь вывод пишется во временный файл:
+    до spill_bytes в памяти, дальше на диске, но не больше max_bytes"""
+    
+    def __init__(self, head_chars=32768, tail_chars=32768, spill_bytes=1024 * 1024, max_bytes=64 * 1024 * 1024):
+        self.head_chars = head_chars
+        self.tail_chars = tail_chars
+        self.max_bytes = max_bytes
+        self.chars = 0
+        self.bytes = 0
+        self.overflow = False
+        self._head = []
+        self._head_len = 0
+        self._tail = deque()
+        self._tail_len = 0
+        self._spool = tempfile.SpooledTemporaryFile(max_size=spill_bytes)
+    
+    def feed(self, text):
+        if not text:
+            return
+        self.chars += len(text)
+        
+        data = text.encode('utf-8')
+        if self.bytes + len(data) > self.max_bytes:
+            data = data[:self.max_bytes - self.bytes]
+            self.overflow = True
+        if data:
+            self._spool.write(data)
+            self.bytes += len(data)
+        
+        if self._head_len < self.head_chars:
+            part = text[:self.head_chars - self._head_len]
+            self._head.append(part)
+            self._head_len += len(part)
+            text = text[len(part):]
+        if text:
+            self._tail.append(text)
+            self._tail_len += len(text)
+            # Старые фрагменты хвоста выбрасываем, пока без них остается не меньше tail_chars
+            while self._tail_len - len(self._tail[0]) >= self.tail_chars:
+                self._tail_len -= len(self._tail.popleft())
+    
+    @property
+    def truncated(self):
+        """Середина вывода не поместилась в память"""
+        return self.chars > self._head_len + min(self._tail_len, self.tail_chars)
+    
+    def text(self):
+        """Вывод целиком или, если он слишком большой, начало и конец с отметкой о пропуске"""
+        head = ''.join(self._head)
+        tail = ''.join(self._tail)[-self.tail_chars:] if self.tail_chars else ''
+        skipped = self.chars - len(head) - len(tail)
+        if skipped <= 0:
+            return head + tail
+        return head + f"\n\n... [пропущено {skipped} символов] ...\n\n" + tail
+    
+    def copy_to(self, target):
+        """Копирует весь сохраненный вывод (до max_bytes) в двоичный файл target"""
+        self._spool.seek(0)
+        shutil.copyfileobj(self._spool, target)
+        self._spool.seek(0, 2)
+    
+    def close(self):
+        self._spool.close()
+
+
+# Результат удаленной команды
+class CommandResult:
+    """Вывод stdout и stderr (каждый в своем ограниченном буфере), код возврата и ошибка подключения.
+    Успех - это нулевой код возврата, а не только удавшееся подключение.
+    interrupted - 'cancelled' или 'timeout', если команда была остановлена до завершения"""
+    
+    def __init__(self, **limits):
+        self.stdout = OutputCapture(**limits)
+        self.stderr = OutputCapture(**limits)
+        self.exit_status = None
+        self.error = None
+        self.interrupted = None
+    
+    @property
+    def ok(self):
+        return self.error is None and self.interrupted is None and self.exit_status == 0
+    
+    @property
+    def truncated(self):
+        return self.stdout.truncated or self.stderr.truncated
+    
+    @property
+    def overflow(self):
+        return self.stdout.overflow or self.stderr.overflow
+    
+    @property
+    def raw_size(self):
+        return self.stdout.bytes + self.stderr.bytes + (1 if self.stderr.bytes else 0)
+    
+    def output(self):
+        """Объединенный вывод: сначала stdout, затем stderr"""
+        output = self.stdout.text()
+        error = self.stderr.text()
+        return (output + ("\n" + error if error else "")).strip()
+    
+    def copy_to(self, target):
+        """Записывает полный вывод (stdout, затем stderr) в двоичный файл target"""
+        self.stdout.copy_to(target)
+        if self.stderr.bytes:
+            target.write(b"\n")
+            self.stderr.copy_to(target)
+    
+    def close(self):
+        self.stdout.close()
+        self.stderr.close()
@@ -0,0 +1,269 @@
+import itertools
+import logging
+import os
+import queue
+import socket
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing.connection import Client, Listener
+
+from jobs import CancelToken
+
+logger = logging.getLogger(__name__)
+
+# Протокол между front-end и исполнителем - кортежи через multiprocessing.connection (unix-сокет):
+# front-end -> исполнитель: ('run', id, server_config, command, timeout) - команда с потоковым выводом,
+#   ('call', id, operation, args) - короткая операция, ('cancel', id, reason) - остановка команды
+# исполнитель -> front-end: ('output', id, 'stdout' | 'stderr', text),
+#   ('done', id, exit_status, error, interrupted) - итог команды, ('result', id, value) - итог операции,
+#   ('failed', id, message, timed_out) - исключение операции
+
+
+class ExecutorUnavailable(Exception):
+    """Исполнитель не запущен или соединение с ним оборвалось"""
+
+
+class RemoteError(Exception):
+    """Исключение операции на стороне исполнителя"""
+
+
+class _ForwardedOutput:
+    """Поток вывода, который вместо захвата пересылает фрагменты в front-end"""
+    
+    def __init__(self, send, request_id, kind):
+        self.send = send
+        self.request_id = request_id
+        self.kind = kind
+    
+    def feed(self, text):
+        if text:
+            self.send(('output', self.request_id, self.kind, text))
+
+
+class ForwardedResult:
+    """Замена CommandResult для исполнителя: вывод уходит в front-end, где и захватывается"""
+    
+    def __init__(self, send, request_id):
+        self.stdout = _ForwardedOutput(send, request_id, 'stdout')
+        self.stderr = _ForwardedOutput(send, request_id, 'stderr')
+        self.exit_status = None
+        self.error = None
+        self.interrupted = None
+
+
+# Процесс-исполнитель SSH команд
+class ExecutorServer:
+    """Принимает запросы front-end на unix-сокете и выполняет их в пуле потоков.
+    run_command(server_config, command, result, cancel, timeout) выполняет команду, передавая вывод
+    в result.stdout/stderr (ForwardedResult); operations - {имя: функция} для коротких операций,
+    у которых свой небольшой пул: проверки серверов не ждут, пока освободятся долгие команды.
+    При обрыве соединения с front-end его незавершенные команды останавливаются, при остановке
+    исполнителя - все, и front-end получает их итог до закрытия соединения"""
+    
+    def __init__(self, address, run_command, operations=None, authkey=None, workers=16, call_workers=4):
+        self.address = address
+        self.run_command = run_command
+        self.operations = operations or {}
+        self.authkey = authkey
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='executor')
+        self.call_pool = ThreadPoolExecutor(max_workers=call_workers, thread_name_prefix='executor-call')
+        self._listener = None
+        self._active = set()
+    
+    def serve_forever(self):
+        if os.path.exists(self.address):
+            # Сокет остался от предыдущего запуска
+            os.unlink(self.address)
+        # Сокет сразу создается с правами 0600: chmod после bind оставлял окно, когда он был доступен всем
+        umask = os.umask(0o177)
+        try:
+            self._listener = Listener(self.address, family='AF_UNIX', authkey=self.authkey)
+        finally:
+            os.umask(umask)
+        logger.info(f"Исполнитель принимает запросы на {self.address}")
+        try:
+            while True:
+                try:
+                    conn = self._listener.accept()
+                except OSError as e:
+                    if self._listener is None:
+                        return
+                    logger.warning(f"Не удалось принять подключение: {e}")
+                    continue
+                threading.Thread(target=self._serve, args=(conn,), name='executor-conn', daemon=True).start()
+        finally:
+            self.stop()
+    
+    def stop(self):
+        listener, self._listener = self._listener, None
+        if listener is not None:
+            listener.close()
+        active = list(self._active)
+        if active:
+            logger.info(f"Исполнитель останавливается, останавливаем команды: {len(active)}")
+        for token in active:
+            token.cancel()
+        self.pool.shutdown(wait=True, cancel_futures=True)
+        self.call_pool.shutdown(wait=True, cancel_futures=True)
+    
+    def _serve(self, conn):
+        lock = threading.Lock()
+        tokens = {}
+        
+        def send(message):
+            try:
+                with lock:
+                    conn.send(message)
+            except (OSError, ValueError) as e:
+                logger.debug(f"Ответ front-end не отправлен: {e}")
+        
+        logger.info("Front-end подключен")
+        try:
+            while True:
+                message = conn.recv()
+                operation, request_id = message[0], message[1]
+                if operation == 'run':
+                    tokens[request_id] = CancelToken()
+                    self.pool.submit(self._run, send, tokens, request_id, *message[2:])
+                elif operation == 'call':
+                    self.call_pool.submit(self._call, send, request_id, *message[2:])
+                elif operation == 'cancel':
+                    token = tokens.get(request_id)
+                    if token is not None:
+                        token.cancel(message[2])
+        except (EOFError, OSError) as e:
+            logger.warning(f"Front-end отключился ({e or 'соединение закрыто'}), "
+                           f"останавливаем его команды: {len(tokens)}")
+        finally:
+            for token in list(tokens.values()):
+                token.cancel()
+            conn.close()
+    
+    def _run(self, send, tokens, request_id, server_config, command, timeout):
+        result = ForwardedResult(send, request_id)
+        token = tokens[request_id]
+        self._active.add(token)
+        try:
+            self.run_command(server_config, command, result, token, timeout)
+        except Exception as e:
+            result.error = f"Ошибка исполнителя: {e}"
+            logger.error(result.error)
+        finally:
+            self._active.discard(token)
+            tokens.pop(request_id, None)
+        send(('done', request_id, result.exit_status, result.error, result.interrupted))
+    
+    def _call(self, send, request_id, operation, args):
+        try:
+            value = self.operations[operation](*args)
+        except Exception as e:
+            send(('failed', request_id, str(e) or type(e).__name__, isinstance(e, (socket.timeout, TimeoutError))))
+            return
+        send(('result', request_id, value))
+
+
+# Подключение front-end к исполнителю
+class ExecutorClient:
+    """Соединение с одним исполнителем: открывается при первом запросе и заново после обрыва,
+    поэтому исполнитель можно перезапустить, не останавливая бота. Ответы разбирает поток чтения
+    и раскладывает по очередям запросов; при обрыве незавершенные запросы получают ('lost', id, ошибка)"""
+    
+    def __init__(self, name, address, authkey=None):
+        self.name = name
+        self.address = address
+        self.authkey = authkey
+        self._conn = None
+        self._pending = {}
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._send_lock = threading.Lock()
+    
+    @property
+    def connected(self):
+        return self._conn is not None
+    
+    def _connection(self):
+        # Вызывается под self._lock
+        if self._conn is None:
+            try:
+                conn = Client(self.address, family='AF_UNIX', authkey=self.authkey)
+            except Exception as e:
+                raise ExecutorUnavailable(f"Исполнитель {self.name} недоступен: {e}") from e
+            self._conn = conn
+            threading.Thread(target=self._read, args=(conn,), name=f'executor-{self.name}', daemon=True).start()
+            logger.info(f"Подключено к исполнителю {self.name} ({self.address})")
+        return self._conn
+    
+    def submit(self, operation, *args):
+        """Отправляет запрос и возвращает (номер, очередь ответов)"""
+        replies = queue.Queue()
+        with self._lock:
+            conn = self._connection()
+            request_id = next(self._ids)
+            self._pending[request_id] = replies
+        self._send(conn, (operation, request_id) + args)
+        return request_id, replies
+    
+    def cancel(self, request_id, reason='cancelled'):
+        with self._lock:
+            conn = self._conn
+        if conn is not None and request_id in self._pending:
+            self._send(conn, ('cancel', request_id, reason))
+    
+    def finish(self, request_id):
+        """Забывает запрос после получения итога"""
+        with self._lock:
+            self._pending.pop(request_id, None)
+    
+    def call(self, operation, *args, timeout=None):
+        """Выполняет короткую операцию и возвращает ее значение; исключение исполнителя
+        поднимается как socket.timeout (таймаут) или RemoteError"""
+        request_id, replies = self.submit('call', operation, args)
+        try:
+            reply = replies.get(timeout=timeout)
+        except queue.Empty:
+            raise socket.timeout(f"Исполнитель {self.name} не ответил за {timeout} с") from None
+        finally:
+            self.finish(request_id)
+        if reply[0] == 'result':
+            return reply[2]
+        if reply[0] == 'lost':
+            raise ExecutorUnavailable(reply[2])
+        raise (socket.timeout if reply[3] else RemoteError)(reply[2])
+    
+    def _send(self, conn, message):
+        try:
+            with self._send_lock:
+                conn.send(message)
+        except (OSError, ValueError) as e:
+            self._lost(conn, e)
+            raise ExecutorUnavailable(f"Соединение с исполнителем {self.name} оборвалось: {e}") from e
+    
+    def _read(self, conn):
+        try:
+            while True:
+                message = conn.recv()
+                with self._lock:
+                    replies = self._pending.get(message[1])
+                if replies is not None:
+                    replies.put(message)
+        except (EOFError, OSError) as e:
+            self._lost(conn, e)
+    
+    def _lost(self, conn, error):
+        with self._lock:
+            if self._conn is not conn:
+                return
+            self._conn = None
+            pending, self._pending = self._pending, {}
+        conn.close()
+        logger.error(f"Соединение с исполнителем {self.name} потеряно ({error or 'соединение закрыто'}), "
+                     f"прервано запросов: {len(pending)}")
+        for request_id, replies in pending.items():
+            replies.put(('lost', request_id, f"Исполнитель {self.name} перезапущен или остановлен"))
+    
+    def close(self):
+        with self._lock:
+            conn = self._conn
+        if conn is not None:
+            self._lost(conn, None)
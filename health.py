@@ -0,0 +1,74 @@
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+# Фоновая проверка доступности серверов
+class HealthPoller:
+    """Периодически проверяет серверы и хранит последний статус каждого с ограниченным сроком годности"""
+    
+    def __init__(self, get_servers, probe, executor, interval=60, ttl=180):
+        self.get_servers = get_servers
+        self.probe = probe
+        self.executor = executor
+        self.interval = interval
+        self.ttl = ttl
+        self._statuses = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+    
+    def start(self):
+        if self.interval <= 0 or self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name='health-poller', daemon=True)
+        self._thread.start()
+    
+    def stop(self):
+        self._stop.set()
+    
+    def get(self, server_id):
+        """Возвращает актуальный статус сервера или None, если проверки не было или она устарела"""
+        with self._lock:
+            status = self._statuses.get(server_id)
+        if status is None or time.time() - status['checked_at'] > self.ttl:
+            return None
+        return status
+    
+    def record(self, server_id, result):
+        """Сохраняет результат проверки (в том числе выполненной вне поллера)"""
+        now = time.time()
+        with self._lock:
+            previous = self._statuses.get(server_id, {})
+            status = dict(result)
+            status['checked_at'] = now
+            status['last_seen'] = now if result['online'] else previous.get('last_seen')
+            status['last_error'] = result.get('error') or previous.get('last_error')
+            self._statuses[server_id] = status
+        return status
+    
+    def poll_once(self):
+        """Проверяет все серверы параллельно и ждет завершения проверок"""
+        servers = dict(self.get_servers())
+        futures = {server_id: self.executor.submit(self.probe, config) for server_id, config in servers.items()}
+        for server_id, future in futures.items():
+            try:
+                self.record(server_id, future.result())
+            except Exception as e:
+                logger.error(f"Ошибка фоновой проверки сервера {server_id}: {e}")
+        with self._lock:
+            # Удаленные из конфигурации серверы больше не отслеживаем
+            for server_id in list(self._statuses):
+                if server_id not in servers:
+                    del self._statuses[server_id]
+    
+    def _run(self):
+        while not self._stop.is_set():
+            started = time.monotonic()
+            try:
+                self.poll_once()
+            except Exception as e:
+                logger.error(f"Ошибка фоновой проверки серверов: {e}")
+            self._stop.wait(max(0, self.interval - (time.monotonic() - started)))
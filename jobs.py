@@ -0,0 +1,193 @@
+import itertools
+import logging
+import threading
+import time
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+
+# Отмена задачи и срок ее выполнения
+class CancelToken:
+    """Признак остановки задачи, общий для всех ее команд. reason - 'cancelled' (отменена пользователем)
+    или 'timeout' (истек срок выполнения), None - задача не остановлена. stopped - остановка успела
+    повлиять на выполнение (команда прервана или не запускалась)"""
+    
+    def __init__(self):
+        self.reason = None
+        self.deadline = None
+        self.stopped = False
+    
+    def cancel(self, reason='cancelled'):
+        if self.reason is None:
+            self.reason = reason
+    
+    def set_timeout(self, seconds):
+        """Срок выполнения от текущего момента (0 или None - без ограничения)"""
+        self.deadline = time.monotonic() + seconds if seconds else None
+    
+    def check(self):
+        """Возвращает причину остановки или None; истекший срок превращается в остановку по timeout"""
+        if self.reason is None and self.deadline is not None and time.monotonic() >= self.deadline:
+            self.cancel('timeout')
+        if self.reason is not None:
+            self.stopped = True
+        return self.reason
+
+
+# Задача обновления
+class Job:
+    """Одна задача в очереди планировщика"""
+    
+    def __init__(self, job_id, server_id, description, func, chat_id=None, user_id=None):
+        self.id = job_id
+        self.server_id = server_id
+        self.description = description
+        self.func = func
+        self.chat_id = chat_id
+        self.user_id = user_id
+        self.message_id = None
+        self.status = 'queued'
+        self.result = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.cancel_token = CancelToken()
+        # Чаты, которые получат результат: повторные запросы того же обновления присоединяются к задаче
+        self.subscribers = [chat_id] if chat_id is not None else []
+    
+    def elapsed(self):
+        """Время выполнения (или ожидания, если задача еще в очереди) в секундах"""
+        if self.started_at is None:
+            return time.time() - self.created_at
+        return (self.finished_at or time.time()) - self.started_at
+
+
+# Планировщик задач с общим пулом потоков и очередями по серверам
+class JobScheduler:
+    """Выполняет задачи в ограниченном пуле потоков, не более per_server_limit одновременно на сервер.
+    Задачи одного сервера выполняются в порядке поступления (FIFO)"""
+    
+    def __init__(self, workers=4, per_server_limit=1, on_finish=None):
+        self.workers = workers
+        self.per_server_limit = per_server_limit
+        # Вызывается после завершения каждой задачи (например, для записи в журнал)
+        self.on_finish = on_finish
+        self._cond = threading.Condition()
+        self._queues = {}
+        self._running = {}
+        self._running_per_server = {}
+        self._ids = itertools.count(1)
+        self._threads = []
+        self._stopped = False
+    
+    def start(self):
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._worker, name=f'job-worker-{i + 1}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+    
+    def submit(self, server_id, description, func, chat_id=None, user_id=None, job_id=None):
+        """Ставит задачу в очередь сервера. Возвращает задачу и количество задач перед ней.
+        job_id - номер из внешнего журнала задач, иначе номер выдает планировщик"""
+        with self._cond:
+            job = Job(job_id or next(self._ids), server_id, description, func, chat_id, user_id)
+            queue = self._queues.setdefault(server_id, deque())
+            queue.append(job)
+            ahead = len(queue) - 1
+            if self._running_per_server.get(server_id, 0) >= self.per_server_limit:
+                ahead += self._running_per_server[server_id]
+            self._cond.notify()
+        logger.info(f"Задача #{job.id} ({server_id}: {description}) поставлена в очередь, перед ней {ahead}")
+        return job, ahead
+    
+    def snapshot(self):
+        """Возвращает копии списков выполняющихся и ожидающих задач"""
+        with self._cond:
+            running = sorted(self._running.values(), key=lambda job: job.id)
+            queued = sorted((job for queue in self._queues.values() for job in queue), key=lambda job: job.id)
+        return running, queued
+    
+    def find(self, job_id):
+        """Выполняющаяся или ожидающая задача по номеру, None если такой нет"""
+        with self._cond:
+            job = self._running.get(job_id)
+            if job is None:
+                job = next((job for queue in self._queues.values() for job in queue if job.id == job_id), None)
+        return job
+    
+    def cancel(self, job_id):
+        """Отменяет задачу: ожидающая сразу убирается из очереди, у выполняющейся срабатывает
+        cancel_token (ее команды останавливаются). Возвращает задачу или None, если она уже завершилась"""
+        with self._cond:
+            job = self._running.get(job_id)
+            if job is not None:
+                job.cancel_token.cancel()
+                logger.info(f"Задача #{job_id} отменяется")
+                return job
+            queue = next((queue for queue in self._queues.values() if any(job.id == job_id for job in queue)), None)
+            if queue is None:
+                return None
+            job = next(job for job in queue if job.id == job_id)
+            queue.remove(job)
+            job.cancel_token.cancel()
+            job.status = 'cancelled'
+            job.finished_at = time.time()
+        logger.info(f"Задача #{job_id} отменена до запуска")
+        self._notify_finish(job)
+        return job
+    
+    def shutdown(self):
+        """Останавливает потоки: выполняющиеся задачи доработают, ожидающие не запускаются
+        (в журнале они остаются незавершенными и восстанавливаются при следующем запуске)"""
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+    
+    def _next_runnable(self):
+        # Из голов очередей серверов со свободными слотами берем самую старую задачу
+        candidates = [queue[0] for server_id, queue in self._queues.items()
+                      if queue and self._running_per_server.get(server_id, 0) < self.per_server_limit]
+        if not candidates:
+            return None
+        job = min(candidates, key=lambda job: job.id)
+        self._queues[job.server_id].popleft()
+        return job
+    
+    def _worker(self):
+        while True:
+            with self._cond:
+                job = None if self._stopped else self._next_runnable()
+                while job is None:
+                    if self._stopped:
+                        return
+                    self._cond.wait()
+                    job = None if self._stopped else self._next_runnable()
+                job.status = 'running'
+                job.started_at = time.time()
+                self._running[job.id] = job
+                self._running_per_server[job.server_id] = self._running_per_server.get(job.server_id, 0) + 1
+            
+            try:
+                job.result = job.func(job)
+                # Остановленная задача завершается штатно, но итог у нее свой; отмена, пришедшая
+                # уже после всех команд (во время отправки результата), итог не меняет
+                job.status = job.cancel_token.reason if job.cancel_token.stopped else 'done'
+            except Exception as e:
+                job.status = 'failed'
+                logger.error(f"Ошибка выполнения задачи #{job.id}: {e}")
+            finally:
+                job.finished_at = time.time()
+                self._notify_finish(job)
+                with self._cond:
+                    self._running.pop(job.id, None)
+                    self._running_per_server[job.server_id] -= 1
+                    # Освободился слот сервера - будим все потоки, подходящая задача может быть у любого
+                    self._cond.notify_all()
+    
+    def _notify_finish(self, job):
+        if self.on_finish is not None:
+            try:
+                self.on_finish(job)
+            except Exception as e:
+                logger.error(f"Ошибка обработки завершения задачи #{job.id}: {e}")
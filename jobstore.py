@@ -0,0 +1,162 @@
+import heapq
+import itertools
+import logging
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    server_id TEXT NOT NULL,
+    pc_number INTEGER,
+    pc_numbers TEXT,
+    force INTEGER NOT NULL DEFAULT 0,
+    user_id INTEGER,
+    chat_id INTEGER,
+    description TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'queued',
+    exit_status INTEGER,
+    created_at REAL NOT NULL,
+    started_at REAL,
+    finished_at REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_server_time_pc ON jobs (server_id, created_at, pc_number, pc_numbers);
+CREATE INDEX IF NOT EXISTS jobs_user_time ON jobs (user_id, created_at);
+CREATE INDEX IF NOT EXISTS jobs_time ON jobs (created_at);
+CREATE INDEX IF NOT EXISTS jobs_unfinished ON jobs (id) WHERE finished_at IS NULL;
+"""
+
+_COLUMNS = ('id', 'server_id', 'pc_number', 'pc_numbers', 'force', 'user_id', 'chat_id', 'description',
+            'status', 'exit_status', 'created_at', 'started_at', 'finished_at')
+
+
+# Запрос истории одного сервера (server_id=None - всех), новые задачи первыми
+def _history_query(server_id, pc_number, limit):
+    query = f"SELECT {', '.join(_COLUMNS)} FROM jobs"
+    conditions = []
+    params = []
+    if server_id is not None:
+        conditions.append("server_id = ?")
+        params.append(server_id)
+    if pc_number is not None:
+        conditions.append("(pc_number = ? OR ',' || pc_numbers || ',' LIKE ?)")
+        params.extend([pc_number, f'%,{pc_number},%'])
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    query += " ORDER BY created_at DESC LIMIT ?"
+    params.append(limit)
+    return query, params
+
+
+# Хранилище задач обновления в SQLite
+class JobStore:
+    """Журнал задач в SQLite (WAL): новая задача записывается сразу, чтобы пережить перезапуск,
+    а итоги завершенных задач копятся и записываются пачками раз в flush_interval секунд"""
+    
+    def __init__(self, path, flush_interval=1.0, batch_size=100):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(_SCHEMA)
+        self._migrate()
+        self._lock = threading.Lock()
+        self._finished = []
+        self._wakeup = threading.Event()
+        self._stopped = False
+        self._thread = None
+    
+    def _migrate(self):
+        """Добавляет столбцы, появившиеся после создания базы"""
+        columns = {row['name'] for row in self._conn.execute("PRAGMA table_info(jobs)")}
+        if 'pc_numbers' not in columns:
+            self._conn.execute("ALTER TABLE jobs ADD COLUMN pc_numbers TEXT")
+        # Фильтр по ПК проверяет и pc_numbers - оба индекса заменил jobs_server_time_pc
+        self._conn.execute("DROP INDEX IF EXISTS jobs_server_time")
+        self._conn.execute("DROP INDEX IF EXISTS jobs_server_pc_time")
+    
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='job-store', daemon=True)
+        self._thread.start()
+    
+    def stop(self):
+        self._stopped = True
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+        self.flush()
+    
+    def add(self, server_id, pc_number, force, user_id, chat_id, description, pc_numbers=None):
+        """Записывает новую задачу и возвращает ее номер.
+        pc_numbers - список ПК для обновления выбранных компьютеров (хранится через запятую)"""
+        pc_numbers = ','.join(str(number) for number in pc_numbers) if pc_numbers else None
+        with self._lock:
+            cursor = self._conn.execute(
+                "INSERT INTO jobs (server_id, pc_number, pc_numbers, force, user_id, chat_id, description, created_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (server_id, pc_number, pc_numbers, int(bool(force)), user_id, chat_id, description, time.time()))
+            return cursor.lastrowid
+    
+    def finish(self, job_id, status, exit_status=None, started_at=None, finished_at=None):
+        """Ставит итог задачи в очередь на запись (записывается пачкой)"""
+        with self._lock:
+            self._finished.append((status, exit_status, started_at, finished_at or time.time(), job_id))
+            full = len(self._finished) >= self.batch_size
+        if full:
+            self._wakeup.set()
+    
+    def flush(self):
+        """Записывает накопленные итоги одной транзакцией"""
+        with self._lock:
+            batch, self._finished = self._finished, []
+            if not batch:
+                return
+            try:
+                with self._conn:
+                    self._conn.execute("BEGIN")
+                    self._conn.executemany(
+                        "UPDATE jobs SET status = ?, exit_status = ?, started_at = ?, finished_at = ? WHERE id = ?",
+                        batch)
+            except sqlite3.Error as e:
+                logger.error(f"Ошибка записи итогов задач: {e}")
+                self._finished = batch + self._finished
+    
+    def unfinished(self):
+        """Задачи, прерванные перезапуском (в порядке поступления)"""
+        self.flush()
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT {', '.join(_COLUMNS)} FROM jobs WHERE finished_at IS NULL ORDER BY id").fetchall()
+        return [dict(row) for row in rows]
+    
+    def history(self, server_ids=None, pc_number=None, limit=20):
+        """Последние задачи, новые первыми. server_ids=None - по всем серверам.
+        pc_number находит и задачи по выбранным компьютерам, в которые входит этот ПК"""
+        self.flush()
+        with self._lock:
+            if server_ids is None:
+                rows = self._conn.execute(*_history_query(None, pc_number, limit)).fetchall()
+            else:
+                # По каждому серверу - отдельный запрос по индексу jobs_server_time_pc без сортировки;
+                # с IN (...) SQLite сортировал бы всю историю выбранных серверов
+                rows = heapq.merge(*(self._conn.execute(*_history_query(server_id, pc_number, limit)).fetchall()
+                                     for server_id in server_ids),
+                                   key=lambda row: row['created_at'], reverse=True)
+            return [dict(row) for row in itertools.islice(rows, limit)]
+    
+    def close(self):
+        self.stop()
+        with self._lock:
+            self._conn.close()
+    
+    def _run(self):
+        while not self._stopped:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self.flush()
@@ -0,0 +1,219 @@
+import bisect
+import logging
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+logger = logging.getLogger(__name__)
+
+# Границы корзин гистограмм (секунды): от быстрых вызовов API до долгих запусков fre.sh
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def _format_value(value):
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class Counter:
+    """Счетчик с метками"""
+    
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+    
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels[name]) for name in self.labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+    
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            values = sorted(self._values.items())
+        for key, value in values:
+            lines.append(f"{self.name}{_format_labels(self.labels, key)} {_format_value(value)}")
+        return lines
+
+
+class _Series:
+    def __init__(self, buckets, window):
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        # Последние window значений - для точных перцентилей в /stats
+        self.recent = deque(maxlen=window)
+
+
+class Histogram:
+    """Гистограмма длительностей с метками: корзины для Prometheus
+    и скользящее окно последних значений для перцентилей"""
+    
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS, window=1024):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self.window = window
+        self._series = {}
+        self._lock = threading.Lock()
+    
+    def observe(self, value, **labels):
+        key = tuple(str(labels[name]) for name in self.labels)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = _Series(self.buckets, self.window)
+            series.counts[bisect.bisect_left(self.buckets, value)] += 1
+            series.sum += value
+            series.count += 1
+            series.recent.append(value)
+    
+    @contextmanager
+    def time(self, **labels):
+        """Замеряет длительность блока with (в том числе завершившегося исключением)"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+    
+    def percentiles(self, quantiles=(0.5, 0.95, 0.99)):
+        """Возвращает {метки: (количество, [перцентили])} по последним значениям каждой серии"""
+        with self._lock:
+            snapshot = {key: (series.count, sorted(series.recent)) for key, series in self._series.items()}
+        result = {}
+        for key, (count, values) in sorted(snapshot.items()):
+            if values:
+                result[key] = (count, [values[min(len(values) - 1, int(q * len(values)))] for q in quantiles])
+        return result
+    
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series_list = sorted((key, list(series.counts), series.sum, series.count)
+                                 for key, series in self._series.items())
+        for key, counts, total, count in series_list:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                le = '+Inf' if bound == float('inf') else _format_value(bound)
+                lines.append(f"{self.name}_bucket{_format_labels(self.labels, key, [('le', le)])} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, key)} {total!r}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, key)} {count}")
+        return lines
+
+
+class Gauge:
+    """Значение, которое вычисляется в момент чтения: func() возвращает число
+    или словарь {кортеж значений меток: число}"""
+    
+    def __init__(self, name, help, func, labels=()):
+        self.name = name
+        self.help = help
+        self.func = func
+        self.labels = tuple(labels)
+    
+    def values(self):
+        try:
+            value = self.func()
+        except Exception as e:
+            logger.error(f"Ошибка вычисления метрики {self.name}: {e}")
+            return {}
+        return value if isinstance(value, dict) else {(): value}
+    
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge"]
+        for key, value in sorted(self.values().items()):
+            lines.append(f"{self.name}{_format_labels(self.labels, key)} {_format_value(value)}")
+        return lines
+
+
+# Реестр метрик бота
+class MetricsRegistry:
+    """Хранит метрики и отдает их в текстовом формате Prometheus"""
+    
+    def __init__(self):
+        self.metrics = []
+    
+    def counter(self, name, help, labels=()):
+        metric = Counter(name, help, labels)
+        self.metrics.append(metric)
+        return metric
+    
+    def histogram(self, name, help, labels=(), **kwargs):
+        metric = Histogram(name, help, labels, **kwargs)
+        self.metrics.append(metric)
+        return metric
+    
+    def gauge(self, name, help, func, labels=()):
+        metric = Gauge(name, help, func, labels)
+        self.metrics.append(metric)
+        return metric
+    
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+# HTTP сервер для сбора метрик Prometheus
+class MetricsServer:
+    """Отдает registry.render() по GET /metrics"""
+    
+    def __init__(self, registry, host='127.0.0.1', port=9464):
+        self.registry = registry
+        self.host = host
+        self.port = port
+        self._httpd = None
+    
+    def _make_handler(self):
+        registry = self.registry
+        
+        class Handler(BaseHTTPRequestHandler):
+            timeout = 10
+            
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_response(404)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                body = registry.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            
+            def log_message(self, format, *args):
+                logger.debug(f"{self.address_string()} {format % args}")
+        
+        return Handler
+    
+    def start(self):
+        self._httpd = HTTPServer((self.host, self.port), self._make_handler())
+        self.port = self._httpd.server_port
+        threading.Thread(target=self._httpd.serve_forever, name='metrics-http', daemon=True).start()
+        logger.info(f"Метрики доступны на http://{self.host}:{self.port}/metrics")
+    
+    def stop(self):
+        if self._httpd is not None:
+            self._httpd.shutdown()
+            self._httpd.server_close()
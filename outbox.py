@@ -0,0 +1,277 @@
+import itertools
+import logging
+import threading
+import time
+from concurrent.futures import Future
+
+import requests
+from telebot.apihelper import ApiTelegramException
+from urllib3.exceptions import ConnectTimeoutError, NewConnectionError
+
+logger = logging.getLogger(__name__)
+
+# Приоритеты: ответы на нажатия кнопок уходят раньше сообщений и редактирований
+PRIORITY_CALLBACK = 0
+PRIORITY_MESSAGE = 1
+
+# Эти вызовы создают новое сообщение: повтор после таймаута ответа может его продублировать
+NON_IDEMPOTENT = ('send_message', 'reply_to', 'send_document')
+
+# Как часто убирать ведра и блокировки чатов, в которые давно ничего не отправлялось
+PRUNE_INTERVAL = 60
+
+
+class TokenBucket:
+    """Ведро токенов: rate токенов в секунду, не больше burst накопленных"""
+    
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+    
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+    
+    def delay(self, now):
+        """Через сколько секунд появится токен (0 - уже есть)"""
+        self._refill(now)
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+    
+    def take(self, now):
+        self._refill(now)
+        self.tokens -= 1
+    
+    def full(self, now):
+        """Ведро снова полное - его можно удалить и создать заново без потери состояния"""
+        self._refill(now)
+        return self.tokens >= self.burst
+
+
+# Соединение с Telegram не установилось - запрос точно не отправлен, повтор не создаст дубль
+def _not_sent(error):
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], 'reason', None) if error.args else None
+    return isinstance(reason, (NewConnectionError, ConnectTimeoutError))
+
+
+class _Request:
+    """Один вызов Bot API в очереди"""
+    
+    def __init__(self, seq, priority, chat_id, method, args, kwargs, coalesce_key, wait_result):
+        self.seq = seq
+        self.priority = priority
+        self.chat_id = chat_id
+        self.method = method
+        self.args = args
+        self.kwargs = kwargs
+        self.coalesce_key = coalesce_key
+        self.wait_result = wait_result
+        self.attempts = 0
+        self.future = Future()
+
+
+# Единая очередь исходящих запросов к Telegram
+class TelegramOutbox:
+    """Отправляет запросы Bot API из нескольких потоков с ограничением скорости по чату и общей.
+    Запросы одного чата уходят по порядку и по одному; 429 и сетевые ошибки повторяются
+    с учетом retry_after (отправка новых сообщений - только если запрос не ушел); несколько ожидающих редактирований одного сообщения сливаются в одно.
+    observe(метод, секунды, исход) получает длительность каждого вызова API (ok, retry, error)"""
+    
+    def __init__(self, bot, global_rate=25, chat_rate=1, chat_burst=3, workers=4, max_retries=5, observe=None):
+        self.bot = bot
+        self.observe = observe
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.workers = workers
+        self.max_retries = max_retries
+        self._global_bucket = TokenBucket(global_rate, global_rate)
+        self._chat_buckets = {}
+        self._blocked_until = {}
+        self._pending = []
+        self._coalesced = {}
+        self._in_flight = set()
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._threads = []
+        self._stopped = False
+        self._next_prune = time.monotonic() + PRUNE_INTERVAL
+    
+    def start(self):
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._worker, name=f'tg-send-{i + 1}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+    
+    def stop(self, timeout=10):
+        """Дожидается отправки очереди, но не дольше timeout секунд"""
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        deadline = time.monotonic() + timeout
+        for thread in self._threads:
+            thread.join(max(0, deadline - time.monotonic()))
+        left = self.pending()
+        if left:
+            logger.warning(f"Не отправлено запросов при остановке: {left}")
+    
+    def pending(self, chat_id=None):
+        """Количество запросов, ожидающих отправки; для chat_id - еще и отправляемый в этот чат"""
+        with self._cond:
+            if chat_id is None:
+                return len(self._pending)
+            return sum(request.chat_id == chat_id for request in self._pending) + (chat_id in self._in_flight)
+    
+    def submit(self, method, chat_id, *args, priority=PRIORITY_MESSAGE, coalesce_key=None, wait_result=True, **kwargs):
+        """Ставит вызов bot.<method>(*args, **kwargs) в очередь и возвращает Future с результатом"""
+        with self._cond:
+            if coalesce_key is not None:
+                request = self._coalesced.get(coalesce_key)
+                if request is not None:
+                    # Запрос еще не отправлен - достаточно отправить последнюю версию
+                    request.args, request.kwargs = args, kwargs
+                    return request.future
+            request = _Request(next(self._seq), priority, chat_id, method, args, kwargs, coalesce_key, wait_result)
+            self._pending.append(request)
+            if coalesce_key is not None:
+                self._coalesced[coalesce_key] = request
+            self._cond.notify()
+        return request.future
+    
+    # Обертки с сигнатурами TeleBot: отправка ждет результата (нужен message_id),
+    # редактирования и ответы на callback уходят в фоне
+    def send_message(self, chat_id, text, **kwargs):
+        return self.submit('send_message', chat_id, chat_id, text, **kwargs).result()
+    
+    def reply_to(self, message, text, **kwargs):
+        return self.submit('reply_to', message.chat.id, message, text, **kwargs).result()
+    
+    def send_document(self, chat_id, document, **kwargs):
+        return self.submit('send_document', chat_id, chat_id, document, **kwargs).result()
+    
+    # Отправка в фоне: возвращают Future с сообщением, ошибка пишется в лог. Для потоков, которые
+    # не должны ждать очереди чата (задачи обновления держат слот сервера)
+    def post_message(self, chat_id, text, **kwargs):
+        return self.submit('send_message', chat_id, chat_id, text, wait_result=False, **kwargs)
+    
+    def post_document(self, chat_id, document, **kwargs):
+        return self.submit('send_document', chat_id, chat_id, document, wait_result=False, **kwargs)
+    
+    def edit_message_text(self, text, chat_id, message_id, **kwargs):
+        return self.submit('edit_message_text', chat_id, text, chat_id, message_id,
+                           coalesce_key=(chat_id, message_id), wait_result=False, **kwargs)
+    
+    def answer_callback_query(self, callback_query_id, text=None, show_alert=None, **kwargs):
+        return self.submit('answer_callback_query', None, callback_query_id, text, show_alert,
+                           priority=PRIORITY_CALLBACK, wait_result=False, **kwargs)
+    
+    def _chat_delay(self, chat_id, now):
+        delay = self._blocked_until.get(chat_id, 0) - now
+        if chat_id is not None:
+            bucket = self._chat_buckets.get(chat_id)
+            if bucket is None:
+                bucket = self._chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+            delay = max(delay, bucket.delay(now))
+        return delay
+    
+    def _prune(self, now):
+        """Удаляет состояние чатов без очереди: полные ведра и истекшие блокировки"""
+        busy = {request.chat_id for request in self._pending} | self._in_flight
+        for chat_id in [chat_id for chat_id, bucket in self._chat_buckets.items()
+                        if chat_id not in busy and bucket.full(now)]:
+            del self._chat_buckets[chat_id]
+        for chat_id in [chat_id for chat_id, until in self._blocked_until.items() if until <= now]:
+            del self._blocked_until[chat_id]
+    
+    def _next_request(self, now):
+        """Выбирает готовый к отправке запрос или возвращает (None, сколько ждать)"""
+        if now >= self._next_prune:
+            self._prune(now)
+            self._next_prune = now + PRUNE_INTERVAL
+        global_delay = max(self._global_bucket.delay(now), self._blocked_until.get(None, 0) - now)
+        best = None
+        wait = None
+        for request in self._pending:
+            if request.chat_id is not None and request.chat_id in self._in_flight:
+                continue
+            delay = max(global_delay, self._chat_delay(request.chat_id, now))
+            if delay > 0:
+                wait = delay if wait is None else min(wait, delay)
+            elif best is None or (request.priority, request.seq) < (best.priority, best.seq):
+                best = request
+        if best is None:
+            return None, wait
+        
+        self._pending.remove(best)
+        if best.coalesce_key is not None:
+            self._coalesced.pop(best.coalesce_key, None)
+        self._global_bucket.take(now)
+        if best.chat_id is not None:
+            self._chat_buckets[best.chat_id].take(now)
+            self._in_flight.add(best.chat_id)
+        return best, None
+    
+    def _worker(self):
+        while True:
+            with self._cond:
+                while True:
+                    if self._stopped and not self._pending:
+                        return
+                    request, wait = self._next_request(time.monotonic())
+                    if request is not None:
+                        break
+                    self._cond.wait(wait)
+            
+            retry_after = None
+            outcome = 'error'
+            started = time.perf_counter()
+            try:
+                result = getattr(self.bot, request.method)(*request.args, **request.kwargs)
+                outcome = 'ok'
+                request.future.set_result(result)
+            except ApiTelegramException as e:
+                if e.error_code == 429 and request.attempts < self.max_retries:
+                    retry_after = (e.result_json or {}).get('parameters', {}).get('retry_after', 1)
+                    logger.warning(f"Telegram просит подождать {retry_after}с ({request.method}, чат {request.chat_id})")
+                else:
+                    self._fail(request, e)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                # Таймаут ответа не значит, что сообщение не дошло - новые сообщения повторяем,
+                # только если соединение не установилось
+                if request.attempts < self.max_retries and (request.method not in NON_IDEMPOTENT or _not_sent(e)):
+                    retry_after = min(2 ** request.attempts, 30)
+                    logger.warning(f"Сетевая ошибка {request.method}, повтор через {retry_after}с: {e}")
+                else:
+                    self._fail(request, e)
+            except Exception as e:
+                self._fail(request, e)
+            if self.observe is not None:
+                self.observe(request.method, time.perf_counter() - started, 'retry' if retry_after is not None else outcome)
+            
+            with self._cond:
+                self._in_flight.discard(request.chat_id)
+                if retry_after is not None:
+                    request.attempts += 1
+                    # Запрос остается первым в своей очереди, чат (или вся очередь) ждет retry_after
+                    self._blocked_until[request.chat_id] = time.monotonic() + retry_after
+                    for value in list(request.args) + list(request.kwargs.values()):
+                        # Файл отправляется заново с начала; у types.InputFile поток лежит в .file
+                        stream = getattr(value, 'file', value)
+                        if hasattr(stream, 'seek'):
+                            stream.seek(0)
+                    if request.coalesce_key is not None and request.coalesce_key in self._coalesced:
+                        # Пока ждали, пришла более новая версия - старую не отправляем
+                        request.future.set_result(None)
+                    else:
+                        self._pending.append(request)
+                        if request.coalesce_key is not None:
+                            self._coalesced[request.coalesce_key] = request
+                self._cond.notify_all()
+    
+    def _fail(self, request, error):
+        request.future.set_exception(error)
+        if not request.wait_result and 'message is not modified' not in str(error):
+            # Результат фоновых запросов никто не ждет - ошибку хотя бы пишем в лог
+            logger.error(f"Ошибка {request.method} (чат {request.chat_id}): {error}")
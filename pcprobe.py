@@ -0,0 +1,111 @@
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Состояния ПК и значки на кнопках меню
+PC_STATE_ICONS = {'free': '🟢', 'busy': '🔴', 'off': '⚫'}
+
+# Проверка всех ПК страницы одной командой на сервере TrueNAS. ПК занят, если у него есть
+# установленное соединение с сервером на одном из портов {ports} (iSCSI, SMB), иначе он
+# свободен, если отвечает на ping, и выключен, если не отвечает. Вывод: строка "<ip> <состояние>" на ПК
+DEFAULT_PROBE_COMMAND = (
+    "busy=\" $(ss -Htn state established '( {port_filter} )' 2>/dev/null | tr '\\n' ' ') \"; "
+    "for ip in {ips}; do "
+    "( case \"$busy\" in *\" $ip:\"*) echo \"$ip busy\";; "
+    "*) if ping -c 1 -W 1 \"$ip\" >/dev/null 2>&1; then echo \"$ip free\"; else echo \"$ip off\"; fi;; esac ) & "
+    "done; wait"
+)
+
+
+def build_probe_command(ips, ports=(3260, 445), template=None):
+    """Команда проверки списка IP (template с {ips} заменяет встроенную)"""
+    if template:
+        return template.format(ips=' '.join(ips))
+    port_filter = ' or '.join(f"sport = :{port}" for port in ports)
+    return DEFAULT_PROBE_COMMAND.format(port_filter=port_filter, ips=' '.join(ips))
+
+
+def parse_probe_output(output, ips):
+    """Разбирает вывод проверки в {ip: состояние}; ПК без ответа в выводе не попадают"""
+    states = {}
+    for line in output.splitlines():
+        parts = line.split()
+        if len(parts) == 2 and parts[0] in ips and parts[1] in PC_STATE_ICONS:
+            states[parts[0]] = parts[1]
+    return states
+
+
+# Кэш состояний ПК по страницам меню
+class PCStatusProbe:
+    """Состояния ПК одной страницы меню (server_id, page) хранятся ttl секунд.
+    Проверка выполняется в executor одной удаленной командой на страницу; одновременные
+    запросы одной страницы ждут общую проверку"""
+    
+    def __init__(self, run_command, executor, ttl=20, ports=(3260, 445), template=None):
+        self.run_command = run_command
+        self.executor = executor
+        self.ttl = ttl
+        self.ports = ports
+        self.template = template
+        self._states = {}
+        self._pending = {}
+        self._lock = threading.Lock()
+    
+    @property
+    def enabled(self):
+        return self.ttl > 0
+    
+    def get(self, server_id, page):
+        """Возвращает {номер ПК: состояние} или None, если проверки не было или она устарела"""
+        with self._lock:
+            entry = self._states.get((server_id, page))
+        if entry is None or time.monotonic() - entry[0] > self.ttl:
+            return None
+        return entry[1]
+    
+    def store(self, server_id, page, states):
+        with self._lock:
+            self._states[(server_id, page)] = (time.monotonic(), states)
+    
+    def invalidate(self, server_id):
+        """Сбрасывает состояния всех страниц сервера (например, после обновления ПК)"""
+        with self._lock:
+            for key in [key for key in self._states if key[0] == server_id]:
+                del self._states[key]
+    
+    def command(self, pcs):
+        """Команда проверки для {номер ПК: IP}"""
+        return build_probe_command(list(pcs.values()), self.ports, self.template)
+    
+    def parse(self, output, pcs):
+        by_ip = parse_probe_output(output, set(pcs.values()))
+        return {pc_number: by_ip[ip] for pc_number, ip in pcs.items() if ip in by_ip}
+    
+    def request(self, server_id, page, server_config, pcs, on_done):
+        """Запускает проверку страницы в фоне и вызывает on_done(states) по готовности
+        (states - None при ошибке). Если проверка страницы уже идет, on_done ждет ее"""
+        key = (server_id, page)
+        with self._lock:
+            callbacks = self._pending.get(key)
+            if callbacks is not None:
+                callbacks.append(on_done)
+                return
+            self._pending[key] = [on_done]
+        self.executor.submit(self._probe, key, server_config, pcs)
+    
+    def _probe(self, key, server_config, pcs):
+        states = None
+        try:
+            states = self.parse(self.run_command(server_config, self.command(pcs)), pcs)
+            self.store(key[0], key[1], states)
+        except Exception as e:
+            logger.warning(f"Не удалось проверить состояние ПК на {server_config['name']}: {e}")
+        with self._lock:
+            callbacks = self._pending.pop(key, [])
+        for callback in callbacks:
+            try:
+                callback(states)
+            except Exception as e:
+                logger.error(f"Ошибка обновления меню после проверки ПК: {e}")
@@ -0,0 +1,136 @@
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+# Хранилище состояний пользователей (последний сервер и страница меню)
+class SessionStore:
+    """Состояния чатов с ограниченным сроком жизни (ttl) и размером (max_entries):
+    при переполнении вытесняется давно не использованное. Если задан path, состояния
+    сохраняются в JSON файл раз в save_interval секунд и загружаются при старте"""
+    
+    def __init__(self, ttl=7 * 24 * 3600, max_entries=10000, path=None, save_interval=30):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.path = path
+        self.save_interval = save_interval
+        # Порядок - от давно использованных к недавним; значение - (время обращения, состояние)
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+        self._dirty = False
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expired = 0
+        self._stop = threading.Event()
+        self._thread = None
+    
+    def get(self, chat_id):
+        """Возвращает копию состояния чата или None"""
+        now = time.time()
+        with self._lock:
+            entry = self._sessions.get(chat_id)
+            if entry is None:
+                self.misses += 1
+                return None
+            if now - entry[0] > self.ttl:
+                del self._sessions[chat_id]
+                self.expired += 1
+                self.misses += 1
+                self._dirty = True
+                return None
+            self._sessions[chat_id] = (now, entry[1])
+            self._sessions.move_to_end(chat_id)
+            self.hits += 1
+            return dict(entry[1])
+    
+    def update(self, chat_id, **fields):
+        """Дополняет состояние чата полями fields (None - удалить поле)"""
+        now = time.time()
+        with self._lock:
+            entry = self._sessions.pop(chat_id, None)
+            state = dict(entry[1]) if entry is not None and now - entry[0] <= self.ttl else {}
+            for key, value in fields.items():
+                if value is None:
+                    state.pop(key, None)
+                else:
+                    state[key] = value
+            self._sessions[chat_id] = (now, state)
+            while len(self._sessions) > self.max_entries:
+                self._sessions.popitem(last=False)
+                self.evictions += 1
+            self._dirty = True
+    
+    def purge(self):
+        """Удаляет устаревшие состояния (они всегда в начале порядка)"""
+        cutoff = time.time() - self.ttl
+        with self._lock:
+            while self._sessions:
+                chat_id, (used_at, _) = next(iter(self._sessions.items()))
+                if used_at > cutoff:
+                    break
+                del self._sessions[chat_id]
+                self.expired += 1
+                self._dirty = True
+    
+    def stats(self):
+        with self._lock:
+            return {'size': len(self._sessions), 'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions, 'expired': self.expired}
+    
+    def load(self):
+        """Загружает сохраненные состояния, пропуская устаревшие"""
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                entries = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.error(f"Не удалось загрузить состояния пользователей из {self.path}: {e}")
+            return
+        cutoff = time.time() - self.ttl
+        with self._lock:
+            for chat_id, used_at, state in sorted(entries, key=lambda entry: entry[1])[-self.max_entries:]:
+                if used_at > cutoff:
+                    self._sessions[int(chat_id)] = (used_at, state)
+        logger.info(f"Загружено состояний пользователей: {len(self._sessions)}")
+    
+    def save(self):
+        """Записывает состояния в файл, если они изменились (через временный файл)"""
+        if not self.path:
+            return
+        with self._lock:
+            if not self._dirty:
+                return
+            entries = [[chat_id, used_at, state] for chat_id, (used_at, state) in self._sessions.items()]
+            self._dirty = False
+        temp_path = self.path + '.tmp'
+        try:
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump(entries, f, ensure_ascii=False)
+            os.replace(temp_path, self.path)
+        except OSError as e:
+            logger.error(f"Не удалось сохранить состояния пользователей в {self.path}: {e}")
+            with self._lock:
+                self._dirty = True
+    
+    def start(self):
+        self.load()
+        self._thread = threading.Thread(target=self._run, name='session-store', daemon=True)
+        self._thread.start()
+    
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+        self.save()
+    
+    def _run(self):
+        while not self._stop.wait(self.save_interval):
+            self.purge()
+            self.save()
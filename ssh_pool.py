@@ -0,0 +1,243 @@
+import logging
+import socket
+import threading
+import time
+from contextlib import contextmanager
+
+from sshkeys import KeyCache, KnownHosts
+
+logger = logging.getLogger(__name__)
+
+
+class SSHPoolError(Exception):
+    """Ошибка получения соединения или канала из пула"""
+
+
+class _PoolEntry:
+    """Состояние одного сервера в пуле: транспорт и лимит каналов"""
+    
+    def __init__(self, max_channels):
+        self.lock = threading.Lock()
+        self.channels = threading.BoundedSemaphore(max_channels)
+        self.transport = None
+        self.fingerprint = None
+        self.connected_at = None
+        self.connect_time = None
+
+
+# Пул постоянных SSH соединений (по одному транспорту на сервер)
+class SSHConnectionPool:
+    """Держит авторизованные транспорты по server_id и открывает канал на каждую команду.
+    Ключ хоста сверяется с known_hosts (KnownHosts), закрытые ключи клиента кэшируются.
+    observe(server_id, операция, секунды) получает длительность подключения (connect),
+    SSH рукопожатия (handshake), авторизации по ключу или паролю (auth_key, auth_password)
+    и открытия канала (channel)"""
+    
+    def __init__(self, keepalive=30, max_channels=4, connect_timeout=30, channel_wait=60, observe=None,
+                 known_hosts=None):
+        self.keepalive = keepalive
+        self.max_channels = max_channels
+        self.connect_timeout = connect_timeout
+        self.channel_wait = channel_wait
+        self.observe = observe
+        self.known_hosts = known_hosts if known_hosts is not None else KnownHosts()
+        self.keys = KeyCache(self._load_key)
+        self._entries = {}
+        self._lock = threading.Lock()
+    
+    def _entry(self, server_id):
+        with self._lock:
+            entry = self._entries.get(server_id)
+            if entry is None:
+                entry = _PoolEntry(self.max_channels)
+                self._entries[server_id] = entry
+            return entry
+    
+    @staticmethod
+    def _fingerprint(server_config):
+        """Параметры подключения, при изменении которых транспорт нужно пересоздать"""
+        return (server_config['hostname'], server_config.get('port', 22), server_config['username'],
+                server_config['password'], server_config.get('key_path'), server_config.get('key_passphrase'))
+    
+    @staticmethod
+    def _load_key(path, passphrase):
+        import paramiko
+        
+        return paramiko.PKey.from_path(path, passphrase.encode('utf-8') if passphrase else None)
+    
+    @staticmethod
+    def _is_alive(transport):
+        if transport is None or not transport.is_active():
+            return False
+        try:
+            # Пустой пакет сразу выявляет оборванное соединение
+            transport.send_ignore()
+        except Exception:
+            return False
+        return True
+    
+    def _observe(self, server_config, operation, seconds):
+        if self.observe is not None:
+            self.observe(server_config['id'], operation, seconds)
+    
+    def _connect(self, server_config, timeout):
+        # paramiko загружается при первом подключении: это ~150 мс запуска бота,
+        # а асинхронной среде выполнения он не нужен вовсе
+        import paramiko
+        
+        hostname = server_config['hostname']
+        port = server_config.get('port', 22)
+        logger.info(f"Подключение к {server_config['name']}")
+        # TCP соединение, рукопожатие и авторизацию выполняем по шагам, чтобы замерить каждый
+        started = time.perf_counter()
+        sock = socket.create_connection((hostname, port), timeout)
+        connected = time.perf_counter()
+        self._observe(server_config, 'connect', connected - started)
+        transport = paramiko.Transport(sock)
+        try:
+            transport.banner_timeout = timeout
+            transport.handshake_timeout = timeout
+            transport.auth_timeout = timeout
+            known = self.known_hosts.lookup(hostname, port)
+            options = transport.get_security_options()
+            if set(known) & set(options.key_types):
+                # Согласуем только типы ключей хоста, которые уже сохранены, иначе сервер
+                # может предъявить ключ другого типа и он будет принят как новый
+                options.key_types = [key_type for key_type in options.key_types if key_type in known]
+            transport.start_client(timeout=timeout)
+            host_key = transport.get_remote_server_key()
+            self.known_hosts.check(hostname, port, host_key.get_name(), host_key.get_base64())
+            self._observe(server_config, 'handshake', time.perf_counter() - connected)
+            self._authenticate(transport, server_config)
+        except Exception:
+            transport.close()
+            sock.close()
+            raise
+        transport.set_keepalive(self.keepalive)
+        return transport
+    
+    def _authenticate(self, transport, server_config):
+        """Авторизация по ключу (SERVER_i_KEY_PATH), при неудаче или без ключа - по паролю"""
+        import paramiko
+        
+        username = server_config['username']
+        key_path = server_config.get('key_path')
+        if key_path:
+            try:
+                key = self.keys.get(key_path, server_config.get('key_passphrase'))
+                started = time.perf_counter()
+                transport.auth_publickey(username, key)
+                self._observe(server_config, 'auth_key', time.perf_counter() - started)
+                return
+            except (paramiko.SSHException, OSError, ValueError) as e:
+                if not server_config.get('password') or not transport.is_active():
+                    raise
+                logger.warning(f"Авторизация по ключу на {server_config['name']} не удалась ({e}), используется пароль")
+        started = time.perf_counter()
+        transport.auth_password(username, server_config['password'])
+        self._observe(server_config, 'auth_password', time.perf_counter() - started)
+    
+    def _drop(self, entry):
+        if entry.transport is not None:
+            try:
+                entry.transport.close()
+            except Exception:
+                pass
+        entry.transport = None
+        entry.fingerprint = None
+        entry.connected_at = None
+        entry.connect_time = None
+    
+    def get_transport(self, server_id, server_config, timeout=None):
+        """Возвращает живой транспорт, при необходимости переподключаясь"""
+        entry = self._entry(server_id)
+        fingerprint = self._fingerprint(server_config)
+        if not entry.lock.acquire(timeout=-1 if timeout is None else timeout):
+            raise SSHPoolError(f"Подключение к {server_config['name']} уже выполняется")
+        try:
+            if entry.transport is not None and (entry.fingerprint != fingerprint or not self._is_alive(entry.transport)):
+                logger.warning(f"Соединение с {server_config['name']} потеряно, переподключение")
+                self._drop(entry)
+            if entry.transport is None:
+                started = time.monotonic()
+                entry.transport = self._connect(server_config, timeout or self.connect_timeout)
+                entry.fingerprint = fingerprint
+                entry.connected_at = time.monotonic()
+                entry.connect_time = entry.connected_at - started
+            return entry.transport
+        finally:
+            entry.lock.release()
+    
+    @contextmanager
+    def channel(self, server_id, server_config, timeout=None):
+        """Выдает новый канал на транспорте сервера с учетом лимита каналов"""
+        import paramiko
+        
+        entry = self._entry(server_id)
+        if not entry.channels.acquire(timeout=self.channel_wait if timeout is None else timeout):
+            raise SSHPoolError(f"Нет свободных каналов для {server_config['name']}")
+        try:
+            channel = None
+            for attempt in range(2):
+                transport = self.get_transport(server_id, server_config, timeout)
+                try:
+                    started = time.perf_counter()
+                    channel = transport.open_session()
+                    self._observe(server_config, 'channel', time.perf_counter() - started)
+                    break
+                except (paramiko.SSHException, EOFError, OSError) as e:
+                    # Транспорт умер между проверкой и открытием канала - пробуем еще раз
+                    with entry.lock:
+                        if entry.transport is transport:
+                            self._drop(entry)
+                    if attempt:
+                        raise SSHPoolError(f"Не удалось открыть канал к {server_config['name']}: {e}") from e
+            try:
+                yield channel
+            finally:
+                channel.close()
+        finally:
+            entry.channels.release()
+    
+    def probe(self, server_id, server_config, timeout):
+        """Проверяет сервер командой echo и возвращает (время подключения, время выполнения) в секундах.
+        Время подключения равно None, если использовано уже открытое соединение"""
+        entry = self._entry(server_id)
+        connected_before = entry.connected_at
+        with self.channel(server_id, server_config, timeout=timeout) as channel:
+            connect_time = entry.connect_time if entry.connected_at != connected_before else None
+            started = time.monotonic()
+            channel.settimeout(timeout)
+            channel.exec_command("echo 'test'")
+            channel.makefile('rb').read()
+            rtt = time.monotonic() - started
+        return connect_time, rtt
+    
+    def execute(self, server_id, server_config, command, timeout):
+        """Выполняет короткую команду с дедлайном и возвращает ее stdout (stderr отбрасывается)"""
+        with self.channel(server_id, server_config, timeout=timeout) as channel:
+            channel.settimeout(timeout)
+            channel.exec_command(command)
+            return channel.makefile('rb').read().decode('utf-8', errors='replace')
+    
+    def side_command(self, channel, command, timeout):
+        """Выполняет короткую служебную команду в отдельном канале того же соединения, что и channel,
+        вне лимита каналов: например, остановку команды, когда все каналы сервера заняты"""
+        side = channel.get_transport().open_session(timeout=timeout)
+        try:
+            side.settimeout(timeout)
+            side.exec_command(command)
+            return side.makefile('rb').read().decode('utf-8', errors='replace')
+        finally:
+            side.close()
+    
+    def close(self, server_id=None):
+        """Закрывает соединения одного сервера или всего пула"""
+        with self._lock:
+            if server_id is None:
+                entries = list(self._entries.values())
+            else:
+                entries = [self._entries[server_id]] if server_id in self._entries else []
+        for entry in entries:
+            with entry.lock:
+                self._drop(entry)
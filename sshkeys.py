@@ -0,0 +1,110 @@
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Политики проверки ключей хостов: tofu - новый ключ запоминается при первом подключении,
+# измененный отклоняется; strict - подключение только к хостам, уже записанным в known_hosts
+HOST_KEY_POLICIES = ('tofu', 'strict')
+
+
+class HostKeyError(Exception):
+    """Ключ хоста не совпадает с сохраненным или хост неизвестен при строгой проверке"""
+
+
+def host_entry(hostname, port):
+    """Имя хоста в формате known_hosts OpenSSH: host или [host]:port"""
+    return hostname if port == 22 else f"[{hostname}]:{port}"
+
+
+# Сохраненные ключи хостов
+class KnownHosts:
+    """Ключи хостов в памяти с сохранением в файл формата known_hosts
+    (строки "хост тип base64", можно дополнить выводом ssh-keyscan).
+    path=None - ключи хранятся только в памяти процесса"""
+    
+    def __init__(self, path=None, policy='tofu'):
+        if policy not in HOST_KEY_POLICIES:
+            raise ValueError(f"Неизвестная политика ключей хостов: {policy}")
+        self.path = path
+        self.policy = policy
+        self._keys = {}
+        self._lock = threading.Lock()
+    
+    def load(self):
+        """Читает файл known_hosts; хешированные имена и маски не поддерживаются и пропускаются"""
+        if not self.path or not os.path.exists(self.path):
+            return
+        keys = {}
+        with open(self.path, encoding='utf-8') as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) < 3 or parts[0].startswith(('#', '|', '@')):
+                    continue
+                for host in parts[0].split(','):
+                    keys.setdefault(host, {})[parts[1]] = parts[2]
+        with self._lock:
+            self._keys = keys
+        logger.info(f"Загружены ключи {len(keys)} хостов из {self.path}")
+    
+    def save(self):
+        if not self.path:
+            return
+        with self._lock:
+            lines = [f"{host} {key_type} {key}\n"
+                     for host, host_keys in sorted(self._keys.items())
+                     for key_type, key in sorted(host_keys.items())]
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            f.writelines(lines)
+        os.replace(temp_path, self.path)
+    
+    def lookup(self, hostname, port):
+        """Сохраненные ключи хоста: {тип: base64} (пустой словарь, если хост неизвестен)"""
+        with self._lock:
+            return dict(self._keys.get(host_entry(hostname, port), {}))
+    
+    def check(self, hostname, port, key_type, key):
+        """Проверяет ключ, предъявленный сервером. Неизвестный ключ при политике tofu запоминается,
+        иначе бросается HostKeyError"""
+        host = host_entry(hostname, port)
+        with self._lock:
+            known = self._keys.get(host, {})
+            if known.get(key_type) == key:
+                return
+            if key_type in known:
+                raise HostKeyError(f"Ключ хоста {host} ({key_type}) изменился! Если сервер переустановлен, "
+                                   f"удалите старый ключ из {self.path or 'known_hosts'}")
+            if self.policy == 'strict':
+                raise HostKeyError(f"Хост {host} отсутствует в {self.path or 'known_hosts'} (SSH_HOST_KEY_POLICY=strict)")
+            self._keys.setdefault(host, {})[key_type] = key
+        logger.warning(f"Новый ключ хоста {host} ({key_type}) сохранен")
+        try:
+            self.save()
+        except OSError as e:
+            logger.error(f"Не удалось сохранить known_hosts: {e}")
+
+
+# Кэш закрытых ключей
+class KeyCache:
+    """Закрытые ключи разбираются один раз (расшифровка ключа с паролем занимает заметное время)
+    и перечитываются только при изменении файла. loader(path, passphrase) возвращает объект ключа"""
+    
+    def __init__(self, loader):
+        self.loader = loader
+        self._keys = {}
+        self._lock = threading.Lock()
+    
+    def get(self, path, passphrase=None):
+        mtime = os.stat(path).st_mtime
+        with self._lock:
+            cached = self._keys.get((path, passphrase))
+            if cached is not None and cached[0] == mtime:
+                return cached[1]
+            started = time.perf_counter()
+            key = self.loader(path, passphrase)
+            self._keys[(path, passphrase)] = (mtime, key)
+        logger.info(f"Ключ {path} загружен за {(time.perf_counter() - started) * 1000:.0f} мс")
+        return key
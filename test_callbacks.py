@@ -0,0 +1,56 @@
+import unittest
+
+from callbacks import ACTIONS, MAX_CALLBACK_DATA, CallbackAction, CallbackCodec, action_fields
+
+
+class CallbackCodecTest(unittest.TestCase):
+    def setUp(self):
+        self.codec = CallbackCodec(['server_1', 'server_2'])
+    
+    def test_every_action_round_trips(self):
+        values = {'server': 'server_2', 'pc': 17, 'page': 3, 'job': 12345}
+        for action in ACTIONS:
+            fields = action_fields(action)
+            kwargs = {'server_id': values['server'] if 'server' in fields else None,
+                      'pc_number': values['pc'] if 'pc' in fields else None,
+                      'page': values['page'] if 'page' in fields else None,
+                      'job_id': values['job'] if 'job' in fields else None}
+            with self.subTest(action=action):
+                data = self.codec.encode(action, **kwargs)
+                self.assertLessEqual(len(data.encode('utf-8')), MAX_CALLBACK_DATA)
+                self.assertEqual(self.codec.decode(data), CallbackAction(action, *kwargs.values()))
+    
+    def test_long_server_id_is_sent_as_token(self):
+        server_id = 'datacenter-' + 'x' * 100
+        codec = CallbackCodec([server_id])
+        data = codec.encode('select_pc', server_id, 5)
+        self.assertLessEqual(len(data), MAX_CALLBACK_DATA)
+        self.assertEqual(codec.decode(data), CallbackAction('select_pc', server_id, 5, None))
+    
+    def test_unknown_server_decodes_to_none(self):
+        data = CallbackCodec(['server_9']).encode('select_server', 'server_9')
+        self.assertEqual(self.codec.decode(data), CallbackAction('select_server', None, None, None))
+    
+    def test_legacy_format_is_decoded(self):
+        cases = {
+            'select_server:server_1': CallbackAction('select_server', 'server_1', None, None),
+            'update_normal:server_2:7': CallbackAction('update_normal', 'server_2', 7, None),
+            'computers_page:server_1:2': CallbackAction('computers_page', 'server_1', None, 2),
+            'servers_page:4': CallbackAction('servers_page', None, None, 4),
+            'cancel_job:server_1:42': CallbackAction('cancel_job', 'server_1', None, None, 42),
+            'back_to_servers': CallbackAction('back_to_servers', None, None, None),
+            'select_server:server_9': CallbackAction('select_server', None, None, None),
+        }
+        for data, expected in cases.items():
+            with self.subTest(data=data):
+                self.assertEqual(self.codec.decode(data), expected)
+    
+    def test_malformed_data_is_rejected(self):
+        for data in ('', '1', '1s', '1m:abc', '1m:' + self.codec.encode('select_server', 'server_1')[3:] + ':x',
+                     '9z:1', 'unknown:server_1', 'update_normal:server_1:x', 'back_to_servers:extra'):
+            with self.subTest(data=data):
+                self.assertIsNone(self.codec.decode(data))
+
+
+if __name__ == '__main__':
+    unittest.main()
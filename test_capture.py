@@ -0,0 +1,56 @@
+import io
+import unittest
+
+from capture import CommandResult, OutputCapture
+
+
+class OutputCaptureTest(unittest.TestCase):
+    def capture(self, chunks, **limits):
+        capture = OutputCapture(**limits)
+        self.addCleanup(capture.close)
+        for chunk in chunks:
+            capture.feed(chunk)
+        return capture
+    
+    def test_short_output_is_kept_whole(self):
+        capture = self.capture(['hello ', 'world'], head_chars=10, tail_chars=10)
+        self.assertFalse(capture.truncated)
+        self.assertEqual(capture.text(), 'hello world')
+    
+    def test_long_output_keeps_head_and_tail(self):
+        chunks = [f'{i:04d}\n' for i in range(1000)]
+        capture = self.capture(chunks, head_chars=20, tail_chars=15)
+        output = ''.join(chunks)
+        self.assertTrue(capture.truncated)
+        self.assertEqual(capture.text(), output[:20] + f"\n\n... [пропущено {len(output) - 35} символов] ...\n\n"
+                         + output[-15:])
+    
+    def test_chunk_larger_than_limits_is_split(self):
+        capture = self.capture(['a' * 5 + 'b' * 100 + 'c' * 5], head_chars=5, tail_chars=5)
+        self.assertEqual(capture.text(), 'aaaaa\n\n... [пропущено 100 символов] ...\n\nccccc')
+    
+    def test_full_output_is_spooled_up_to_max_bytes(self):
+        capture = self.capture(['x' * 300, 'y' * 300], head_chars=10, tail_chars=10, spill_bytes=100, max_bytes=500)
+        target = io.BytesIO()
+        capture.copy_to(target)
+        self.assertTrue(capture.overflow)
+        self.assertEqual(target.getvalue(), b'x' * 300 + b'y' * 200)
+
+
+class CommandResultTest(unittest.TestCase):
+    def test_output_joins_stdout_and_stderr(self):
+        result = CommandResult(head_chars=100, tail_chars=100)
+        self.addCleanup(result.close)
+        result.stdout.feed('done\n')
+        result.stderr.feed('warning\n')
+        result.exit_status = 0
+        target = io.BytesIO()
+        result.copy_to(target)
+        self.assertTrue(result.ok)
+        self.assertEqual(result.output(), 'done\n\nwarning')
+        self.assertEqual(target.getvalue(), b'done\n\nwarning\n')
+        self.assertEqual(result.raw_size, len(target.getvalue()))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,106 @@
+import threading
+import time
+import unittest
+
+from jobs import JobScheduler
+
+
+class JobSchedulerTest(unittest.TestCase):
+    def make_scheduler(self, **kwargs):
+        scheduler = JobScheduler(**kwargs)
+        scheduler.start()
+        self.addCleanup(scheduler.shutdown)
+        return scheduler
+    
+    def test_per_server_limit_runs_other_servers_in_parallel(self):
+        finished = threading.Semaphore(0)
+        scheduler = self.make_scheduler(workers=4, per_server_limit=1, on_finish=lambda job: finished.release())
+        release = threading.Event()
+        started = {name: threading.Event() for name in ('first', 'second', 'other')}
+        
+        def blocking(job):
+            started[job.description].set()
+            release.wait(5)
+        
+        first, ahead_first = scheduler.submit('server_1', 'first', blocking)
+        second, ahead_second = scheduler.submit('server_1', 'second', blocking)
+        other, _ = scheduler.submit('server_2', 'other', blocking)
+        self.assertEqual((ahead_first, ahead_second), (0, 1))
+        self.assertTrue(started['first'].wait(5))
+        self.assertTrue(started['other'].wait(5))
+        self.assertFalse(started['second'].is_set())
+        self.assertEqual(scheduler.snapshot(), ([first, other], [second]))
+        release.set()
+        for _ in range(3):
+            self.assertTrue(finished.acquire(timeout=5))
+        self.assertEqual([job.status for job in (first, second, other)], ['done'] * 3)
+    
+    def test_cancel_removes_queued_job(self):
+        finished = []
+        scheduler = self.make_scheduler(workers=1, on_finish=finished.append)
+        release = threading.Event()
+        ran = []
+        running, _ = scheduler.submit('server_1', 'running', lambda job: release.wait(5))
+        queued, _ = scheduler.submit('server_1', 'queued', lambda job: ran.append(job.id))
+        self.assertIs(scheduler.cancel(queued.id), queued)
+        self.assertEqual(queued.status, 'cancelled')
+        self.assertIsNone(scheduler.find(queued.id))
+        self.assertEqual(finished, [queued])
+        release.set()
+        self.assertIsNone(scheduler.cancel(12345))
+        self.assertEqual(ran, [])
+    
+    def test_cancel_stops_running_job(self):
+        done = threading.Event()
+        scheduler = self.make_scheduler(workers=1, on_finish=lambda job: done.set())
+        started = threading.Event()
+        
+        def cancellable(job):
+            started.set()
+            while job.cancel_token.check() is None:
+                time.sleep(0.01)
+        
+        job, _ = scheduler.submit('server_1', 'running', cancellable)
+        self.assertTrue(started.wait(5))
+        self.assertIs(scheduler.cancel(job.id), job)
+        self.assertTrue(done.wait(5))
+        self.assertEqual(job.status, 'cancelled')
+    
+    def test_shutdown_leaves_queued_jobs_unstarted(self):
+        scheduler = self.make_scheduler(workers=2, per_server_limit=1)
+        started = threading.Event()
+        release = threading.Event()
+        
+        def blocking(job):
+            started.set()
+            release.wait(5)
+        
+        ran = []
+        running, _ = scheduler.submit('server_1', 'running', blocking)
+        queued, _ = scheduler.submit('server_1', 'queued', lambda job: ran.append(job.id))
+        self.assertTrue(started.wait(5))
+        scheduler.shutdown()
+        release.set()
+        for thread in scheduler._threads:
+            thread.join(5)
+            self.assertFalse(thread.is_alive())
+        self.assertEqual(running.status, 'done')
+        self.assertEqual(queued.status, 'queued')
+        self.assertEqual(ran, [])
+    
+    def test_shutdown_wakes_idle_workers_without_starting_jobs(self):
+        scheduler = self.make_scheduler(workers=2)
+        ran = []
+        # Рабочие потоки ждут в wait(): задача и остановка приходят до того, как они проснутся
+        with scheduler._cond:
+            queued, _ = scheduler.submit('server_1', 'queued', lambda job: ran.append(job.id))
+            scheduler.shutdown()
+        for thread in scheduler._threads:
+            thread.join(5)
+            self.assertFalse(thread.is_alive())
+        self.assertEqual(queued.status, 'queued')
+        self.assertEqual(ran, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,55 @@
+import itertools
+import unittest
+from unittest import mock
+
+from jobstore import JobStore, _history_query
+
+
+class JobStoreHistoryTest(unittest.TestCase):
+    def setUp(self):
+        # Задачи получают разное время создания в порядке добавления
+        clock = itertools.count(1000)
+        patcher = mock.patch('jobstore.time.time', lambda: float(next(clock)))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.store = JobStore(':memory:')
+        self.addCleanup(self.store.close)
+    
+    def add(self, server_id, pc_number=None, pc_numbers=None):
+        return self.store.add(server_id, pc_number, False, 7, 7, 'test', pc_numbers=pc_numbers)
+    
+    def test_history_of_several_servers_is_merged_newest_first(self):
+        ids = [self.add(server_id) for server_id in ('s1', 's2', 's3', 's1', 's2', 's1')]
+        rows = self.store.history(['s1', 's2'], limit=4)
+        self.assertEqual([row['id'] for row in rows], [ids[5], ids[4], ids[3], ids[1]])
+        self.assertEqual([row['id'] for row in self.store.history(limit=2)], [ids[5], ids[4]])
+        self.assertEqual(self.store.history([]), [])
+    
+    def test_history_includes_batched_results(self):
+        job_id = self.add('s1', pc_number=3)
+        self.store.finish(job_id, 'done', exit_status=0, started_at=1.0, finished_at=2.0)
+        row, = self.store.history(['s1'], pc_number=3)
+        self.assertEqual((row['status'], row['exit_status'], row['finished_at']), ('done', 0, 2.0))
+        self.assertEqual(self.store.unfinished(), [])
+    
+    def test_pc_filter_matches_multi_select_jobs(self):
+        single = self.add('s1', pc_number=3)
+        selected = self.add('s1', pc_numbers=[2, 3, 4])
+        self.add('s1', pc_numbers=[13, 23])
+        self.add('s1', pc_number=13)
+        rows = self.store.history(['s1'], pc_number=3)
+        self.assertEqual([row['id'] for row in rows], [selected, single])
+    
+    def test_server_history_is_read_by_index_without_sorting(self):
+        for server_id in (None, 's1'):
+            for pc_number in (None, 3):
+                query, params = _history_query(server_id, pc_number, 20)
+                plan = [row[3] for row in self.store._conn.execute("EXPLAIN QUERY PLAN " + query, params)]
+                with self.subTest(server_id=server_id, pc_number=pc_number):
+                    self.assertEqual(len(plan), 1, plan)
+                    self.assertIn('USING INDEX', plan[0])
+                    self.assertNotIn('TEMP B-TREE', plan[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
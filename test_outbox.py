@@ -0,0 +1,135 @@
+import io
+import threading
+import time
+import unittest
+
+import requests
+from telebot import types
+from telebot.apihelper import ApiTelegramException
+from urllib3.exceptions import MaxRetryError, NewConnectionError
+
+from outbox import TelegramOutbox
+
+
+def too_many_requests(retry_after=0):
+    return ApiTelegramException('sendDocument', None, {
+        'error_code': 429, 'description': 'Too Many Requests', 'parameters': {'retry_after': retry_after}})
+
+
+def connection_refused():
+    # Так requests сообщает, что соединение не установилось
+    reason = NewConnectionError(None, 'Connection refused')
+    return requests.ConnectionError(MaxRetryError(None, '/bot/sendMessage', reason=reason))
+
+
+class FakeBot:
+    """Bot API, который отвечает 429 на первые flood_calls вызовов, затем бросает errors по одной"""
+    
+    def __init__(self, flood_calls=0, errors=()):
+        self.flood_calls = flood_calls
+        self.errors = list(errors)
+        self.calls = []
+        self.uploads = []
+        self.lock = threading.Lock()
+    
+    def _call(self, method, *args):
+        with self.lock:
+            self.calls.append((method,) + args)
+            if self.flood_calls:
+                self.flood_calls -= 1
+                raise too_many_requests()
+            if self.errors:
+                raise self.errors.pop(0)
+        return method
+    
+    def send_message(self, chat_id, text, **kwargs):
+        return self._call('send_message', chat_id, text)
+    
+    def edit_message_text(self, text, chat_id, message_id, **kwargs):
+        return self._call('edit_message_text', chat_id, message_id, text)
+    
+    def send_document(self, chat_id, document, **kwargs):
+        # Как telebot: содержимое InputFile читается при каждой отправке
+        with self.lock:
+            self.uploads.append(document.file.read())
+        return self._call('send_document', chat_id)
+
+
+class TelegramOutboxTest(unittest.TestCase):
+    def make_outbox(self, bot, **kwargs):
+        outbox = TelegramOutbox(bot, global_rate=1000, chat_rate=1000, chat_burst=1000, **kwargs)
+        outbox.start()
+        self.addCleanup(outbox.stop)
+        return outbox
+    
+    def test_document_is_uploaded_in_full_after_429(self):
+        bot = FakeBot(flood_calls=1)
+        outbox = self.make_outbox(bot)
+        payload = b'x' * 1000
+        document = types.InputFile(io.BytesIO(payload), file_name='output.txt')
+        self.assertEqual(outbox.send_document(1, document), 'send_document')
+        self.assertEqual(bot.uploads, [payload, payload])
+    
+    def test_429_is_retried_until_success(self):
+        bot = FakeBot(flood_calls=2)
+        outbox = self.make_outbox(bot)
+        self.assertEqual(outbox.send_message(1, 'hello'), 'send_message')
+        self.assertEqual(len(bot.calls), 3)
+    
+    def test_429_gives_up_after_max_retries(self):
+        bot = FakeBot(flood_calls=10)
+        outbox = self.make_outbox(bot, max_retries=2)
+        with self.assertRaises(ApiTelegramException):
+            outbox.send_message(1, 'hello')
+        self.assertEqual(len(bot.calls), 3)
+    
+    def test_pending_edits_of_one_message_are_coalesced(self):
+        bot = FakeBot()
+        outbox = TelegramOutbox(bot, global_rate=1000, chat_rate=1000, chat_burst=1000)
+        for i in range(5):
+            outbox.edit_message_text(f'text {i}', 1, 10)
+        outbox.edit_message_text('other message', 1, 11)
+        self.assertEqual(outbox.pending(), 2)
+        outbox.start()
+        self.addCleanup(outbox.stop)
+        outbox.send_message(1, 'after edits')
+        self.assertEqual(bot.calls, [('edit_message_text', 1, 10, 'text 4'),
+                                     ('edit_message_text', 1, 11, 'other message'),
+                                     ('send_message', 1, 'after edits')])
+    
+    def test_message_is_not_resent_after_read_timeout(self):
+        bot = FakeBot(errors=[requests.ReadTimeout('read timed out')])
+        outbox = self.make_outbox(bot)
+        with self.assertRaises(requests.ReadTimeout):
+            outbox.send_message(1, 'hello')
+        self.assertEqual(len(bot.calls), 1)
+    
+    def test_message_is_resent_when_connection_failed(self):
+        bot = FakeBot(errors=[connection_refused()])
+        outbox = self.make_outbox(bot)
+        self.assertEqual(outbox.send_message(1, 'hello'), 'send_message')
+        self.assertEqual(len(bot.calls), 2)
+    
+    def test_idle_chat_state_is_pruned(self):
+        bot = FakeBot()
+        outbox = self.make_outbox(bot)
+        outbox.send_message(1, 'hello')
+        outbox._blocked_until[2] = time.monotonic() - 1
+        with outbox._cond:
+            outbox._prune(time.monotonic() + 10)
+        self.assertEqual(outbox._chat_buckets, {})
+        self.assertEqual(outbox._blocked_until, {})
+    
+    def test_stop_sends_queued_requests_and_joins_workers(self):
+        bot = FakeBot()
+        outbox = TelegramOutbox(bot, global_rate=1000, chat_rate=1000, chat_burst=1000)
+        futures = [outbox.post_message(1, f'text {i}') for i in range(3)]
+        outbox.start()
+        outbox.stop(timeout=5)
+        self.assertTrue(all(future.done() for future in futures))
+        self.assertFalse(any(thread.is_alive() for thread in outbox._threads))
+        self.assertEqual(len(bot.calls), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
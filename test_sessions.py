@@ -0,0 +1,61 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from sessions import SessionStore
+
+
+class SessionStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000000.0
+        patcher = mock.patch('sessions.time.time', lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+    
+    def test_update_merges_and_removes_fields(self):
+        store = SessionStore()
+        store.update(1, current_server='server_1', computers_page=2)
+        store.update(1, computers_page=None, servers_page=1)
+        self.assertEqual(store.get(1), {'current_server': 'server_1', 'servers_page': 1})
+    
+    def test_expired_state_is_dropped(self):
+        store = SessionStore(ttl=60)
+        store.update(1, current_server='server_1')
+        store.update(2, current_server='server_2')
+        self.now += 30
+        self.assertIsNotNone(store.get(2))
+        self.now += 31
+        self.assertIsNone(store.get(1))
+        store.update(3, current_server='server_1')
+        store.purge()
+        self.assertEqual(store.stats(), {'size': 2, 'hits': 1, 'misses': 1, 'evictions': 0, 'expired': 1})
+    
+    def test_least_recently_used_state_is_evicted(self):
+        store = SessionStore(max_entries=2)
+        store.update(1, servers_page=1)
+        store.update(2, servers_page=2)
+        store.get(1)
+        store.update(3, servers_page=3)
+        self.assertIsNone(store.get(2))
+        self.assertEqual(store.get(1), {'servers_page': 1})
+        self.assertEqual(store.stats()['evictions'], 1)
+    
+    def test_saved_states_are_loaded_without_expired(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, 'sessions.json')
+        store = SessionStore(ttl=60, path=path)
+        store.update(1, current_server='server_1')
+        self.now += 40
+        store.update(2, current_server='server_2')
+        store.save()
+        self.now += 30
+        loaded = SessionStore(ttl=60, path=path)
+        loaded.load()
+        self.assertIsNone(loaded.get(1))
+        self.assertEqual(loaded.get(2), {'current_server': 'server_2'})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,32 @@
+import threading
+import unittest
+
+from webhook import WebhookServer
+
+
+class WebhookServerTest(unittest.TestCase):
+    def test_stop_does_not_block_on_full_queue(self):
+        release = threading.Event()
+        handled = []
+        
+        def handle_update(update):
+            handled.append(update['update_id'])
+            release.wait(5)
+        
+        server = WebhookServer(handle_update, host='127.0.0.1', port=0, workers=2, queue_size=3)
+        server.start()
+        for update_id in range(5):
+            server.updates.put({'update_id': update_id})
+        stopper = threading.Thread(target=server.stop)
+        stopper.start()
+        stopper.join(5)
+        self.assertFalse(stopper.is_alive())
+        release.set()
+        for thread in server._threads:
+            thread.join(5)
+            self.assertFalse(thread.is_alive())
+        self.assertEqual(sorted(handled), [0, 1])
+
+
+if __name__ == '__main__':
+    unittest.main()
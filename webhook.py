@@ -0,0 +1,111 @@
+import hmac
+import json
+import logging
+import queue
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+logger = logging.getLogger(__name__)
+
+# Заголовок, в котором Telegram передает секрет, заданный в setWebhook
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+
+# Прием обновлений Telegram через вебхук
+class WebhookServer:
+    """Встроенный HTTP сервер: проверяет секрет, кладет обновления во внутреннюю очередь
+    и обрабатывает их пулом рабочих потоков. Для проверки локально достаточно
+    отправить POST с JSON обновления на path (с секретом в заголовке SECRET_HEADER)"""
+    
+    def __init__(self, handle_update, host='0.0.0.0', port=8443, path='/webhook', secret=None,
+                 workers=4, queue_size=1000, max_body=1024 * 1024):
+        self.handle_update = handle_update
+        self.host = host
+        self.port = port
+        self.path = path
+        self.secret = secret
+        self.workers = workers
+        self.max_body = max_body
+        self.updates = queue.Queue(maxsize=queue_size)
+        self._threads = []
+        self._httpd = None
+        self._stopping = threading.Event()
+    
+    def _make_handler(self):
+        server = self
+        
+        class Handler(BaseHTTPRequestHandler):
+            # Медленный клиент не должен надолго занимать единственный поток приема
+            timeout = 10
+            
+            def do_POST(self):
+                self.send_response(server.accept(self.path, self.headers, self.rfile))
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+            
+            def log_message(self, format, *args):
+                logger.debug(f"{self.address_string()} {format % args}")
+        
+        return Handler
+    
+    def accept(self, path, headers, body):
+        """Проверяет запрос и ставит обновление в очередь. Возвращает HTTP код ответа"""
+        if path != self.path:
+            return 404
+        if self.secret and not hmac.compare_digest(headers.get(SECRET_HEADER, ''), self.secret):
+            logger.warning("Запрос к вебхуку с неверным секретом отклонен")
+            return 403
+        try:
+            length = int(headers.get('Content-Length', 0))
+        except ValueError:
+            return 400
+        if length <= 0 or length > self.max_body:
+            return 413 if length > self.max_body else 400
+        try:
+            update = json.loads(body.read(length).decode('utf-8'))
+        except ValueError:
+            return 400
+        try:
+            self.updates.put_nowait(update)
+        except queue.Full:
+            # Telegram повторит доставку позже
+            logger.warning("Очередь обновлений переполнена, обновление отклонено")
+            return 503
+        return 200
+    
+    def start(self):
+        """Запускает рабочие потоки и HTTP сервер в фоне"""
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._worker, name=f'webhook-worker-{i + 1}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        self._httpd = HTTPServer((self.host, self.port), self._make_handler())
+        # Порт 0 - выбрать свободный (удобно при локальной проверке)
+        self.port = self._httpd.server_port
+        threading.Thread(target=self._httpd.serve_forever, name='webhook-http', daemon=True).start()
+        logger.info(f"Вебхук слушает {self.host}:{self.port}{self.path}")
+    
+    def stop(self):
+        if self._httpd is not None:
+            self._httpd.shutdown()
+            self._httpd.server_close()
+        self._stopping.set()
+        # Будим простаивающие потоки; если очередь полна, потоки заняты и сами увидят _stopping
+        for _ in self._threads:
+            try:
+                self.updates.put_nowait(None)
+            except queue.Full:
+                break
+        left = sum(update is not None for update in list(self.updates.queue))
+        if left:
+            logger.warning(f"Остановка вебхука: не обработано обновлений: {left}")
+    
+    def _worker(self):
+        while not self._stopping.is_set():
+            update = self.updates.get()
+            if update is None:
+                return
+            try:
+                self.handle_update(update)
+            except Exception as e:
+                logger.error(f"Ошибка обработки обновления {update.get('update_id')}: {e}")